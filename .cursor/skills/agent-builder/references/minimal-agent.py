@@ -1,9 +1,33 @@
 #!/usr/bin/env python3
 """
-Minimal Agent Template - Copy and customize this.
+Reference Agent Template - Copy and customize this.
 
-This is the simplest possible working agent (~80 lines).
-It has everything you need: 3 tools + loop.
+The core is still small: 3 tools (TOOLS + execute_tool) and the loop in agent().
+Everything else in this file is optional machinery for production use - each
+part below is self-contained, so delete what you don't need (or start from
+scripts/init_agent.py --level 0 for a bash-only agent):
+
+Parallel tools: tool calls from one response run in parallel
+(MAX_PARALLEL_TOOLS threads); calls that touch the same file keep their
+original order. bash may touch any file, so it runs alone unless
+PARALLEL_BASH=1.
+
+Streaming: responses are streamed (STREAM=0 to turn off): text prints as it
+arrives and read-only tool calls start as soon as their input is complete,
+while the model is still writing the rest of the turn. Writes and bash wait
+until the turn has ended with stop_reason "tool_use", so a turn cut off at
+max_tokens never changes anything.
+
+Context management: long sessions stay cheap - the system prompt, tools and
+history prefix carry cache_control breakpoints, and once the history passes
+CONTEXT_BUDGET (estimated tokens) old tool outputs are cut down - then recent
+ones, then the oldest exchanges, until it fits. Each turn logs the estimate
+next to the real input / cached token counts.
+
+Telemetry: objects in HOOKS get on_request / on_response / on_tool_start /
+on_tool_end calls. Set TRACE_FILE=trace.jsonl to record model latency, token
+usage and per-tool timing, then `python scripts/trace_summary.py trace.jsonl`
+shows where the time went.
 
 Usage:
     1. Set ANTHROPIC_API_KEY environment variable
@@ -12,14 +36,23 @@ Usage:
 """
 
 from anthropic import Anthropic
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 import subprocess
+import threading
+import json
+import time
 import os
 
 # Configuration
 client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
 MODEL = os.getenv("MODEL_NAME", "claude-sonnet-4-20250514")
 WORKDIR = Path.cwd()
+MAX_PARALLEL_TOOLS = int(os.getenv("MAX_PARALLEL_TOOLS", "4"))
+PARALLEL_BASH = os.getenv("PARALLEL_BASH", "0") == "1"  # opt in: bash overlaps reads and other bash
+STREAM = os.getenv("STREAM", "1") != "0"
+CONTEXT_BUDGET = int(os.getenv("CONTEXT_BUDGET", "80000"))  # estimated tokens
+TRACE_FILE = os.getenv("TRACE_FILE", "")  # JSONL trace, empty = off
 
 # System prompt - keep it simple
 SYSTEM = f"""You are a coding agent at {WORKDIR}.
@@ -94,6 +127,326 @@ def execute_tool(name: str, args: dict) -> str:
     return f"Unknown tool: {name}"
 
 
+# Telemetry: any object with some of these methods can go in HOOKS
+#   on_request(agent, request)                       before each model call
+#   on_response(agent, response, seconds)            after it returns
+#   on_tool_start(agent, name, args)                 when a tool starts running
+#   on_tool_end(agent, name, args, output, seconds)  when it finishes
+# agent is "main" here, the subagent label in subagent-pattern.py.
+HOOKS = []
+
+
+def fire(event: str, *args, hooks: list = None):
+    """Call event on every hook; a failing hook never breaks the loop."""
+    for hook in HOOKS if hooks is None else hooks:
+        handler = getattr(hook, event, None)
+        if handler:
+            try:
+                handler(*args)
+            except Exception as e:
+                print(f"  [hook {event} failed: {e}]")
+
+
+class TraceRecorder:
+    """Appends one JSON line per event to path - summarize with scripts/trace_summary.py."""
+
+    def __init__(self, path: str):
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()  # tools and subagents report from other threads
+        self._turns = {}
+
+    def _write(self, event: str, agent: str, **fields):
+        line = json.dumps({"ts": round(time.time(), 3), "event": event, "agent": agent, **fields},
+                          ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def on_request(self, agent, request):
+        with self._lock:
+            turn = self._turns[agent] = self._turns.get(agent, 0) + 1
+        self._write("request", agent, turn=turn, messages=len(request["messages"]),
+                    est_tokens=estimate_tokens(request))
+
+    def on_response(self, agent, response, seconds):
+        usage = response.usage
+        self._write("response", agent, turn=self._turns.get(agent, 0), seconds=round(seconds, 3),
+                    stop_reason=response.stop_reason,
+                    input_tokens=usage.input_tokens, output_tokens=usage.output_tokens,
+                    cache_read=getattr(usage, "cache_read_input_tokens", 0) or 0,
+                    cache_write=getattr(usage, "cache_creation_input_tokens", 0) or 0)
+
+    def on_tool_start(self, agent, name, args):
+        self._write("tool_start", agent, tool=name)
+
+    def on_tool_end(self, agent, name, args, output, seconds):
+        self._write("tool_end", agent, tool=name, seconds=round(seconds, 3),
+                    output_chars=len(output), args=json.dumps(args, ensure_ascii=False)[:200])
+
+
+if TRACE_FILE:
+    HOOKS.append(TraceRecorder(TRACE_FILE))
+
+
+# Which tools read / write the file in args["path"] - add yours (e.g. edit_file) here.
+# bash may touch any file, so it runs alone (like unlisted tools) unless PARALLEL_BASH.
+READ_TOOLS = {"read_file"}
+WRITE_TOOLS = {"write_file"}
+SHELL_TOOLS = {"bash"}
+
+
+def _access(name: str, args: dict):
+    """(kind, path) for conflict detection: kind is read / write / shell / other."""
+    if name in READ_TOOLS or name in WRITE_TOOLS:
+        path = os.path.normcase(str((WORKDIR / args.get("path", "")).resolve()))
+        return ("write" if name in WRITE_TOOLS else "read"), path
+    return ("shell" if name in SHELL_TOOLS else "other"), None
+
+
+def conflicts(a: tuple, b: tuple) -> bool:
+    """Must these two (name, args) calls run in order?
+
+    Reads never conflict with reads; a write conflicts with anything on the same
+    path. bash and unlisted tools conflict with everything. With PARALLEL_BASH,
+    bash only conflicts with writes, so commands that depend on each other's
+    side effects (mkdir x / cd x) may then run out of order.
+    """
+    (ka, pa), (kb, pb) = _access(*a), _access(*b)
+    if "other" in (ka, kb) or ("shell" in (ka, kb) and not PARALLEL_BASH):
+        return True
+    if "write" not in (ka, kb):
+        return False
+    return "shell" in (ka, kb) or pa == pb
+
+
+def _run_after(deps: list, name: str, args: dict, agent: str = "main") -> str:
+    wait(deps)
+    fire("on_tool_start", agent, name, args)
+    start = time.perf_counter()
+    try:
+        output = execute_tool(name, args)
+    except Exception as e:
+        output = f"Error: {e}"
+    fire("on_tool_end", agent, name, args, output, time.perf_counter() - start)
+    return output
+
+
+class ToolRunner:
+    """
+    Starts tool calls as they arrive; each waits for earlier calls it conflicts
+    with, so "write a.py then read a.py" still happens in that order while
+    independent reads and writes to other files overlap.
+    """
+
+    def __init__(self, max_workers: int = MAX_PARALLEL_TOOLS, agent: str = "main"):
+        self.agent = agent  # reported to HOOKS
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self._calls = []
+        self._futures = []
+
+    def submit(self, name: str, args: dict):
+        """Start a call, returns a Future for its output."""
+        # Each call only waits on earlier ones, which were submitted first, so a
+        # full pool never deadlocks
+        deps = [f for c, f in zip(self._calls, self._futures) if conflicts(c, (name, args))]
+        future = self._pool.submit(_run_after, deps, name, args, self.agent)
+        self._calls.append((name, args))
+        self._futures.append(future)
+        return future
+
+    def close(self):
+        """No more calls; running ones finish in the background."""
+        self._pool.shutdown(wait=False)
+
+
+def execute_tools(calls: list, max_workers: int = MAX_PARALLEL_TOOLS, agent: str = "main") -> list:
+    """Run one turn's [(name, args), ...] concurrently. Returns outputs in call order."""
+    if len(calls) <= 1 or max_workers <= 1:
+        return [_run_after([], name, args, agent) for name, args in calls]
+    runner = ToolRunner(max_workers, agent)
+    futures = [runner.submit(name, args) for name, args in calls]
+    runner.close()
+    return [f.result() for f in futures]
+
+
+def stream_turn(request: dict, echo: bool = True, agent: str = "main", api_client=None):
+    """
+    Stream one response. Returns (message, {tool_use_id: Future}).
+
+    Text is printed as it arrives (echo=False for silent subagents). A read-only
+    tool_use block (READ_TOOLS) is handed to a ToolRunner at its
+    content_block_stop - the moment its input JSON is complete - so it runs while
+    later blocks are generated. Writes, bash and every call after them are held
+    until the message ends and only run if stop_reason is "tool_use"; on any
+    other stop (e.g. max_tokens) early reads are cancelled or joined and no
+    futures are returned. agent labels those tool calls for HOOKS; api_client overrides the module
+    client (subagents pass the one they were given).
+    """
+    runner = ToolRunner(agent=agent)
+    futures = {}
+    partial = {}  # block index -> [tool_use block, input JSON so far]
+    mid_line = False  # streamed text not yet ended with a newline
+    holding = False  # a side-effecting call was seen: start nothing more early
+    try:
+        with (api_client or client).messages.stream(**request) as stream:
+            for event in stream:
+                if event.type == "content_block_start" and event.content_block.type == "tool_use":
+                    partial[event.index] = [event.content_block, ""]
+                elif event.type == "content_block_delta":
+                    if event.delta.type == "text_delta" and echo:
+                        print(event.delta.text, end="", flush=True)
+                        mid_line = not event.delta.text.endswith("\n")
+                    elif event.delta.type == "input_json_delta" and event.index in partial:
+                        partial[event.index][1] += event.delta.partial_json
+                elif event.type == "content_block_stop" and event.index in partial:
+                    block, raw = partial.pop(event.index)
+                    try:
+                        args = json.loads(raw) if raw else {}
+                    except ValueError:
+                        holding = True  # started below from the final message
+                        continue
+                    if echo:
+                        print(("\n" if mid_line else "") + f"> {block.name}: {args}")
+                        mid_line = False
+                    # Later calls may depend on a held one, so keep block order from here on
+                    holding = holding or block.name not in READ_TOOLS
+                    if not holding:
+                        futures[block.id] = runner.submit(block.name, args)
+            message = stream.get_final_message()
+        if message.stop_reason == "tool_use":
+            for block in message.content:
+                if block.type == "tool_use" and block.id not in futures:
+                    futures[block.id] = runner.submit(block.name, block.input)
+        else:
+            # Truncated or otherwise not a tool turn: drop reads that haven't started, let the rest finish
+            for future in futures.values():
+                future.cancel()
+            wait(list(futures.values()))
+            futures = {}
+    finally:
+        runner.close()
+    if mid_line:
+        print()
+    return message, futures
+
+
+# Context management: cache the stable prefix, shrink old tool output
+CACHE = {"type": "ephemeral"}
+KEEP_RECENT = 6  # latest messages are never compacted
+ELIDED_KEEP = 500  # chars of an old tool_result kept after compaction
+
+
+def estimate_tokens(value) -> int:
+    """Rough count (~4 chars per token) - good enough to decide when to compact."""
+    dump = lambda o: o.model_dump() if hasattr(o, "model_dump") else str(o)
+    return len(json.dumps(value, default=dump, ensure_ascii=False)) // 4
+
+
+def _elide(messages: list, target: int, total: int, min_len: int) -> tuple:
+    """Cut tool_results longer than min_len in messages, oldest first, until total <= target."""
+    elided = 0
+    for msg in messages:
+        if total <= target:
+            break
+        if msg["role"] != "user" or not isinstance(msg["content"], list):
+            continue
+        for part in msg["content"]:
+            if not isinstance(part, dict) or part.get("type") != "tool_result":
+                continue
+            text = part.get("content")
+            if isinstance(text, str) and len(text) > min_len:
+                part["content"] = text[:ELIDED_KEEP] + f"\n[... {len(text) - ELIDED_KEEP} chars of old output elided]"
+                total -= (len(text) - ELIDED_KEEP) // 4
+                elided += 1
+    return total, elided
+
+
+def _is_prompt(msg: dict) -> bool:
+    """A user turn that starts an exchange (not a batch of tool_results)."""
+    content = msg["content"]
+    return msg["role"] == "user" and (isinstance(content, str) or not any(
+        isinstance(p, dict) and p.get("type") == "tool_result" for p in content))
+
+
+def compact_history(history: list, budget: int = CONTEXT_BUDGET) -> int:
+    """
+    Once history is over budget, cut old tool_results to their first ELIDED_KEEP
+    chars, oldest first, until it is down to half the budget. Returns the estimate.
+
+    Compacting well below the budget means it happens rarely, so the cached
+    prefix stays valid for many turns in between. If that is not enough, the
+    latest KEEP_RECENT messages are cut too (down to the budget), then whole old
+    exchanges are dropped. The newest tool_result - output the model has not
+    seen yet - is cut only as a last resort.
+
+    Check with `python -m doctest minimal-agent.py`: the older outputs are
+    enough here, so the newest one survives intact.
+
+    >>> h = [{"role": "user", "content": "task"}]
+    >>> for i in range(10):
+    ...     h += [{"role": "assistant", "content": [{"type": "tool_use", "id": f"t{i}", "name": "bash", "input": {}}]},
+    ...           {"role": "user", "content": [{"type": "tool_result", "tool_use_id": f"t{i}", "content": "x" * 40000}]}]
+    >>> compact_history(h, budget=20000) <= 20000  # doctest: +ELLIPSIS
+      [context compacted to ~... tokens: 9 tool outputs elided]
+    True
+    >>> len(h[-1]["content"][0]["content"])
+    40000
+    """
+    total = estimate_tokens(history)
+    if total <= budget:
+        return total
+    total, elided = _elide(history[:-KEEP_RECENT], budget // 2, total, ELIDED_KEEP * 2)
+    newest = history[-1:] if history and not _is_prompt(history[-1]) else []
+    older = history[:len(history) - len(newest)]
+    if total > budget:
+        total, more = _elide(older, budget, total, ELIDED_KEEP + 100)
+        elided += more
+    dropped = 0
+    if total > budget:
+        # Drop the oldest exchanges (prompt .. its last tool_result), never the current one
+        starts = [i for i, m in enumerate(history) if _is_prompt(m)]
+        for cut in starts[1:]:
+            del history[:cut - dropped]
+            dropped = cut
+            if estimate_tokens(history) <= budget:
+                break
+        total = estimate_tokens(history)
+    if total > budget and newest:
+        # Last resort: the output the model is about to read
+        total, more = _elide(newest, budget, total, ELIDED_KEEP + 100)
+        elided += more
+    if elided or dropped:
+        dropped_note = f", dropped {dropped} old messages" if dropped else ""
+        print(f"  [context compacted to ~{total} tokens: {elided} tool outputs elided{dropped_note}]")
+    if total > budget:
+        print(f"  [context still ~{total} tokens, over CONTEXT_BUDGET={budget}: the current turn alone is too big]")
+    return total
+
+
+def build_request(history: list) -> dict:
+    """Request with cache breakpoints on tools, system and the end of history."""
+    last = history[-1]
+    content = last["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    # Breakpoint on the newest message: next turn reads everything up to here from cache
+    content = content[:-1] + [{**content[-1], "cache_control": CACHE}]
+    return dict(
+        model=MODEL,
+        system=[{"type": "text", "text": SYSTEM, "cache_control": CACHE}],
+        tools=TOOLS[:-1] + [{**TOOLS[-1], "cache_control": CACHE}],
+        messages=history[:-1] + [{**last, "content": content}],
+        max_tokens=8000,
+    )
+
+
+def log_context(estimate: int, usage):
+    read = getattr(usage, "cache_read_input_tokens", 0) or 0
+    written = getattr(usage, "cache_creation_input_tokens", 0) or 0
+    print(f"  [context ~{estimate} tokens est | input {usage.input_tokens}, cache read {read}, "
+          f"cache write {written}, output {usage.output_tokens}]")
+
+
 def agent(prompt: str, history: list = None) -> str:
     """Run the agent loop."""
     if history is None:
@@ -102,13 +455,25 @@ def agent(prompt: str, history: list = None) -> str:
     history.append({"role": "user", "content": prompt})
 
     while True:
-        response = client.messages.create(
-            model=MODEL,
-            system=SYSTEM,
-            messages=history,
-            tools=TOOLS,
-            max_tokens=8000,
-        )
+        estimate = compact_history(history)
+        request = build_request(history)
+        fire("on_request", "main", request)
+        start = time.perf_counter()
+        if STREAM:
+            # Tools already started while the response was streaming
+            response, started = stream_turn(request)
+        else:
+            response, started = client.messages.create(**request), {}
+        fire("on_response", "main", response, time.perf_counter() - start)
+        log_context(estimate, response.usage)
+
+        if response.stop_reason == "max_tokens":
+            # Cut off mid-turn: its tool calls never ran and would have no results,
+            # so keep only the text and tell the user
+            text = "".join(b.text for b in response.content if hasattr(b, "text"))
+            print("  [response cut off at max_tokens - its tool calls were dropped, no writes or bash ran]")
+            history.append({"role": "assistant", "content": text or "(cut off at max_tokens)"})
+            return text + "\n[response truncated at max_tokens]"
 
         # Build assistant message
         history.append({"role": "assistant", "content": response.content})
@@ -117,18 +482,22 @@ def agent(prompt: str, history: list = None) -> str:
         if response.stop_reason != "tool_use":
             return "".join(b.text for b in response.content if hasattr(b, "text"))
 
-        # Execute tools
+        # Execute tools (in parallel; results keep the tool_use order)
+        tool_calls = [b for b in response.content if b.type == "tool_use"]
+        if started:
+            outputs = [started[tc.id].result() for tc in tool_calls]
+        else:
+            for tc in tool_calls:
+                print(f"> {tc.name}: {tc.input}")
+            outputs = execute_tools([(tc.name, tc.input) for tc in tool_calls])
         results = []
-        for block in response.content:
-            if block.type == "tool_use":
-                print(f"> {block.name}: {block.input}")
-                output = execute_tool(block.name, block.input)
-                print(f"  {output[:100]}...")
-                results.append({
-                    "type": "tool_result",
-                    "tool_use_id": block.id,
-                    "content": output
-                })
+        for tc, output in zip(tool_calls, outputs):
+            print(f"  {tc.name}: {output[:100]}...")
+            results.append({
+                "type": "tool_result",
+                "tool_use_id": tc.id,
+                "content": output
+            })
 
         history.append({"role": "user", "content": results})
 
@@ -145,5 +514,7 @@ if __name__ == "__main__":
             break
         if query in ("q", "quit", "exit", ""):
             break
-        print(agent(query, history))
+        answer = agent(query, history)
+        if not STREAM:  # already printed while streaming
+            print(answer)
         print()
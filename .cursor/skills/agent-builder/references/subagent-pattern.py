@@ -3,13 +3,25 @@ Subagent Pattern - How to implement Task tool for context isolation.
 
 The key insight: spawn child agents with ISOLATED context to prevent
 "context pollution" where exploration details fill up the main conversation.
+
+Pass execute_tools (see minimal-agent.py) to run_task and the subagent runs
+each turn's tool calls in parallel too. When the model issues several Task
+calls in one turn, run_tasks() fans them out concurrently under a shared
+token budget and yields each result as it completes. Pass stream_turn (also
+minimal-agent.py) and subagent tool calls start while the response streams.
+Pass hooks (minimal-agent.HOOKS) to trace each subagent's model calls and
+tools under its own label.
 """
 
+import threading
 import time
-import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 
 # Assuming client, MODEL, execute_tool are defined elsewhere
 
+MAX_CONCURRENT_SUBAGENTS = 4
+
 
 # =============================================================================
 # AGENT TYPE REGISTRY
@@ -116,8 +128,55 @@ Example uses:
 # SUBAGENT EXECUTION
 # =============================================================================
 
+_print_lock = threading.Lock()
+
+
+def progress(label: str, message: str):
+    """One line per update - concurrent subagents can't share a \\r line."""
+    with _print_lock:
+        print(f"  [{label}] {message}", flush=True)
+
+
+def _fire(hooks, event: str, *args):
+    """Same hook interface as minimal-agent.py: on_request, on_response, on_tool_start, on_tool_end."""
+    for hook in hooks or ():
+        handler = getattr(hook, event, None)
+        if handler:
+            try:
+                handler(*args)
+            except Exception as e:
+                print(f"  [hook {event} failed: {e}]")
+
+
+def _timed_tool(execute_tool, hooks, label: str, name: str, args: dict) -> str:
+    _fire(hooks, "on_tool_start", label, name, args)
+    t0 = time.perf_counter()
+    output = execute_tool(name, args)
+    _fire(hooks, "on_tool_end", label, name, args, output, time.perf_counter() - t0)
+    return output
+
+
+class TokenBudget:
+    """Input + output tokens shared by all subagents of one fan-out."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def add(self, usage):
+        with self._lock:
+            self.used += usage.input_tokens + usage.output_tokens
+
+    @property
+    def exhausted(self) -> bool:
+        return self.used >= self.limit
+
+
 def run_task(description: str, prompt: str, agent_type: str,
-             client, model: str, workdir, base_tools: list, execute_tool) -> str:
+             client, model: str, workdir, base_tools: list, execute_tool,
+             execute_tools=None, budget: TokenBudget = None, label: str = None,
+             stream_turn=None, hooks: list = None) -> str:
     """
     Execute a subagent task with isolated context.
 
@@ -136,6 +195,18 @@ def run_task(description: str, prompt: str, agent_type: str,
         workdir: Working directory
         base_tools: List of tool definitions
         execute_tool: Function to execute tools
+        execute_tools: Optional batch executor, ([(name, args)], agent=label) -> [output],
+            that runs one turn's calls concurrently (minimal-agent.execute_tools)
+        budget: Optional shared TokenBudget; the subagent stops at the next
+            turn once it is used up
+        label: Progress prefix (defaults to agent_type)
+        stream_turn: Optional (request, echo=False, agent=label, api_client=client)
+            -> (message, {tool_use_id: Future}) that streams the response with the
+            given client and starts tools as their input completes
+            (minimal-agent.stream_turn)
+        hooks: Optional telemetry hooks (minimal-agent.HOOKS); events carry
+            label as the agent name. Tools run by stream_turn / execute_tools
+            report to minimal-agent's HOOKS themselves
 
     Returns:
         Final text output from subagent
@@ -160,52 +231,64 @@ Complete the task and return a clear, concise summary."""
     sub_messages = [{"role": "user", "content": prompt}]
 
     # Progress display
-    print(f"  [{agent_type}] {description}")
+    label = label or agent_type
+    progress(label, description)
     start = time.time()
     tool_count = 0
+    over_budget = False
 
     # Run the same agent loop (but silently)
     while True:
-        response = client.messages.create(
-            model=model,
-            system=sub_system,
-            messages=sub_messages,
-            tools=sub_tools,
-            max_tokens=8000,
-        )
+        request = dict(model=model, system=sub_system, messages=sub_messages,
+                       tools=sub_tools, max_tokens=8000)
+        _fire(hooks, "on_request", label, request)
+        t0 = time.perf_counter()
+        if stream_turn:
+            response, started = stream_turn(request, echo=False, agent=label, api_client=client)
+        else:
+            response, started = client.messages.create(**request), {}
+        _fire(hooks, "on_response", label, response, time.perf_counter() - t0)
 
         # Check if done
+        if budget:
+            budget.add(response.usage)
+        if response.stop_reason == "max_tokens":
+            # Cut off mid-turn: its tool calls are not run (stream_turn holds writes until the turn ends)
+            progress(label, f"{description} - response cut off at max_tokens")
         if response.stop_reason != "tool_use":
             break
+        if budget and budget.exhausted:
+            progress(label, f"{description} - token budget used up, stopping")
+            over_budget = True
+            break
 
-        # Execute tools
+        # Execute tools - the whole turn at once when a batch executor is given
         tool_calls = [b for b in response.content if b.type == "tool_use"]
+        if started:
+            outputs = [started[tc.id].result() for tc in tool_calls]
+        elif execute_tools:
+            outputs = execute_tools([(tc.name, tc.input) for tc in tool_calls], agent=label)
+        else:
+            outputs = [_timed_tool(execute_tool, hooks, label, tc.name, tc.input) for tc in tool_calls]
         results = []
 
-        for tc in tool_calls:
+        for tc, output in zip(tool_calls, outputs):
             tool_count += 1
-            output = execute_tool(tc.name, tc.input)
             results.append({
                 "type": "tool_result",
                 "tool_use_id": tc.id,
                 "content": output
             })
 
-            # Update progress (in-place on same line)
-            elapsed = time.time() - start
-            sys.stdout.write(
-                f"\r  [{agent_type}] {description} ... {tool_count} tools, {elapsed:.1f}s"
-            )
-            sys.stdout.flush()
+        elapsed = time.time() - start
+        progress(label, f"{description} ... {tool_count} tools, {elapsed:.1f}s")
 
         sub_messages.append({"role": "assistant", "content": response.content})
         sub_messages.append({"role": "user", "content": results})
 
     # Final progress update
     elapsed = time.time() - start
-    sys.stdout.write(
-        f"\r  [{agent_type}] {description} - done ({tool_count} tools, {elapsed:.1f}s)\n"
-    )
+    progress(label, f"{description} - done ({tool_count} tools, {elapsed:.1f}s)")
 
     # Extract and return ONLY the final text
     # This is what the parent agent sees - a clean summary
@@ -213,9 +296,44 @@ Complete the task and return a clear, concise summary."""
         if hasattr(block, "text"):
             return block.text
 
+    if over_budget:
+        return f"(subagent stopped: token budget used up after {tool_count} tools)"
     return "(subagent returned no text)"
 
 
+def run_tasks(tasks: list, client, model: str, workdir, base_tools: list, execute_tool,
+              execute_tools=None, max_concurrent: int = MAX_CONCURRENT_SUBAGENTS,
+              token_budget: int = None, stream_turn=None, hooks: list = None):
+    """
+    Fan out several Task calls at once. Yields (index, result) as each finishes.
+
+    tasks: [{"description", "prompt", "agent_type"}, ...] - the Task inputs of one turn.
+    All subagents share one client (it is thread-safe) and, when token_budget
+    is set, one TokenBudget. Agent types with all tools ("*", e.g. code) may
+    write files, so those run one at a time; read-only types overlap freely.
+    """
+    budget = TokenBudget(token_budget) if token_budget else None
+    writer_lock = threading.Lock()
+
+    def _one(i: int, task: dict) -> str:
+        may_write = AGENT_TYPES.get(task.get("agent_type"), {}).get("tools") == "*"
+        with writer_lock if may_write else nullcontext():
+            return run_task(task["description"], task["prompt"], task["agent_type"],
+                            client, model, workdir, base_tools, execute_tool,
+                            execute_tools=execute_tools, budget=budget,
+                            label=f"{task['agent_type']}#{i + 1}", stream_turn=stream_turn,
+                            hooks=hooks)
+
+    with ThreadPoolExecutor(max_workers=max_concurrent) as pool:
+        futures = {pool.submit(_one, i, t): i for i, t in enumerate(tasks)}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = f"Error: {e}"
+            yield futures[future], result
+
+
 # =============================================================================
 # USAGE EXAMPLE
 # =============================================================================
@@ -233,11 +351,31 @@ def execute_tool(name: str, args: dict) -> str:
             model=MODEL,
             workdir=WORKDIR,
             base_tools=BASE_TOOLS,
-            execute_tool=execute_tool  # Pass self for recursion
+            execute_tool=execute_tool,  # Pass self for recursion
+            execute_tools=execute_tools,  # Parallel tool calls (minimal-agent.py)
+            stream_turn=stream_turn,  # Start tools while streaming (minimal-agent.py)
+            hooks=HOOKS,  # Telemetry, e.g. TRACE_FILE (minimal-agent.py)
         )
     # ... other tools ...
 
 
 # In your TOOLS list:
 TOOLS = BASE_TOOLS + [TASK_TOOL]
+
+
+# Fan-out: in the main loop, run all Task calls of a turn together and
+# everything else through execute_tools; results keep the tool_use order.
+
+tool_calls = [b for b in response.content if b.type == "tool_use"]
+tasks = [tc for tc in tool_calls if tc.name == "Task"]
+others = [tc for tc in tool_calls if tc.name != "Task"]
+outputs = dict(zip((tc.id for tc in others),
+                   execute_tools([(tc.name, tc.input) for tc in others])))
+for i, result in run_tasks([tc.input for tc in tasks], client, MODEL, WORKDIR,
+                           BASE_TOOLS, execute_tool, execute_tools=execute_tools,
+                           token_budget=200_000, hooks=HOOKS):
+    outputs[tasks[i].id] = result          # arrives as each subagent finishes
+    print(f"  <- {tasks[i].input['description']}: {result[:100]}")
+results = [{"type": "tool_result", "tool_use_id": tc.id, "content": outputs[tc.id]}
+           for tc in tool_calls]
 """
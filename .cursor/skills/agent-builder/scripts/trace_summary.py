@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Trace Summary - Where did an agent session spend its time and tokens?
+
+Reads the JSONL written by TraceRecorder (TRACE_FILE=... in
+references/minimal-agent.py) and reports, per agent, model time and token
+usage, then per tool the call count, wall time and output size, followed by
+the slowest tool calls and the largest prompts.
+
+Usage:
+    python trace_summary.py <trace.jsonl> [more.jsonl ...] [--top N]
+
+Examples:
+    TRACE_FILE=trace.jsonl python minimal-agent.py
+    python trace_summary.py trace.jsonl             # Full report
+    python trace_summary.py trace.jsonl --top 10    # Longer top lists
+"""
+
+import argparse
+import json
+import sys
+from collections import defaultdict
+
+
+def load_events(paths: list) -> list:
+    """All events from the given files, oldest first. Broken lines are skipped."""
+    events = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(event, dict) and "event" in event:
+                    events.append(event)
+    events.sort(key=lambda e: e.get("ts", 0))
+    return events
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def table(headers: list, rows: list) -> str:
+    widths = [max(len(str(x)) for x in col) for col in zip(headers, *rows)]
+    fmt = lambda row: "  ".join(str(x).rjust(w) if i else str(x).ljust(w)
+                                for i, (x, w) in enumerate(zip(row, widths)))
+    return "\n".join([fmt(headers), fmt(["-" * w for w in widths])] + [fmt(r) for r in rows])
+
+
+def summarize(events: list, top: int = 5) -> str:
+    responses = [e for e in events if e["event"] == "response"]
+    tools = [e for e in events if e["event"] == "tool_end"]
+    requests = [e for e in events if e["event"] == "request"]
+    if not responses and not tools:
+        return "No model calls or tool runs in trace."
+
+    out = []
+    span = events[-1]["ts"] - events[0]["ts"]
+    model_time = sum(e["seconds"] for e in responses)
+    tool_time = sum(e["seconds"] for e in tools)
+    out.append(f"Session: {span:.1f}s wall, {len(responses)} model calls ({model_time:.1f}s), "
+               f"{len(tools)} tool runs ({tool_time:.1f}s, may overlap)")
+
+    # Model calls per agent
+    by_agent = defaultdict(list)
+    for e in responses:
+        by_agent[e["agent"]].append(e)
+    rows = []
+    for agent, rs in sorted(by_agent.items(), key=lambda kv: -sum(e["seconds"] for e in kv[1])):
+        secs = [e["seconds"] for e in rs]
+        fresh = sum(e["input_tokens"] for e in rs)
+        read = sum(e.get("cache_read", 0) for e in rs)
+        written = sum(e.get("cache_write", 0) for e in rs)
+        prompt = fresh + read + written
+        rows.append([agent, len(rs), f"{sum(secs):.1f}", f"{sum(secs) / len(rs):.2f}",
+                     f"{percentile(secs, 0.95):.2f}", prompt, f"{100 * read / prompt:.0f}%" if prompt else "-",
+                     sum(e["output_tokens"] for e in rs)])
+    if rows:
+        out += ["", "Model calls by agent:",
+                table(["agent", "calls", "total s", "avg s", "p95 s", "prompt tok", "cached", "output tok"], rows)]
+
+    # Tools, slowest total first
+    by_tool = defaultdict(list)
+    for e in tools:
+        by_tool[e["tool"]].append(e)
+    rows = []
+    for name, ts in sorted(by_tool.items(), key=lambda kv: -sum(e["seconds"] for e in kv[1])):
+        secs = [e["seconds"] for e in ts]
+        sizes = [e.get("output_chars", 0) for e in ts]
+        rows.append([name, len(ts), f"{sum(secs):.1f}", f"{sum(secs) / len(ts):.2f}", f"{max(secs):.2f}",
+                     sum(sizes) // len(ts), max(sizes)])
+    if rows:
+        out += ["", "Tools:", table(["tool", "calls", "total s", "avg s", "max s", "avg chars", "max chars"], rows)]
+
+    if tools:
+        rows = [[f"{e['seconds']:.2f}", e["agent"], e["tool"], e.get("output_chars", 0), e.get("args", "")[:60]]
+                for e in sorted(tools, key=lambda e: -e["seconds"])[:top]]
+        out += ["", f"Slowest tool calls (top {top}):", table(["s", "agent", "tool", "chars", "args"], rows)]
+
+    if responses:
+        # Prompt size is exact from the response usage; estimate from the request as a fallback
+        est = {(e["agent"], e.get("turn")): e.get("est_tokens", 0) for e in requests}
+        rows = []
+        for e in sorted(responses, key=lambda e: -(e["input_tokens"] + e.get("cache_read", 0) + e.get("cache_write", 0)))[:top]:
+            prompt = e["input_tokens"] + e.get("cache_read", 0) + e.get("cache_write", 0)
+            rows.append([prompt or est.get((e["agent"], e.get("turn")), 0), e["agent"], e.get("turn", "-"),
+                         e.get("cache_read", 0), f"{e['seconds']:.2f}"])
+        out += ["", f"Largest prompts (top {top}):", table(["prompt tok", "agent", "turn", "cache read", "s"], rows)]
+
+    return "\n".join(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Summarize agent trace JSONL: model latency, tokens, tool timing",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split("Examples:")[1],
+    )
+    parser.add_argument("traces", nargs="+", help="JSONL trace file(s) written by TraceRecorder")
+    parser.add_argument("--top", type=int, default=5, help="Rows in the slowest / largest lists (default 5)")
+    args = parser.parse_args()
+
+    try:
+        events = load_events(args.traces)
+    except OSError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(summarize(events, args.top))
+
+
+if __name__ == "__main__":
+    main()
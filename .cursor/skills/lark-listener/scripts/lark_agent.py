@@ -5,72 +5,49 @@
 用法:
   python lark_agent.py --workspace D:\kuaikuAi\autowork
   python lark_agent.py --workspace D:\kuaikuAi\autowork --agent-on-new   # 收到消息后自动启动无头 Agent
+  python lark_agent.py --workspace D:\kuaikuAi\autowork --agent-workers 3   # supervisor 模式：3 个 Agent worker 并行处理
+
+运行中修改 lark-config.json 会自动生效：agent_debounce / agent_cooldown / agent_batch 以及
+ack_text、workers、send_rate 等（写了的优先于命令行参数，见 lark_config.py），长连接不断开。
 """
 
 import argparse
-import json
 import os
 import subprocess
 import sys
-from datetime import datetime
 
 try:
-    import lark_oapi as lark
-    import requests
+    import lark_oapi  # noqa: F401
+    import requests  # noqa: F401
 except ImportError:
     print("请先安装: pip install lark-oapi requests", file=sys.stderr)
     sys.exit(1)
 
-LARK_PENDING_FILENAME = "lark-pending.md"
-CONFIG_FILENAME = "lark-config.json"
-NON_TEXT_PLACEHOLDER = "(非文本消息)"
-
-
-def _ts():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-
-def _load_config(workspace_dir):
-    for d in (workspace_dir, os.getcwd(), os.path.dirname(os.path.abspath(__file__))):
-        path = os.path.join(d, CONFIG_FILENAME)
-        if os.path.isfile(path):
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                if isinstance(data, dict):
-                    return data
-            except Exception:
-                pass
-    return {}
+from lark_common import _ts, resolve_credentials
+from lark_config import get_config
+from lark_engine import ListenerEngine
+from lark_queue import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS
+from lark_scheduler import DEFAULT_COOLDOWN, DEFAULT_DEBOUNCE, AgentScheduler
+from lark_store import DEFAULT_COMPACT_BYTES
+from lark_workers import DEFAULT_AGENT_TIMEOUT, DEFAULT_BATCH, AgentWorkerPool
 
 
-def _domain_host(domain_key):
-    return "https://open.larksuite.com" if domain_key in ("lark", "larksuite") else "https://open.feishu.cn"
+def _spawn_headless_agent(workspace: str, task_file: str = "agent-tasks/lark-pending.md", replies_file: str = "agent-tasks/replies.jsonl"):
+    """启动无头 Cursor Agent 处理飞书待办，返回 Popen（失败返回 None）
 
-
-def send_reply(message_id: str, content: str, app_id: str, app_secret: str, domain_key: str, workspace: str) -> bool:
-    host = _domain_host(domain_key)
-    url = f"{host}/open-apis/auth/v3/tenant_access_token/internal"
-    r = requests.post(url, json={"app_id": app_id, "app_secret": app_secret}, timeout=10)
-    r.raise_for_status()
-    token = r.json()["tenant_access_token"]
-    reply_url = f"{host}/open-apis/im/v1/messages/{message_id}/reply"
-    body = {"content": json.dumps({"text": content}, ensure_ascii=False), "msg_type": "text"}
-    r = requests.post(reply_url, json=body, headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"}, timeout=10)
-    r.raise_for_status()
-    return r.json().get("code") == 0
-
-
-def _spawn_headless_agent(workspace: str):
-    """启动无头 Cursor Agent 处理飞书待办"""
+    task_file / replies_file 相对 workspace；supervisor 模式下每个 worker 传入自己的任务文件，只含分给它的消息。
+    """
     local = os.environ.get("LOCALAPPDATA", "")
     agent_path = os.path.join(local, "cursor-agent", "agent.cmd") if local else ""
     if not (agent_path and os.path.isfile(agent_path)):
         agent_path = "agent"
+    task_file = task_file.replace(os.sep, "/")
+    replies_file = replies_file.replace(os.sep, "/")
     prompt = (
-        "Read agent-tasks/lark-pending.md. For each block WITHOUT **[已回复]**, extract message_id and user text (after 用户消息：). "
-        "For each: 1) Generate reply. 2) Write reply to agent-tasks/reply-temp.txt (UTF-8). 3) Run: python .cursor/skills/lark-listener/scripts/lark_reply.py <message_id> --file agent-tasks/reply-temp.txt --mark-done --workspace . "
-        "Use --file to avoid Windows cmd encoding issues. Process all pending."
+        f"Read {task_file}. For each block WITHOUT **[已回复]**, extract message_id and user text (after 用户消息：). "
+        f"For each: generate the reply and append one JSON line {{\"message_id\": ..., \"text\": ...}} to {replies_file} (UTF-8). "
+        f"When all are done, run once: python .cursor/skills/lark-listener/scripts/lark_reply.py --batch {replies_file} --mark-done --workspace . "
+        f"then delete {replies_file}. Use a file to avoid Windows cmd encoding issues. Process all pending."
     )
 
     if sys.platform == "win32":
@@ -80,7 +57,7 @@ def _spawn_headless_agent(workspace: str):
         cmd_str = f'{agent_path} -p {repr(prompt)} --workspace {repr(workspace)} --trust -f'
 
     try:
-        subprocess.Popen(
+        proc = subprocess.Popen(
             cmd_str,
             shell=True,
             cwd=workspace,
@@ -89,114 +66,74 @@ def _spawn_headless_agent(workspace: str):
             stderr=subprocess.DEVNULL,
             creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0) if sys.platform == "win32" else 0,
         )
-        print(f"[{_ts()}] 已启动无头 Agent")
+        print(f"[{_ts()}] 已启动无头 Agent pid={proc.pid}")
+        return proc
     except Exception as e:
         print(f"[{_ts()}] 启动 Agent 失败: {e}", file=sys.stderr)
+        return None
 
 
-def run_listener(app_id: str, app_secret: str, workspace_dir: str, ack: bool, domain_key: str, agent_on_new: bool = False):
-    import time
-    workspace = os.path.abspath(workspace_dir)
-    task_dir = os.path.join(workspace, "agent-tasks")
-    os.makedirs(task_dir, exist_ok=True)
-    pending_path = os.path.join(task_dir, LARK_PENDING_FILENAME)
-    domain = _domain_host(domain_key)
-    last_agent_spawn = 0
-    AGENT_SPAWN_COOLDOWN = 15
-
-    if not os.path.isfile(pending_path):
-        with open(pending_path, "w", encoding="utf-8") as f:
-            f.write("# 飞书待办\n\nAgent 读取本文件，对每条无 **[已回复]** 的块：处理 user_text → 运行 lark_reply.py message_id \"回复\" --mark-done --workspace 项目根\n\n")
-
-    def _noop(_d):
-        pass
+def _apply_agent_config(scheduler, cfg: dict, defaults: dict):
+    """lark-config.json 里的 Agent 调度项应用到调度器，没写的用 defaults（命令行参数）"""
 
-    def _get(obj, key, default=""):
-        if obj is None:
-            return default
-        return obj.get(key, default) if isinstance(obj, dict) else getattr(obj, key, default)
-
-    def handle_im_message(data):
+    def _num(key, cast):
+        if cfg.get(key) is None:
+            return defaults[key]
         try:
-            event = _get(data, "event") or getattr(data, "event", None)
-            if not event:
-                return
-            msg = _get(event, "message") or getattr(event, "message", None)
-            if not msg:
-                return
-            message_id = (_get(msg, "message_id") or "").strip()
-            chat_id = _get(msg, "chat_id", "")
-            msg_type = _get(msg, "message_type", "")
-            text = NON_TEXT_PLACEHOLDER
-            if message_id and msg_type == "text":
-                raw = _get(msg, "content") or "{}"
-                try:
-                    c = json.loads(raw) if isinstance(raw, str) else raw
-                    text = (_get(c, "text") or "").strip() if isinstance(c, dict) else str(raw)[:200]
-                except Exception:
-                    text = str(raw)[:200] if raw else NON_TEXT_PLACEHOLDER
-            elif message_id:
-                text = str(_get(msg, "content", ""))[:200] or NON_TEXT_PLACEHOLDER
-            if not message_id:
-                return
-
-            # 去重：同一 message_id 已存在则跳过（飞书可能重推事件）
-            try:
-                with open(pending_path, "r", encoding="utf-8") as f:
-                    if f"message_id: {message_id}" in f.read():
-                        print(f"[{_ts()}] 跳过重复 message_id={message_id}")
-                        return
-            except Exception:
-                pass
-
-            block = f"""
----
-message_id: {message_id}
-chat_id: {chat_id}
-**[{_ts()}]** 用户消息：
-{text}
-
----
-"""
-            with open(pending_path, "a", encoding="utf-8") as f:
-                f.write(block)
-            print(f"[{_ts()}] 收到消息 message_id={message_id} text={text[:40]}...")
-
-            if ack:
-                try:
-                    send_reply(message_id, "已收到，正在处理。", app_id, app_secret, domain_key, workspace)
-                except Exception as e:
-                    print(f"[{_ts()}] ack 失败: {e}", file=sys.stderr)
-
-            if agent_on_new:
-                nonlocal last_agent_spawn
-                now = time.time()
-                if now - last_agent_spawn >= AGENT_SPAWN_COOLDOWN:
-                    _spawn_headless_agent(workspace)
-                    last_agent_spawn = now
-                else:
-                    print(f"[{_ts()}] 冷却中，跳过启动 Agent（{int(AGENT_SPAWN_COOLDOWN - (now - last_agent_spawn))}s 后可再启动）")
-        except Exception as e:
-            print(f"[{_ts()}] handle_im_message: {e}", file=sys.stderr)
-
-    ev = (
-        lark.EventDispatcherHandler.builder("", "")
-        .register_p2_im_message_receive_v1(handle_im_message)
-        .register_p2_im_message_message_read_v1(_noop)
-        .register_p2_im_chat_access_event_bot_p2p_chat_entered_v1(_noop)
-        .build()
-    )
+            return cast(cfg[key])
+        except (TypeError, ValueError):
+            print(f"[{_ts()}] WARN: 配置项 {key}={cfg[key]!r} 无效，使用 {defaults[key]}", file=sys.stderr)
+            return defaults[key]
 
-    while True:
-        try:
-            client = lark.ws.Client(app_id, app_secret, event_handler=ev, domain=domain)
-            client.start()
-        except KeyboardInterrupt:
-            break
-        except Exception as e:
-            print(f"[{_ts()}] 连接失败: {e}，30s 后重试...", file=sys.stderr)
-            import time
-            time.sleep(30)
+    if isinstance(scheduler, AgentWorkerPool):
+        scheduler.batch = max(1, _num("agent_batch", int))
+    else:
+        scheduler.configure(_num("agent_debounce", float), _num("agent_cooldown", float))
+
+
+def run_listener(app_id: str, app_secret: str, workspace_dir: str, ack: bool, domain_key: str, agent_on_new: bool = False,
+                 workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE, stats_interval: float = 60.0,
+                 agent_debounce: float = DEFAULT_DEBOUNCE, agent_cooldown: float = DEFAULT_COOLDOWN,
+                 agent_workers: int = 0, agent_batch: int = DEFAULT_BATCH, compact_bytes: int = DEFAULT_COMPACT_BYTES,
+                 agent_timeout: float = DEFAULT_AGENT_TIMEOUT, metrics_port: int = 0, json_log: str = "", backfill: bool = True,
+                 backfill_chats=(), config=None, credentials=None):
+    engine = ListenerEngine(
+        app_id, app_secret, workspace_dir, domain_key, ack=ack, workers=workers, queue_size=queue_size,
+        stats_interval=stats_interval, compact_bytes=compact_bytes, name="lark-agent",
+        metrics_port=metrics_port, json_log=json_log, backfill=backfill, backfill_chats=backfill_chats,
+    )
+    workspace, store = engine.workspace, engine.store
+    scheduler = None
+    if agent_workers > 0:
+        # supervisor 模式：常驻 worker 各自认领消息，只把分到的块交给 Agent
+        scheduler = AgentWorkerPool(
+            store,
+            lambda task_file, replies_file: _spawn_headless_agent(workspace, task_file, replies_file),
+            size=agent_workers,
+            batch=agent_batch,
+            agent_timeout=agent_timeout,
+        )
+    elif agent_on_new:
+        scheduler = AgentScheduler(
+            lambda: _spawn_headless_agent(workspace),
+            has_pending=lambda: store.count_unreplied() > 0,
+            pending_count=store.count_unreplied,
+            debounce=agent_debounce,
+            cooldown=agent_cooldown,
+        )
+        # 启动时已有未回复消息（例如上次 Agent 中途退出），也调度一次
+        if store.count_unreplied() > 0:
+            scheduler.notify()
+    if scheduler:
+        engine.on_new(lambda _item: scheduler.notify())
+    if config is not None:
+        engine.watch_config(config, credentials)
+        if scheduler:
+            defaults = {"agent_debounce": agent_debounce, "agent_cooldown": agent_cooldown, "agent_batch": agent_batch}
+            # 先注册回调再应用当前配置：两者之间的修改要么已在 data 里，要么会触发回调
+            config.on_change(lambda _changed, c: _apply_agent_config(scheduler, c.data, defaults))
+            _apply_agent_config(scheduler, config.data, defaults)
+    engine.run()
 
 
 def main():
@@ -206,19 +143,40 @@ def main():
     parser.add_argument("--app-secret", default="")
     parser.add_argument("--ack", action="store_true", help="Reply 'received' on new message")
     parser.add_argument("--agent-on-new", action="store_true", help="Start headless Agent when new message arrives")
+    parser.add_argument("--agent-debounce", type=float, default=DEFAULT_DEBOUNCE, help="Coalesce messages within this many seconds into one Agent run")
+    parser.add_argument("--agent-cooldown", type=float, default=DEFAULT_COOLDOWN, help="Min seconds between Agent starts (later messages get a trailing run)")
+    parser.add_argument("--agent-workers", type=int, default=0, help="Supervisor mode: keep N Agent workers, each handed only its claimed messages (0 = off)")
+    parser.add_argument("--agent-batch", type=int, default=DEFAULT_BATCH, help="Max messages handed to one Agent worker run")
+    parser.add_argument("--agent-timeout", type=float, default=DEFAULT_AGENT_TIMEOUT, help="Kill an Agent worker run after this many seconds and retry its messages (0 = no limit)")
+    parser.add_argument("--compact-bytes", type=int, default=DEFAULT_COMPACT_BYTES, help="Auto-archive replied blocks when lark-pending.md exceeds this many bytes (0 = off)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Background workers for persist/ack/agent trigger")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE, help="Max queued events; when full the callback waits up to 1s, then enqueues past the limit (per-chat order kept)")
+    parser.add_argument("--stats-interval", type=float, default=60.0, help="Seconds between queue depth/lag reports (0 = off)")
+    parser.add_argument("--metrics-port", type=int, default=0, help="Serve Prometheus metrics on 127.0.0.1:PORT/metrics (0 = off)")
+    parser.add_argument("--log-json", default="", help="Also write structured JSON log lines to this file (- = stdout)")
+    parser.add_argument("--no-backfill", action="store_true", help="Do not fetch messages missed while the listener was down")
+    parser.add_argument("--backfill-chats", default="", help="Extra chat_ids to backfill, comma separated (or backfill_chats in lark-config.json)")
     args = parser.parse_args()
 
-    cfg = _load_config(args.workspace)
-    app_id = args.app_id or os.environ.get("APP_ID") or cfg.get("app_id", "")
-    app_secret = args.app_secret or os.environ.get("APP_SECRET") or cfg.get("app_secret", "")
-    domain_key = (cfg.get("domain") or "feishu").lower()
+    config = get_config(args.workspace)
+    app_id, app_secret, domain_key = resolve_credentials(args, config.data)
+    # lark-config.json 的 backfill_chats 由 engine.watch_config 合并进来（可热更新）
+    backfill_chats = [c.strip() for c in args.backfill_chats.split(",") if c.strip()]
 
     if not app_id or not app_secret:
         print("请配置 app_id、app_secret（lark-config.json）", file=sys.stderr)
         sys.exit(1)
 
-    print(f"[{_ts()}] 飞书监听启动，workspace={args.workspace}" + (" [无头Agent已开启]" if args.agent_on_new else ""))
-    run_listener(app_id, app_secret, args.workspace, args.ack, domain_key, agent_on_new=args.agent_on_new)
+    mode = f" [Agent worker 池 x{args.agent_workers}]" if args.agent_workers > 0 else (" [无头Agent已开启]" if args.agent_on_new else "")
+    print(f"[{_ts()}] 飞书监听启动，workspace={args.workspace}" + mode)
+    run_listener(
+        app_id, app_secret, args.workspace, args.ack, domain_key, agent_on_new=args.agent_on_new,
+        workers=args.workers, queue_size=args.queue_size, stats_interval=args.stats_interval,
+        agent_debounce=args.agent_debounce, agent_cooldown=args.agent_cooldown,
+        agent_workers=args.agent_workers, agent_batch=args.agent_batch, compact_bytes=args.compact_bytes,
+        agent_timeout=args.agent_timeout, metrics_port=args.metrics_port, json_log=args.log_json, backfill=not args.no_backfill, backfill_chats=backfill_chats,
+        config=config, credentials=lambda cfg: resolve_credentials(args, cfg),
+    )
 
 
 if __name__ == "__main__":
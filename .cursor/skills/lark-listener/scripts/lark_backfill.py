@@ -0,0 +1,199 @@
+"""
+补拉历史消息：监听没在线（停机、重启、断线重连）期间的消息，用「获取会话历史消息」接口拉回来，交给 ListenerEngine 走正常流水线。
+
+- GET /open-apis/im/v1/messages?container_id_type=chat&container_id=<chat_id>&start_time=<秒>，按创建时间升序分页
+- 并发有上限：先对所有会话并发拉第一页；还有下一页的会话把剩余时间段切成若干片，各片再并发翻页（页码只能顺序翻，切片才能并行）
+- 全部拉完后按 message_id 合并，一次查库批量判重（PendingStore.existing_ids）并排除内存去重缓存里的，只把新消息按创建时间顺序交给
+  engine.handle_event；跳过机器人自己发出的消息（ack、回复）和已撤回的消息
+- 补拉哪些会话：lark-config.json 的 backfill_chats / --backfill-chats，加上库里收到过消息的会话（PendingStore.known_chats）
+- 起点：默认为库里最后一条消息的收录时间（再往前 CATCH_UP_MARGIN 秒），最多回溯 MAX_LOOKBACK；库为空时回溯 EMPTY_LOOKBACK
+- 监听启动时在后台补拉一次（--no-backfill 关闭），长连接重连后补拉断线期间的（lark_ws.py）；也可单独运行本脚本
+
+用法:
+  from lark_backfill import backfill
+  backfill(engine, since=time.time() - 600)
+
+  python lark_backfill.py --workspace D:\\proj                       # 从最后一条消息起补拉，写入 lark-pending.md
+  python lark_backfill.py --workspace D:\\proj --hours 6 --chats oc_xxx,oc_yyy --concurrency 16
+"""
+
+import argparse
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lark_common import _ts, resolve_credentials
+from lark_config import load_config
+from lark_metrics import counter, histogram
+from lark_sender import SendError
+
+PAGE_SIZE = 50
+MAX_CHATS = 200
+DEFAULT_CONCURRENCY = 8
+# 一个会话的剩余时间段最多切几片、每片至少多长
+MAX_SLICES = 8
+MIN_SLICE_SECONDS = 300
+# 起点再往前多拉几秒：覆盖两端时钟误差和断线前正在投递的消息，多拉的由去重挡掉
+CATCH_UP_MARGIN = 5.0
+MAX_LOOKBACK = 24 * 3600
+EMPTY_LOOKBACK = 3600
+
+BACKFILL_PAGES = counter("lark_backfill_pages_total", "补拉时请求的历史消息页数")
+BACKFILL_FETCHED = counter("lark_backfill_fetched_total", "补拉接口返回的用户消息条数")
+BACKFILL_SUBMITTED = counter("lark_backfill_submitted_total", "补拉后判定为新消息、交给流水线的条数")
+BACKFILL_SECONDS = histogram("lark_backfill_seconds", "一次补拉（拉取 + 判重 + 提交）的耗时")
+
+
+def _fetch_page(sender, chat_id: str, start_time: float, end_time: float, page_token: str = "", page_size: int = PAGE_SIZE) -> dict:
+    params = {
+        "container_id_type": "chat",
+        "container_id": chat_id,
+        "start_time": str(int(start_time)),
+        "end_time": str(math.ceil(end_time)),
+        "sort_type": "ByCreateTimeAsc",
+        "page_size": page_size,
+        "page_token": page_token,
+    }
+    data = sender.request("GET", "/open-apis/im/v1/messages", params=params, kind="history").get("data") or {}
+    BACKFILL_PAGES.inc()
+    return data
+
+
+def list_messages(sender, chat_id: str, start_time: float, end_time: float, page_size: int = PAGE_SIZE) -> list:
+    """会话 chat_id 在 [start_time, end_time]（秒）内的全部消息（接口原始 item），按创建时间升序"""
+    items, token = [], ""
+    while True:
+        data = _fetch_page(sender, chat_id, start_time, end_time, token, page_size)
+        items += data.get("items") or []
+        token = data.get("page_token") or ""
+        if not data.get("has_more") or not token:
+            return items
+
+
+def message_to_event(item: dict):
+    """接口返回的消息 → im.message.receive_v1 事件结构；机器人自己发的、已撤回的返回 None"""
+    if (item.get("sender") or {}).get("sender_type") == "app" or item.get("deleted"):
+        return None
+    return {
+        "schema": "2.0",
+        "header": {"event_id": "", "event_type": "im.message.receive_v1", "create_time": item.get("create_time", "")},
+        "event": {
+            "sender": item.get("sender") or {},
+            "message": {
+                "message_id": item.get("message_id", ""),
+                "chat_id": item.get("chat_id", ""),
+                "message_type": item.get("msg_type", ""),
+                "content": (item.get("body") or {}).get("content", ""),
+            },
+        },
+    }
+
+
+def _slices(start: float, end: float) -> list:
+    n = max(1, min(MAX_SLICES, int((end - start) // MIN_SLICE_SECONDS)))
+    step = (end - start) / n
+    return [(start + i * step, start + (i + 1) * step) for i in range(n)]
+
+
+def fetch_chats(sender, chat_ids, start: float, end: float, concurrency: int = DEFAULT_CONCURRENCY) -> dict:
+    """并发拉取多个会话在 [start, end] 内的消息，返回 {message_id: item}；单个会话失败只打印，不影响其他会话"""
+    found = {}
+
+    def _first(chat_id):
+        try:
+            return chat_id, _fetch_page(sender, chat_id, start, end)
+        except SendError as e:
+            # 机器人已被移出会话等：跳过这个会话
+            print(f"[{_ts()}] 补拉 chat_id={chat_id} 失败: {e}", file=sys.stderr)
+            return chat_id, {}
+
+    def _slice(task):
+        chat_id, s, e = task
+        try:
+            return list_messages(sender, chat_id, s, e)
+        except SendError as err:
+            print(f"[{_ts()}] 补拉 chat_id={chat_id} 失败: {err}", file=sys.stderr)
+            return []
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="lark-backfill") as pool:
+        more = []
+        for chat_id, data in pool.map(_first, chat_ids):
+            items = data.get("items") or []
+            found.update((m.get("message_id"), m) for m in items)
+            if data.get("has_more") and items:
+                # 第一页之后的部分切片并行翻页；切片边界的同一秒会重复拉到，按 message_id 合并
+                resume = int(items[-1].get("create_time") or 0) / 1000 or start
+                more += [(chat_id, s, e) for s, e in _slices(resume, end)]
+        for items in pool.map(_slice, more):
+            found.update((m.get("message_id"), m) for m in items)
+    found.pop(None, None)
+    return found
+
+
+def default_since(store, lookback: float = MAX_LOOKBACK) -> float:
+    """补拉起点：最后一条消息的收录时间，最多回溯 lookback 秒；库为空时回溯 EMPTY_LOOKBACK 秒"""
+    now = time.time()
+    last = store.last_received_ts()
+    if last is None:
+        return now - min(EMPTY_LOOKBACK, lookback)
+    return max(last, now - lookback)
+
+
+def backfill(engine, since: float, chat_ids=(), until: float = None, concurrency: int = DEFAULT_CONCURRENCY,
+             margin: float = CATCH_UP_MARGIN) -> dict:
+    """补拉 chat_ids 与库里已知会话自 since（time.time() 时间戳）起的消息，新消息交给 engine.handle_event
+
+    返回 {"chats", "fetched", "submitted", "seconds"}。
+    """
+    t0 = time.monotonic()
+    chats = list(dict.fromkeys([c for c in chat_ids if c] + engine.store.known_chats(MAX_CHATS)))
+    result = {"chats": len(chats), "fetched": 0, "submitted": 0, "seconds": 0.0}
+    if chats:
+        found = fetch_chats(engine.sender, chats, since - margin, until or time.time(), concurrency)
+        events = {mid: ev for mid, ev in ((mid, message_to_event(m)) for mid, m in found.items()) if ev is not None}
+        result["fetched"] = len(events)
+        BACKFILL_FETCHED.inc(len(events))
+        existing = engine.store.existing_ids(events)
+        new = [mid for mid in events if mid not in existing and mid not in engine.dedup]
+        new.sort(key=lambda mid: (int(found[mid].get("create_time") or 0), mid))
+        for mid in new:
+            # 积压很多时等队列空位，而不是挤占实时消息去同步处理
+            engine.handle_event(events[mid], block=True)
+        result["submitted"] = len(new)
+        BACKFILL_SUBMITTED.inc(len(new))
+    elapsed = time.monotonic() - t0
+    BACKFILL_SECONDS.observe(elapsed)
+    result["seconds"] = round(elapsed, 3)
+    print(f"[{_ts()}] 补拉完成：{result['chats']} 个会话，拉到 {result['fetched']} 条，"
+          f"新消息 {result['submitted']} 条，耗时 {elapsed:.2f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="补拉监听离线期间的飞书消息，写入 lark-pending.md")
+    parser.add_argument("--workspace", default=os.getcwd(), help="项目根目录")
+    parser.add_argument("--app-id", default="", help="App ID（优先配置文件）")
+    parser.add_argument("--app-secret", default="", help="App Secret（优先配置文件）")
+    parser.add_argument("--chats", default="", help="额外补拉的 chat_id，逗号分隔（默认 lark-config.json 的 backfill_chats + 库里已知会话）")
+    parser.add_argument("--hours", type=float, default=0, help="从 N 小时前补拉（默认从库里最后一条消息起，最多 24 小时）")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="并发请求数")
+    args = parser.parse_args()
+
+    from lark_engine import ListenerEngine
+
+    cfg = load_config(args.workspace)
+    app_id, app_secret, domain_key = resolve_credentials(args, cfg)
+    if not app_id or not app_secret:
+        print("请配置 app_id 与 app_secret（lark-config.json 或环境变量 APP_ID/APP_SECRET）", file=sys.stderr)
+        sys.exit(1)
+    chats = [c.strip() for c in args.chats.split(",") if c.strip()] + list(cfg.get("backfill_chats") or [])
+    engine = ListenerEngine(app_id, app_secret, args.workspace, domain_key, stats_interval=0, name="lark-backfill")
+    since = time.time() - args.hours * 3600 if args.hours > 0 else default_since(engine.store)
+    backfill(engine, since, chats, concurrency=args.concurrency)
+    engine.queue.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+监听流水线端到端压测：本地 mock 飞书 + ListenerEngine，回放大量合成消息。
+
+流程：启动 MockFeishuServer → 在临时 workspace 建 ListenerEngine（ack 指向 mock）→ 按 --rate 注入事件（含一定比例重推）
+→ 模拟 Agent：--reply-concurrency 个线程在消息落盘后立即取走，用 lark_reply.reply_batch 回复并标记已回复（与注入同时进行）
+→ 等队列排空、全部回复完。
+
+输出：注入速率与处理吞吐（events/s）、入口→落盘、入口→ack 到达 mock、入口→回复到达 mock 的 p50/p99 延迟、回复吞吐、
+lark-pending.md / .db 增长（总字节与每条字节）。--json 输出机器可读结果，便于对比回归。
+入口→回复不含真实 Agent 生成回复的耗时，衡量的是监听 + 发送链路本身（排队、限流、落盘、标记已回复）。
+
+用法:
+  python lark_bench.py                                   # 默认 1000 条、50 个会话、ack 开启、按飞书配额限流
+  python lark_bench.py --messages 5000 --chats 200 --send-rate 0 --chat-rate 0   # 不限流，只看本地流水线
+  python lark_bench.py --latency 0.05 --rate-limit-ratio 0.02 --json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from lark_engine import ListenerEngine
+from lark_mock import MockFeishuServer, make_event
+from lark_queue import DEFAULT_WORKERS
+from lark_sender import DEFAULT_CHAT_RATE, DEFAULT_RATE, TokenBucket
+
+
+REPLY_PREFIX = "回复 "
+# 模拟 Agent 一次最多取走的消息条数（与 lark_reply.py --batch 一样整批发送、整批标记）
+AGENT_BATCH = 20
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+
+def _size(path: str) -> int:
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def run_bench(messages: int = 1000, chats: int = 50, dup_ratio: float = 0.05, rate: float = 0, workers: int = DEFAULT_WORKERS,
+              ack: bool = True, latency: float = 0.0, rate_limit_ratio: float = 0.0, send_rate: float = DEFAULT_RATE,
+              chat_rate: float = DEFAULT_CHAT_RATE, reply_concurrency: int = 8, workspace: str = None) -> dict:
+    from lark_reply import reply_batch
+
+    own_dir = workspace is None
+    workspace = workspace or tempfile.mkdtemp(prefix="lark-bench-")
+    mock = MockFeishuServer(latency=latency, rate_limit_ratio=rate_limit_ratio).start()
+    # 引擎逐条打印收到/跳过的日志，压测时吞掉 stdout（错误仍走 stderr）
+    quiet = contextlib.redirect_stdout(io.StringIO())
+    quiet.__enter__()
+    try:
+        engine = ListenerEngine("cli_bench", "secret", workspace, domain_key=mock.url, ack=ack, workers=workers,
+                                queue_size=max(1000, messages), stats_interval=0, compact_bytes=0, name="bench")
+        engine.sender.limiter = TokenBucket(send_rate)
+        engine.sender.chat_rate = chat_rate
+        md0, db0 = _size(engine.store.md_path), _size(engine.store.db_path)
+
+        ingest_at = {}
+        persist_lat = []
+
+        def _bench_stage(item):
+            persist_lat.append(time.monotonic() - ingest_at[item["message_id"]])
+            return True
+
+        engine.add_stage("bench", _bench_stage, before="ack" if ack else "dispatch")
+
+        # 模拟 Agent：新消息落盘后进入 inbox，replier 线程取走一批就回复并标记已回复
+        inbox = queue.Queue()
+        reply_results = []
+        results_lock = threading.Lock()
+        engine.on_new(lambda item: inbox.put(item["message_id"]))
+
+        def _replier():
+            while True:
+                mid = inbox.get()
+                if mid is None:
+                    inbox.task_done()
+                    return
+                batch = [mid]
+                while len(batch) < AGENT_BATCH:
+                    try:
+                        nxt = inbox.get_nowait()
+                    except queue.Empty:
+                        break
+                    if nxt is None:
+                        inbox.put(None)
+                        inbox.task_done()
+                        break
+                    batch.append(nxt)
+                try:
+                    res = reply_batch([{"message_id": m, "text": REPLY_PREFIX + m} for m in batch], "cli_bench", "secret",
+                                      domain_key=mock.url, workspace=workspace, mark_done=True, concurrency=1)
+                except Exception as e:
+                    res = [{"message_id": m, "ok": False, "error": str(e)} for m in batch]
+                with results_lock:
+                    reply_results.extend(res)
+                for _ in batch:
+                    inbox.task_done()
+
+        repliers = [threading.Thread(target=_replier, name=f"bench-agent-{i}", daemon=True)
+                    for i in range(max(1, reply_concurrency))]
+        for t in repliers:
+            t.start()
+
+        # 合成事件：message_id 唯一，按轮转分配到各会话；dup_ratio 比例的事件是对已发消息的重推
+        events = []
+        dup_every = max(1, round(1 / dup_ratio)) if dup_ratio > 0 else 0
+        for i in range(messages):
+            events.append(make_event(f"om_bench_{i}", f"oc_chat_{i % chats}", f"压测消息 {i} " + "内容" * 20))
+            if dup_every and i and i % dup_every == 0:
+                j = i // 2
+                events.append(make_event(f"om_bench_{j}", f"oc_chat_{j % chats}", "重推", event_id=f"ev_om_bench_{j}"))
+
+        t0 = time.monotonic()
+        for n, ev in enumerate(events):
+            if rate > 0:
+                delay = t0 + n / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            mid = ev["event"]["message"]["message_id"]
+            ingest_at.setdefault(mid, time.monotonic())
+            engine.handle_event(ev)
+        t_ingested = time.monotonic()
+        engine.queue.join()
+        t_drained = time.monotonic()
+        md1, db1 = _size(engine.store.md_path), _size(engine.store.db_path)
+        inbox.join()
+        t_replied = time.monotonic()
+        for _ in repliers:
+            inbox.put(None)
+        for t in repliers:
+            t.join(timeout=5)
+
+        # 同一条消息可能先收到 ack，回复按正文前缀区分
+        with mock._lock:
+            arrivals = list(mock.replies)
+        ack_at, answer_at = {}, {}
+        for at, mid, text in arrivals:
+            (answer_at if text.startswith(REPLY_PREFIX) else ack_at).setdefault(mid, at)
+        ack_lat = [ack_at[mid] - t for mid, t in ingest_at.items() if mid in ack_at]
+        reply_lat = [answer_at[mid] - t for mid, t in ingest_at.items() if mid in answer_at]
+        counts = engine.store.stats()
+        stored = counts["live"] + counts["archived"]
+        reply_ok = sum(1 for r in reply_results if r["ok"])
+
+        result = {
+            "config": {
+                "messages": messages, "chats": chats, "events": len(events), "dup_ratio": dup_ratio, "rate": rate,
+                "workers": workers, "ack": ack, "latency": latency, "rate_limit_ratio": rate_limit_ratio,
+                "send_rate": send_rate, "chat_rate": chat_rate,
+            },
+            "ingest": {
+                "events_per_s": round(len(events) / max(t_ingested - t0, 1e-9), 1),
+                "processed_per_s": round(messages / max(t_drained - t0, 1e-9), 1),
+                "drain_s": round(t_drained - t0, 3),
+                "stored": stored,
+                "dedup_hits": engine.dedup.hits,
+            },
+            "ingest_to_persist_ms": {"p50": _ms(percentile(persist_lat, 50)), "p99": _ms(percentile(persist_lat, 99)),
+                                     "max": _ms(max(persist_lat, default=0))},
+            "ingest_to_ack_ms": {"p50": _ms(percentile(ack_lat, 50)), "p99": _ms(percentile(ack_lat, 99)),
+                                 "max": _ms(max(ack_lat, default=0)), "count": len(ack_lat)},
+            "ingest_to_reply_ms": {"p50": _ms(percentile(reply_lat, 50)), "p99": _ms(percentile(reply_lat, 99)),
+                                   "max": _ms(max(reply_lat, default=0)), "count": len(reply_lat)},
+            "reply": {
+                "ok": reply_ok,
+                "per_s": round(reply_ok / max(t_replied - t0, 1e-9), 1),
+                "duration_s": round(t_replied - t0, 3),
+                "unreplied_after": engine.store.count_unreplied(),
+            },
+            "pending_growth": {
+                "md_bytes": md1 - md0,
+                "db_bytes": db1 - db0,
+                "md_bytes_per_msg": round((md1 - md0) / max(stored, 1), 1),
+                "md_bytes_after_reply": _size(engine.store.md_path),
+            },
+            "stages": engine.timings.snapshot(),
+            "sender": dict(engine.sender.stats),
+            "mock": dict(mock.stats),
+        }
+        engine.queue.stop()
+        engine.store.close()
+        return result
+    finally:
+        quiet.__exit__(None, None, None)
+        mock.stop()
+        if own_dir:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+
+def _print_report(r: dict):
+    c, i, rp = r["config"], r["ingest"], r["reply"]
+    print(f"消息 {c['messages']} 条 / {c['chats']} 个会话 / 事件 {c['events']}（含重推），workers={c['workers']} ack={c['ack']}")
+    print(f"注入 {i['events_per_s']} events/s，处理 {i['processed_per_s']} msg/s，排空 {i['drain_s']}s，入库 {i['stored']}，去重命中 {i['dedup_hits']}")
+    p, a = r["ingest_to_persist_ms"], r["ingest_to_ack_ms"]
+    print(f"入口→落盘  p50={p['p50']}ms p99={p['p99']}ms max={p['max']}ms")
+    if c["ack"]:
+        print(f"入口→ack   p50={a['p50']}ms p99={a['p99']}ms max={a['max']}ms（{a['count']} 条）")
+    rl = r["ingest_to_reply_ms"]
+    print(f"入口→回复  p50={rl['p50']}ms p99={rl['p99']}ms max={rl['max']}ms（{rl['count']} 条，不含 Agent 生成回复的时间）")
+    print(f"回复 {rp['ok']} 条，{rp['per_s']}/s，注入开始到全部回复 {rp['duration_s']}s，剩余未回复 {rp['unreplied_after']}")
+    g = r["pending_growth"]
+    print(f"lark-pending.md +{g['md_bytes']}B（{g['md_bytes_per_msg']}B/条），库 +{g['db_bytes']}B，回复后 md {g['md_bytes_after_reply']}B")
+    print("阶段耗时(avg/max): " + " ".join(f"{k}={v['avg_ms']}/{v['max_ms']}ms" for k, v in r["stages"].items()))
+    print(f"发送: {r['sender']}  mock: {r['mock']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="监听流水线端到端压测（本地 mock 飞书）")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--dup-ratio", type=float, default=0.05, help="重推事件占比")
+    parser.add_argument("--rate", type=float, default=0, help="注入速率 events/s（0 为尽快）")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--no-ack", action="store_true", help="不发 ack，只测落盘")
+    parser.add_argument("--latency", type=float, default=0.0, help="mock 每个请求的延迟秒数")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="mock 返回 429 的比例")
+    parser.add_argument("--send-rate", type=float, default=DEFAULT_RATE, help="发送全局限流 次/秒（0 不限）")
+    parser.add_argument("--chat-rate", type=float, default=DEFAULT_CHAT_RATE, help="发送单会话限流 次/秒（0 不限）")
+    parser.add_argument("--reply-concurrency", type=int, default=8, help="模拟 Agent 的并发回复线程数")
+    parser.add_argument("--workspace", default=None, help="保留结果的目录（默认临时目录，结束后删除）")
+    parser.add_argument("--json", action="store_true", help="输出 JSON")
+    args = parser.parse_args()
+
+    r = run_bench(
+        messages=args.messages, chats=args.chats, dup_ratio=args.dup_ratio, rate=args.rate, workers=args.workers,
+        ack=not args.no_ack, latency=args.latency, rate_limit_ratio=args.rate_limit_ratio, send_rate=args.send_rate,
+        chat_rate=args.chat_rate, reply_concurrency=args.reply_concurrency, workspace=args.workspace,
+    )
+    if args.json:
+        print(json.dumps(r, ensure_ascii=False, indent=2))
+    else:
+        _print_report(r)
+    sys.exit(0 if r["reply"]["unreplied_after"] == 0 and r["ingest"]["stored"] == args.messages else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""
+lark_agent.py / lark_listener.py / lark_reply.py 共用的小工具：域名、凭据解析、事件字段读取（配置读取见 lark_config.py）。
+"""
+
+import os
+from datetime import datetime
+
+CONFIG_FILENAME = "lark-config.json"
+NON_TEXT_PLACEHOLDER = "(非文本消息)"
+ACK_TEXT = "已收到，正在处理。"
+
+
+def _ts():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def domain_host(domain_key):
+    """feishu / lark 映射到开放平台域名；也可直接给完整地址（如本地 mock：http://127.0.0.1:18080）"""
+    if domain_key and domain_key.startswith(("http://", "https://")):
+        return domain_key.rstrip("/")
+    return "https://open.larksuite.com" if domain_key in ("lark", "larksuite") else "https://open.feishu.cn"
+
+
+def get_field(obj, key, default=""):
+    """从 dict 或对象取属性，兼容 lark_oapi 传入的事件对象"""
+    if obj is None:
+        return default
+    return obj.get(key, default) if isinstance(obj, dict) else getattr(obj, key, default)
+
+
+def resolve_credentials(args, cfg):
+    """命令行 > 环境变量 > 配置文件"""
+    app_id = getattr(args, "app_id", "") or os.environ.get("APP_ID") or cfg.get("app_id", "")
+    app_secret = getattr(args, "app_secret", "") or os.environ.get("APP_SECRET") or cfg.get("app_secret", "")
+    domain_key = (cfg.get("domain") or "feishu").lower()
+    return app_id, app_secret, domain_key
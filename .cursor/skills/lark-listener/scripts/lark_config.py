@@ -0,0 +1,151 @@
+"""
+lark-config.json 的读取与热更新：各脚本共用一份解析结果，常驻监听改配置不用重启。
+
+- 配置文件路径只查找一次：依次在 workspace、当前目录、脚本目录查找，都没有时认 workspace 下的（之后创建也能读到）
+- 解析结果按文件 mtime + 大小缓存，load_config() 只 stat 一次、文件没变就不再读盘解析
+- 只有 check() / reload()（以及 load_config()）会检查文件；.data / .get() 只读缓存，不会吞掉尚未通知回调的变更
+- 解析失败（JSON 错误、顶层不是对象）明确告警并保留上一次的有效配置，不会退化成空配置
+- watch() 启动后台线程每 RELOAD_INTERVAL 秒检查一次，有变化时调用 on_change 注册的回调 callback(changed, config)，
+  changed 为 {键: 新值}（删除的键值为 None）；监听据此调整 ack 文案、限流、并发、调度冷却等，长连接不断开（见 lark_engine.py）
+- 可热更新的调优项见 TUNABLE_KEYS；app_id / app_secret / domain 变化时监听换用新凭据并重连长连接
+
+用法:
+  from lark_config import get_config, load_config
+  cfg = load_config(workspace)                       # dict
+  config = get_config(workspace)
+  config.on_change(lambda changed, c: print(changed))
+  config.watch()
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+from lark_common import CONFIG_FILENAME, _ts
+
+RELOAD_INTERVAL = 2.0
+# 可在运行中修改的调优项：ack 文案、后台线程数、发送限流（次/秒）、无头 Agent 调度、worker 池每批条数、补拉会话
+TUNABLE_KEYS = (
+    "ack_text", "workers", "send_rate", "chat_rate",
+    "agent_debounce", "agent_cooldown", "agent_batch", "backfill_chats",
+)
+
+_configs = {}
+_configs_lock = threading.Lock()
+
+
+def find_config(workspace_dir) -> str:
+    """依次在 workspace、当前目录、脚本目录查找 lark-config.json，都没有时返回 workspace 下的路径"""
+    workspace_dir = os.path.abspath(workspace_dir or os.getcwd())
+    for d in (workspace_dir, os.getcwd(), os.path.dirname(os.path.abspath(__file__))):
+        path = os.path.join(d, CONFIG_FILENAME)
+        if os.path.isfile(path):
+            return path
+    return os.path.join(workspace_dir, CONFIG_FILENAME)
+
+
+class Config:
+    def __init__(self, path: str):
+        self.path = path
+        self._data = {}
+        self._stamp = None  # (mtime_ns, size)，None 表示尚未读取或文件不存在
+        self._bad_stamp = None  # 最近一次解析失败的文件版本，同一版本只告警一次
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._thread = None
+        self.reload()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def reload(self) -> dict:
+        """文件有变化时重新解析，返回变化的键 {键: 新值}；没变化或解析失败返回 {}"""
+        stamp = self._stat()
+        with self._lock:
+            if stamp == self._stamp or (stamp is not None and stamp == self._bad_stamp):
+                return {}
+            if stamp is None:
+                data = {}
+            else:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    if not isinstance(data, dict):
+                        raise ValueError(f"顶层应为 JSON 对象，实际是 {type(data).__name__}")
+                except (OSError, ValueError) as e:
+                    self._bad_stamp = stamp
+                    kept = "，继续使用上一次的配置" if self._stamp is not None else ""
+                    print(f"[{_ts()}] WARN: 读取 {self.path} 失败: {e}{kept}", file=sys.stderr)
+                    return {}
+            changed = {k: data.get(k) for k in set(self._data) | set(data) if self._data.get(k) != data.get(k)}
+            self._data, self._stamp, self._bad_stamp = data, stamp, None
+            return changed
+
+    @property
+    def data(self) -> dict:
+        """当前配置的浅拷贝（只读缓存，不检查文件；检查并通知回调用 check()）"""
+        with self._lock:
+            return dict(self._data)
+
+    def get(self, key: str, default=None):
+        return self.data.get(key, default)
+
+    def on_change(self, callback):
+        """注册配置变化回调 callback(changed, config)；由 watch() 的后台线程调用"""
+        self._callbacks.append(callback)
+
+    def check(self) -> dict:
+        """检查一次文件，有变化时依次调用回调，返回变化的键"""
+        changed = self.reload()
+        if changed:
+            shown = sorted(k for k in changed if k != "app_secret") + (["app_secret"] if "app_secret" in changed else [])
+            print(f"[{_ts()}] 配置已更新: {', '.join(shown)}")
+            for cb in list(self._callbacks):
+                try:
+                    cb(changed, self)
+                except Exception as e:
+                    print(f"[{_ts()}] 应用配置变更失败: {e}", file=sys.stderr)
+        return changed
+
+    def watch(self, interval: float = RELOAD_INTERVAL):
+        """启动后台线程监视配置文件（只启动一次）；interval <= 0 时不启动"""
+        if interval <= 0:
+            return None
+        with self._lock:
+            if self._thread is not None:
+                return self._thread
+
+            def _loop():
+                while True:
+                    time.sleep(interval)
+                    self.check()
+
+            self._thread = threading.Thread(target=_loop, name="lark-config-watch", daemon=True)
+            self._thread.start()
+            return self._thread
+
+
+def get_config(workspace_dir) -> Config:
+    """按 workspace 返回进程内共享的 Config，配置文件路径只解析一次"""
+    key = os.path.abspath(workspace_dir or os.getcwd())
+    with _configs_lock:
+        config = _configs.get(key)
+        if config is None:
+            config = _configs[key] = Config(find_config(key))
+        return config
+
+
+def load_config(workspace_dir) -> dict:
+    """读取 lark-config.json（带缓存，文件没变化时不重新解析）；找不到时返回 {}
+
+    文件有变化时经 check() 重新解析，已注册的回调照常收到通知。
+    """
+    config = get_config(workspace_dir)
+    config.check()
+    return config.data
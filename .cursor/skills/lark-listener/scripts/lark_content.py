@@ -0,0 +1,135 @@
+"""
+消息内容解析：把飞书各类消息的 content JSON 转成给 Agent 读的纯文本，并列出其中的附件。
+
+- text：原文；post（富文本）：标题 + 各段落，链接、@、代码块、图片、视频按位置内联
+- image / file / audio / media：占位文本带上 key，如 [图片 key=img_xxx]、[文件 报告.pdf key=file_xxx]
+- interactive（卡片）：按出现顺序取出标题、正文、按钮等文字
+- 其他类型（名片、位置、合并转发等）给简短说明；解析不了的退回原始内容前 200 字
+- 附件只记录 key，不在这里下载；需要时由 lark_resource.py 按 message_id + key 拉取并缓存
+
+用法:
+  from lark_content import parse_content
+  text, resources = parse_content("post", raw_content)
+  # resources: [{"kind": "image" | "file", "key": "img_xxx", "name": ""}]
+"""
+
+import json
+
+from lark_common import NON_TEXT_PLACEHOLDER
+
+RAW_FALLBACK_CHARS = 200
+# 卡片 JSON 里除了文字还有大量配置字段，只取这些键下的字符串
+_CARD_TEXT_KEYS = ("title", "subtitle", "content", "text", "placeholder")
+_SIMPLE = {
+    "sticker": "[表情包]",
+    "merge_forward": "[合并转发的聊天记录]",
+    "system": "[系统消息]",
+    "hongbao": "[红包]",
+    "video_chat": "[视频会议]",
+}
+
+
+def _resource(resources: list, kind: str, key: str, name: str = "") -> str:
+    resources.append({"kind": kind, "key": key, "name": name})
+    return f"key={key}"
+
+
+def _post_element(el: dict, resources: list) -> str:
+    tag = el.get("tag")
+    if tag in ("text", "md"):
+        return el.get("text", "")
+    if tag == "a":
+        text, href = el.get("text", ""), el.get("href", "")
+        return f"{text}({href})" if text and href and text != href else (href or text)
+    if tag == "at":
+        return "@" + (el.get("user_name") or el.get("user_id") or "")
+    if tag == "img":
+        return f"[图片 {_resource(resources, 'image', el.get('image_key', ''))}]"
+    if tag == "media":
+        return f"[视频 {_resource(resources, 'file', el.get('file_key', ''), el.get('file_name', ''))}]"
+    if tag == "emotion":
+        return f"[{el.get('emoji_type', '表情')}]"
+    if tag == "code_block":
+        return f"```{el.get('language', '').lower()}\n{el.get('text', '').rstrip()}\n```"
+    if tag == "hr":
+        # 不能用 ---：lark-pending.md 用它分隔消息块
+        return "————————"
+    return el.get("text", "")
+
+
+def _post(c: dict, resources: list) -> str:
+    # 事件里是 {"title", "content"}，部分接口返回按语言包一层 {"zh_cn": {...}}
+    if "content" not in c:
+        c = next((v for v in c.values() if isinstance(v, dict) and "content" in v), {})
+    lines = [c["title"]] if c.get("title") else []
+    for para in c.get("content") or []:
+        lines.append("".join(_post_element(el, resources) for el in para if isinstance(el, dict)))
+    return "\n".join(lines).strip()
+
+
+def _card_texts(node, out: list, resources: list):
+    if isinstance(node, dict):
+        if node.get("tag") == "img" and node.get("img_key"):
+            out.append(f"[图片 {_resource(resources, 'image', node['img_key'])}]")
+        for k, v in node.items():
+            if isinstance(v, str) and k in _CARD_TEXT_KEYS and v.strip():
+                if not out or out[-1] != v.strip():
+                    out.append(v.strip())
+            elif isinstance(v, (dict, list)):
+                _card_texts(v, out, resources)
+    elif isinstance(node, list):
+        for v in node:
+            _card_texts(v, out, resources)
+
+
+def _card(c: dict, resources: list) -> str:
+    out = []
+    _card_texts(c, out, resources)
+    return "[卡片]\n" + "\n".join(out) if out else "[卡片]"
+
+
+def _render(msg_type: str, c: dict, resources: list) -> str:
+    if msg_type == "text":
+        return (c.get("text") or "").strip()
+    if msg_type == "post":
+        return _post(c, resources)
+    if msg_type == "image":
+        return f"[图片 {_resource(resources, 'image', c.get('image_key', ''))}]"
+    if msg_type == "file":
+        name = c.get("file_name", "")
+        return f"[文件 {name + ' ' if name else ''}{_resource(resources, 'file', c.get('file_key', ''), name)}]"
+    if msg_type == "audio":
+        seconds = round((c.get("duration") or 0) / 1000)
+        return f"[语音 {seconds}s {_resource(resources, 'file', c.get('file_key', ''))}]"
+    if msg_type == "media":
+        name = c.get("file_name", "")
+        return f"[视频 {name + ' ' if name else ''}{_resource(resources, 'file', c.get('file_key', ''), name)}]"
+    if msg_type == "interactive":
+        return _card(c, resources)
+    if msg_type == "share_chat":
+        return f"[群名片 chat_id={c.get('chat_id', '')}]"
+    if msg_type == "share_user":
+        return f"[个人名片 user_id={c.get('user_id', '')}]"
+    if msg_type == "location":
+        return f"[位置 {c.get('name', '')} {c.get('latitude', '')},{c.get('longitude', '')}]".replace("  ", " ")
+    if msg_type in _SIMPLE:
+        return _SIMPLE[msg_type]
+    return ""
+
+
+def parse_content(msg_type: str, raw) -> tuple:
+    """返回 (文本, 附件列表)；content 不是合法 JSON 时退回原始内容前 RAW_FALLBACK_CHARS 字"""
+    resources = []
+    try:
+        c = json.loads(raw) if isinstance(raw, str) else raw
+    except ValueError:
+        c = None
+    if not isinstance(c, dict):
+        return (str(raw)[:RAW_FALLBACK_CHARS] if raw else NON_TEXT_PLACEHOLDER), []
+    try:
+        text = _render(msg_type or "", c, resources)
+    except Exception:
+        text, resources = "", []
+    if not text and msg_type != "text":
+        text = str(raw)[:RAW_FALLBACK_CHARS] or NON_TEXT_PLACEHOLDER
+    return text, [r for r in resources if r["key"]]
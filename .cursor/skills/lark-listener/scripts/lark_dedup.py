@@ -0,0 +1,77 @@
+"""
+飞书事件重推去重：内存中保存最近的 message_id / event_id（LRU + TTL），O(1) 判重、无磁盘 I/O、内存有上限。
+
+启动时用 PendingStore.recent_message_ids() 预热，重启后也能挡住刚处理过的重推。
+库里的 message_id 唯一约束仍然是最终兜底。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_SIZE = 20000
+# 飞书重推一般在数小时内，超过 TTL 的记录交给库去重
+DEFAULT_TTL = 24 * 3600
+
+
+class DedupCache:
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, ttl: float = DEFAULT_TTL):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.hits = 0
+        self._items = OrderedDict()  # key -> 过期时间
+        self._lock = threading.Lock()
+
+    def seen(self, *keys) -> bool:
+        """任一 key 已存在且未过期则返回 True；否则把所有 key 记下并返回 False（检查与写入是原子的）"""
+        keys = [k for k in keys if k]
+        if not keys:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            for k in keys:
+                expire = self._items.get(k)
+                if expire is not None:
+                    if expire > now:
+                        self._items.move_to_end(k)
+                        self.hits += 1
+                        return True
+                    del self._items[k]
+            for k in keys:
+                self._put(k, now)
+        return False
+
+    def add(self, *keys):
+        now = time.monotonic()
+        with self._lock:
+            for k in keys:
+                if k:
+                    self._put(k, now)
+
+    def discard(self, *keys):
+        """处理失败时移除，让飞书重推能再进来"""
+        with self._lock:
+            for k in keys:
+                self._items.pop(k, None)
+
+    def warm(self, keys):
+        """预热：按从旧到新的顺序加入，超过容量时保留最新的"""
+        self.add(*keys)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            expire = self._items.get(key)
+            return expire is not None and expire > time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _put(self, key, now: float):
+        self._items[key] = now + self.ttl
+        self._items.move_to_end(key)
+        # 先淘汰过期的（最旧的在前），再按容量淘汰
+        while self._items:
+            oldest_key, oldest_expire = next(iter(self._items.items()))
+            if oldest_expire > now and len(self._items) <= self.max_size:
+                break
+            del self._items[oldest_key]
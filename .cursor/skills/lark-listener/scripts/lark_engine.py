@@ -0,0 +1,353 @@
+"""
+飞书监听引擎：lark_agent.py 与 lark_listener.py 共用的事件流水线。
+
+  parse → dedup → persist → ack → dispatch
+
+- parse、dedup 在长连接回调内完成（纯内存），之后的阶段交给按 chat_id 分片的 WorkQueue，回调立即返回
+- 阶段可插拔：add_stage() 追加/插入自定义阶段，on_new() 注册新消息到达后的分发回调
+- 每个阶段记录次数/平均/最大耗时，随队列统计定期打印，stats() 可直接读取
+- run() 由 lark_ws.WsSupervisor 维持长连接：亚秒级退避重连、心跳与卡死检测，重连后补拉断线期间的消息（lark_backfill.py）
+- backfill=True 时 run() 同时在后台补拉停机期间的消息（从库里最后一条起），补拉到的新消息与实时消息走同一条流水线
+- metrics_port > 0 时在 127.0.0.1:metrics_port/metrics 暴露 Prometheus 指标（lark_metrics.py），json_log 给出时写 JSON 行日志
+- watch_config() 后 lark-config.json 的调优项（ack_text、workers、send_rate、chat_rate、backfill_chats）改了立即生效，
+  不断开长连接；凭据或 domain 变化时换用新的发送器并重连（lark_config.py）
+
+用法:
+  from lark_engine import ListenerEngine
+  engine = ListenerEngine(app_id, app_secret, workspace, ack=True)
+  engine.on_new(lambda item: scheduler.notify())
+  engine.run()
+"""
+
+import os
+import sys
+import threading
+import time
+
+from lark_backfill import backfill, default_since
+from lark_common import ACK_TEXT, _ts, domain_host, get_field
+from lark_content import parse_content
+from lark_dedup import DedupCache
+from lark_metrics import configure_json_log, counter, gauge, histogram, log_event, start_metrics_logger, start_metrics_server
+from lark_queue import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS, SUBMIT_TIMEOUT, WorkQueue, start_stats_reporter
+from lark_sender import get_sender, start_outbox_flusher
+from lark_store import DEFAULT_COMPACT_BYTES, PendingStore
+from lark_ws import WsSupervisor
+
+OUTBOX_FLUSH_INTERVAL = 30.0
+
+EVENTS_RECEIVED = counter("lark_events_received_total", "收到的消息事件（含重推）")
+DUPLICATES = counter("lark_events_duplicate_total", "跳过的重复事件，layer=memory 内存去重 / store 库唯一约束")
+MESSAGES_STORED = counter("lark_messages_stored_total", "新写入待办的消息")
+STAGE_SECONDS = histogram("lark_stage_seconds", "流水线各阶段耗时")
+E2E_SECONDS = histogram("lark_ingest_to_done_seconds", "回调收到事件到后台阶段全部完成的耗时")
+ACK_SECONDS = histogram("lark_ack_seconds", "ack 回复耗时")
+ACK_FAILURES = counter("lark_ack_failures_total", "ack 发送失败")
+PENDING = gauge("lark_pending_backlog", "未回复的待办条数")
+QUEUE_DEPTH = gauge("lark_queue_depth", "事件队列中待处理的条数")
+
+
+def parse_event(data):
+    """从 im.message.receive_v1 事件中取出 message_id / chat_id / 文本 / 附件，无 message_id 返回 None"""
+    event = get_field(data, "event", None)
+    if not event:
+        return None
+    msg = get_field(event, "message", None)
+    if not msg:
+        return None
+    message_id = (get_field(msg, "message_id") or "").strip()
+    if not message_id:
+        return None
+    msg_type = get_field(msg, "message_type", "") or ""
+    # 富文本、卡片、图片/文件等转成给 Agent 读的文字；附件只记下 key，需要时再用 lark_resource.py 下载
+    text, resources = parse_content(msg_type, get_field(msg, "content") or "")
+    return {
+        "message_id": message_id,
+        "chat_id": get_field(msg, "chat_id", "") or "",
+        "msg_type": msg_type,
+        "text": text,
+        "resources": resources,
+        "event_id": get_field(get_field(data, "header", None), "event_id", "") or "",
+    }
+
+
+class StageTimings:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}  # name -> [count, total, max]
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            d = self._data.setdefault(name, [0, 0.0, 0.0])
+            d[0] += 1
+            d[1] += seconds
+            d[2] = max(d[2], seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                name: {"count": c, "avg_ms": round(total / c * 1000, 2) if c else 0.0, "max_ms": round(mx * 1000, 2)}
+                for name, (c, total, mx) in self._data.items()
+            }
+
+    def summary(self) -> str:
+        return " ".join(f"{name}={s['avg_ms']}ms/{s['max_ms']}ms" for name, s in self.snapshot().items())
+
+
+class ListenerEngine:
+    def __init__(self, app_id: str, app_secret: str, workspace: str, domain_key: str = "feishu", ack: bool = False,
+                 ack_text: str = ACK_TEXT, workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE,
+                 stats_interval: float = 60.0, compact_bytes: int = DEFAULT_COMPACT_BYTES, name: str = "lark",
+                 metrics_port: int = 0, json_log: str = "", backfill: bool = False, backfill_chats=()):
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.workspace = os.path.abspath(workspace)
+        self.domain_key = domain_key
+        self.ack_text = ack_text
+        self.name = name
+        self.backfill = backfill
+        self.backfill_chats = list(backfill_chats or ())
+        self.store = PendingStore(self.workspace, compact_bytes=compact_bytes)
+        # 与 lark_reply.py 共用的发送器：限流 + 重试；常驻进程顺带重发 outbox 里失败的回复
+        self.sender = get_sender(app_id, app_secret, domain_host(domain_key), self.workspace)
+        start_outbox_flusher(lambda: self.sender, OUTBOX_FLUSH_INTERVAL)
+        # 内存去重：挡住飞书重推，无需读库；预热最近收录的 message_id
+        self.dedup = DedupCache()
+        self.dedup.warm(self.store.recent_message_ids(self.dedup.max_size))
+        self.timings = StageTimings()
+        self.ws = None
+        self._dispatchers = []
+        # 配置文件里没写（或删掉）的调优项回到构造时的值
+        self._tuning_defaults = {"ack_text": ack_text, "workers": workers, "send_rate": self.sender.limiter.rate,
+                                 "chat_rate": self.sender.chat_rate}
+        self._backfill_chats_arg = list(self.backfill_chats)
+        # (阶段名, 函数, 是否在回调内执行)；函数返回 False 时终止后续阶段
+        self.stages = [("dedup", self._dedup_stage, True), ("persist", self._persist_stage, False)]
+        if ack:
+            self.stages.append(("ack", self._ack_stage, False))
+        self.stages.append(("dispatch", self._dispatch_stage, False))
+        self.queue = WorkQueue(self._process, workers=workers, maxsize=queue_size, name=name, key=lambda m: m["chat_id"])
+        start_stats_reporter(self.queue, stats_interval, extra=lambda: f"阶段耗时(avg/max) {self.timings.summary()}")
+        # 指标：/metrics 与可选 JSON 日志
+        PENDING.set_function(self.store.count_unreplied)
+        QUEUE_DEPTH.set_function(self.queue.depth)
+        if json_log:
+            configure_json_log(json_log)
+            start_metrics_logger(stats_interval)
+        if start_metrics_server(metrics_port):
+            print(f"[{_ts()}] 指标: http://127.0.0.1:{metrics_port}/metrics")
+
+    # ---- 扩展点 ----
+
+    def add_stage(self, name: str, fn, inline: bool = False, before: str = None):
+        """插入自定义阶段；before 为已有阶段名时插在其前面，否则追加到末尾"""
+        entry = (name, fn, inline)
+        names = [n for n, _, _ in self.stages]
+        if before in names:
+            self.stages.insert(names.index(before), entry)
+        else:
+            self.stages.append(entry)
+
+    def on_new(self, callback):
+        """新消息落盘（及 ack）后调用 callback(item)"""
+        self._dispatchers.append(callback)
+
+    def stats(self) -> dict:
+        return {"queue": self.queue.stats(), "stages": self.timings.snapshot(), "dedup_hits": self.dedup.hits,
+                "sender": dict(self.sender.stats), "ws": self.ws.health() if self.ws else None}
+
+    def catch_up(self, since: float = None) -> dict:
+        """补拉 since（time.time() 时间戳，默认库里最后一条消息的时间）之后的消息，经去重后走正常流水线"""
+        if since is None:
+            since = default_since(self.store)
+        return backfill(self, since, self.backfill_chats)
+
+    # ---- 配置热更新 ----
+
+    def apply_config(self, cfg: dict) -> dict:
+        """按配置调整可热更新的参数，未写的恢复为构造时的值；返回实际变化的 {键: 新值}"""
+        want = {}
+        for key, default in self._tuning_defaults.items():
+            value = cfg.get(key)
+            if value is None:
+                want[key] = default
+                continue
+            try:
+                want[key] = str(value) if key == "ack_text" else (int(value) if key == "workers" else float(value))
+            except (TypeError, ValueError):
+                print(f"[{_ts()}] WARN: 配置项 {key}={value!r} 无效，保持不变", file=sys.stderr)
+        current = {"ack_text": self.ack_text, "workers": self.queue.workers, "send_rate": self.sender.limiter.rate,
+                   "chat_rate": self.sender.chat_rate}
+        changed = {k: v for k, v in want.items() if v != current[k]}
+        if "ack_text" in changed:
+            self.ack_text = changed["ack_text"]
+        if "workers" in changed:
+            self.queue.resize(changed["workers"])
+        if "send_rate" in changed or "chat_rate" in changed:
+            self.sender.set_rates(changed.get("send_rate"), changed.get("chat_rate"))
+        chats = list(dict.fromkeys(self._backfill_chats_arg + list(cfg.get("backfill_chats") or [])))
+        if chats != self.backfill_chats:
+            self.backfill_chats = changed["backfill_chats"] = chats
+        if changed:
+            print(f"[{_ts()}] 已应用配置: " + ", ".join(f"{k}={v}" for k, v in changed.items()))
+            log_event("config_applied", **{k: v for k, v in changed.items() if k != "ack_text"})
+        return changed
+
+    def set_credentials(self, app_id: str, app_secret: str, domain_key: str) -> bool:
+        """凭据或域名变化时换用新的发送器并重连长连接，返回是否有变化"""
+        if (app_id, app_secret, domain_key) == (self.app_id, self.app_secret, self.domain_key):
+            return False
+        if not app_id or not app_secret:
+            print(f"[{_ts()}] WARN: 新配置缺少 app_id / app_secret，继续使用原凭据", file=sys.stderr)
+            return False
+        old = self.sender
+        sender = get_sender(app_id, app_secret, domain_host(domain_key), self.workspace)
+        sender.set_rates(old.limiter.rate, old.chat_rate)
+        self.app_id, self.app_secret, self.domain_key = app_id, app_secret, domain_key
+        self.sender = sender
+        print(f"[{_ts()}] 凭据/域名已更新 app_id={app_id[:12]}... domain={domain_host(domain_key)}，重连长连接")
+        if self.ws:
+            self.ws.reconnect("凭据/域名变更", app_id, app_secret, domain_host(domain_key))
+        return True
+
+    def watch_config(self, config, credentials=None):
+        """应用 lark_config.Config 的当前内容并监视后续修改；credentials(cfg) 返回 (app_id, app_secret, domain_key)，
+        给出时凭据/域名的变化也会生效（命令行、环境变量优先的规则由它决定）"""
+
+        def _apply(_changed, c):
+            data = c.data
+            self.apply_config(data)
+            if credentials:
+                self.set_credentials(*credentials(data))
+
+        _apply(None, config)
+        config.on_change(_apply)
+        config.watch()
+
+    # ---- 内置阶段 ----
+
+    def _dedup_stage(self, item):
+        # 飞书可能重推同一事件（event_id 相同）或同一消息，内存 O(1) 判重
+        if self.dedup.seen(item["message_id"], item["event_id"]):
+            print(f"[{_ts()}] 跳过重复 message_id={item['message_id']}")
+            DUPLICATES.inc(layer="memory")
+            log_event("duplicate", message_id=item["message_id"], layer="memory")
+            return False
+        return True
+
+    def _persist_stage(self, item):
+        # 库的唯一约束兜底去重（内存缓存过期或容量淘汰后的重推）
+        try:
+            added = self.store.add(item["message_id"], item["chat_id"], item["text"])
+        except Exception:
+            # 落盘失败：从缓存移除，让飞书重推能再进来
+            self.dedup.discard(item["message_id"], item["event_id"])
+            raise
+        if not added:
+            print(f"[{_ts()}] 跳过重复 message_id={item['message_id']}")
+            DUPLICATES.inc(layer="store")
+            log_event("duplicate", message_id=item["message_id"], layer="store")
+            return False
+        print(f"[{_ts()}] 收到消息 message_id={item['message_id']} chat_id={item['chat_id']} text={item['text'][:40]}...")
+        MESSAGES_STORED.inc()
+        log_event("message", message_id=item["message_id"], chat_id=item["chat_id"], msg_type=item["msg_type"],
+                  lag_ms=round((time.monotonic() - item["received"]) * 1000, 1))
+        return True
+
+    def _ack_stage(self, item):
+        # ack 过时就没有意义，失败不进 outbox
+        t0 = time.perf_counter()
+        try:
+            self.sender.send(item["message_id"], self.ack_text, chat_id=item["chat_id"], queue_on_failure=False)
+            ACK_SECONDS.observe(time.perf_counter() - t0)
+        except Exception as e:
+            ACK_FAILURES.inc()
+            log_event("ack_failed", message_id=item["message_id"], error=str(e))
+            print(f"[{_ts()}] ack 失败: {e}", file=sys.stderr)
+        return True
+
+    def _dispatch_stage(self, item):
+        for cb in self._dispatchers:
+            try:
+                cb(item)
+            except Exception as e:
+                print(f"[{_ts()}] 分发失败: {e}", file=sys.stderr)
+        return True
+
+    # ---- 流水线 ----
+
+    def _run_stages(self, item, inline: bool) -> bool:
+        for name, fn, stage_inline in self.stages:
+            if stage_inline != inline:
+                continue
+            t0 = time.perf_counter()
+            try:
+                ok = fn(item)
+            finally:
+                elapsed = time.perf_counter() - t0
+                self.timings.record(name, elapsed)
+                STAGE_SECONDS.observe(elapsed, stage=name)
+            if ok is False:
+                return False
+        return True
+
+    def _process(self, item):
+        self._run_stages(item, inline=False)
+        elapsed = time.monotonic() - item["received"]
+        self.timings.record("total", elapsed)
+        E2E_SECONDS.observe(elapsed)
+
+    def _startup_backfill(self):
+        try:
+            self.catch_up()
+        except Exception as e:
+            print(f"[{_ts()}] 启动补拉失败: {e}", file=sys.stderr)
+
+    def handle_event(self, data, block: bool = False):
+        """长连接回调：parse + 内存阶段，然后入队立即返回；block=True 时队列满则等待空位（补拉用）"""
+        try:
+            t0 = time.perf_counter()
+            item = parse_event(data)
+            elapsed = time.perf_counter() - t0
+            self.timings.record("parse", elapsed)
+            STAGE_SECONDS.observe(elapsed, stage="parse")
+            if item is None:
+                return
+            EVENTS_RECEIVED.inc()
+            item["received"] = time.monotonic()
+            if not self._run_stages(item, inline=True):
+                return
+            if not self.queue.submit(item, block=True, timeout=None if block else SUBMIT_TIMEOUT):
+                # 等了 SUBMIT_TIMEOUT 秒仍满：越过上限排进该会话的分片，不丢消息、不打乱会话内顺序，
+                # 落盘/ack 仍由 worker 做，不占用长连接回调线程
+                print(f"[{_ts()}] 队列已满（{self.queue.maxsize}），超出上限入队 message_id={item['message_id']}", file=sys.stderr)
+                self.queue.submit(item, overflow=True)
+        except Exception as e:
+            print(f"[{_ts()}] handle_im_message: {e}", file=sys.stderr)
+
+    def run(self):
+        """建立长连接并阻塞运行；断线后快速重连并补拉断线期间的消息"""
+        import lark_oapi as lark
+
+        def _noop(_d):
+            # 已读回执、进入单聊等事件无需处理，仅避免 "processor not found" 报错
+            pass
+
+        ev = (
+            lark.EventDispatcherHandler.builder("", "")
+            .register_p2_im_message_receive_v1(self.handle_event)
+            .register_p2_im_message_message_read_v1(_noop)
+            .register_p2_im_chat_access_event_bot_p2p_chat_entered_v1(_noop)
+            .build()
+        )
+        # 队列满时回调会等空位（最多 SUBMIT_TIMEOUT 秒）、阻塞长连接事件循环，此时收不到帧不算连接卡死
+        busy = lambda: self.queue.depth() >= self.queue.maxsize
+        self.ws = WsSupervisor(self.app_id, self.app_secret, ev, domain_host(self.domain_key),
+                               on_reconnected=self.catch_up, busy=busy)
+        if self.backfill:
+            # 与建连并行：不耽误实时消息，两边重叠的部分由去重挡掉
+            threading.Thread(target=self._startup_backfill, name="lark-backfill", daemon=True).start()
+        try:
+            self.ws.run()
+        except KeyboardInterrupt:
+            print("\n已停止")
@@ -0,0 +1,134 @@
+"""
+跨进程文件锁 + 原子写：保护 lark-pending.md、token 缓存等被多个进程同时读写的文件。
+
+- FileLock：基于旁路 .lock 文件的排他锁（POSIX 用 fcntl.flock，Windows 用 msvcrt.locking），同进程内可重入
+- atomic_write：写临时文件 → fsync → os.replace，读者要么看到旧内容要么看到新内容，进程崩溃也不会留下半截文件
+- atomic_write / append_durable 的 content 为 bytes 时按原样写入（调用方自己算字节偏移时用）
+
+用法:
+  with FileLock(path + ".lock"):
+      atomic_write(path, content)
+"""
+
+import os
+import sys
+import threading
+import time
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+DEFAULT_TIMEOUT = 30.0
+
+
+class FileLockTimeout(TimeoutError):
+    pass
+
+
+class FileLock:
+    def __init__(self, path: str, timeout: float = DEFAULT_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._fd = None
+        self._depth = 0
+        self._owner = None
+        self._thread_lock = threading.RLock()
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        if self._depth:
+            self._depth += 1
+            return self
+        deadline = time.monotonic() + self.timeout
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            self._thread_lock.release()
+            raise
+        delay = 0.005
+        while True:
+            try:
+                if sys.platform == "win32":
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                else:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    self._thread_lock.release()
+                    raise FileLockTimeout(f"等待文件锁超时: {self.path}")
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+        self._fd = fd
+        self._depth = 1
+        return self
+
+    def release(self):
+        if not self._depth:
+            raise RuntimeError("FileLock 未持有")
+        self._depth -= 1
+        if not self._depth:
+            fd, self._fd = self._fd, None
+            try:
+                if sys.platform == "win32":
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+        self._thread_lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _open_args(mode: str, content, encoding: str):
+    return (mode + "b", None) if isinstance(content, bytes) else (mode, encoding)
+
+
+def atomic_write(path: str, content, encoding: str = "utf-8"):
+    """临时文件写完并 fsync 后 os.replace 覆盖目标"""
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    mode, encoding = _open_args("w", content, encoding)
+    try:
+        with open(tmp, mode, encoding=encoding) as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        _replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _replace(src: str, dst: str, attempts: int = 10):
+    # Windows 上目标文件被其他进程短暂打开时 os.replace 会失败，稍后重试
+    for i in range(attempts):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            if i == attempts - 1:
+                raise
+            time.sleep(0.05 * (i + 1))
+
+
+def append_durable(path: str, content, encoding: str = "utf-8"):
+    """追加写并 fsync，返回写完后的文件大小"""
+    mode, encoding = _open_args("a", content, encoding)
+    with open(path, mode, encoding=encoding) as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
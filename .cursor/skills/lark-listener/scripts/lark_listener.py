@@ -6,164 +6,57 @@
   python lark_listener.py --workspace D:\kuaikuAi\autowork --ack --on-new "cursor D:\kuaikuAi\autowork agent-tasks/lark-pending.md"
 
 配置：从 lark-config.json 读取 app_id、app_secret、domain（不填或 feishu 为飞书中国，lark 为国际版）。
+运行中修改 lark-config.json 会自动生效（ack_text、workers、send_rate 等调优项不断开长连接，见 lark_config.py）。
 """
 
 import argparse
-import json
 import os
 import subprocess
 import sys
-import time
-from datetime import datetime
 
 # 长连接与事件处理依赖 lark-oapi
 try:
-    import lark_oapi as lark
+    import lark_oapi  # noqa: F401
 except ImportError:
     print("请先安装: pip install lark-oapi", file=sys.stderr)
     sys.exit(1)
 
-LARK_PENDING_FILENAME = "lark-pending.md"
-CONFIG_FILENAME = "lark-config.json"
-NON_TEXT_PLACEHOLDER = "(非文本消息)"
-
-
-def _ts():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-
-def _load_config(workspace_dir):
-    for d in (workspace_dir, os.getcwd(), os.path.dirname(os.path.abspath(__file__))):
-        path = os.path.join(d, CONFIG_FILENAME)
-        if os.path.isfile(path):
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                if isinstance(data, dict):
-                    return data
-            except Exception:
-                pass
-    return {}
-
-
-def _domain_url(domain_key):
-    if domain_key in ("lark", "larksuite"):
-        return "https://open.larksuite.com"
-    return "https://open.feishu.cn"
-
-
-def run_ws_listener(app_id: str, app_secret: str, workspace_dir: str, ack: bool = False, on_new_cmd: str = "", domain_key: str = "feishu"):
-    workspace = os.path.abspath(workspace_dir)
-    task_dir = os.path.join(workspace, "agent-tasks")
-    os.makedirs(task_dir, exist_ok=True)
-    pending_path = os.path.join(task_dir, LARK_PENDING_FILENAME)
-    domain = _domain_url(domain_key)
-
-    def _noop(_data):
-        # 已读回执等事件无需处理，仅避免 "processor not found" 报错
-        pass
-
-    def _get(obj, key, default=""):
-        """从 dict 或对象取属性，兼容 lark_oapi 传入的事件对象"""
-        if obj is None:
-            return default
-        if isinstance(obj, dict):
-            return obj.get(key, default)
-        return getattr(obj, key, default)
-
-    def handle_im_message(data):
-        try:
-            # lark_oapi: data.event 为 P2ImMessageReceiveV1Data，data.event.message 为 EventMessage（含 message_id/chat_id/content）
-            event = _get(data, "event")
-            if event is None:
-                event = getattr(data, "event", None)
-            if event is None:
-                return
-            msg = _get(event, "message")  # EventMessage
-            if msg is None:
-                msg = getattr(event, "message", None)
-            if msg is None:
-                return
-            message_id = _get(msg, "message_id", "") or ""
-            chat_id = _get(msg, "chat_id", "") or ""
-            msg_type = _get(msg, "message_type", "") or ""
-            text = NON_TEXT_PLACEHOLDER
-            if message_id and msg_type == "text":
-                raw = _get(msg, "content") or "{}"
-                try:
-                    content = json.loads(raw) if isinstance(raw, str) else raw
-                    text = (_get(content, "text") or "").strip() if isinstance(content, dict) else str(raw)[:200]
-                except Exception:
-                    text = str(raw)[:200] if raw else NON_TEXT_PLACEHOLDER
-            elif message_id:
-                text = str(_get(msg, "content", ""))[:200] or NON_TEXT_PLACEHOLDER
-            if not message_id:
-                return
-            block = f"""
----
-message_id: {message_id}
-chat_id: {chat_id}
-**[{_ts()}]** 飞书消息（请执行并回复此 message_id）：
-{text}
-
-"""
-            with open(pending_path, "a", encoding="utf-8") as f:
-                f.write(block)
-            print(f"[{_ts()}] 收到消息 message_id={message_id} chat_id={chat_id} text={text[:50]}...")
-            print(f"INFO: 已写入 pending: {pending_path}")
-
-            if ack:
-                try:
-                    reply_script = os.path.join(os.path.dirname(__file__), "lark_reply.py")
-                    if os.path.isfile(reply_script):
-                        subprocess.run(
-                            [sys.executable, reply_script, message_id, "已收到，正在处理。"],
-                            cwd=workspace,
-                            timeout=5,
-                            capture_output=True,
-                        )
-                        print("INFO: 回复成功", message_id)
-                except Exception as e:
-                    print("WARN: ack 回复失败:", e, file=sys.stderr)
-
-            if on_new_cmd:
-                try:
-                    subprocess.Popen(
-                        on_new_cmd,
-                        shell=True,
-                        cwd=workspace,
-                        stdin=subprocess.DEVNULL,
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                    )
-                except Exception as e:
-                    print("WARN: on-new 执行失败:", e, file=sys.stderr)
-        except Exception as e:
-            print(f"ERROR: handle_im_message: {e}", file=sys.stderr)
-
-    event_handler = (
-        lark.EventDispatcherHandler.builder("", "")
-        .register_p2_im_message_receive_v1(handle_im_message)
-        .register_p2_im_message_message_read_v1(_noop)
-        .register_p2_im_chat_access_event_bot_p2p_chat_entered_v1(_noop)  # 用户打开与机器人的单聊时触发，忽略即可
-        .build()
+from lark_common import _ts, domain_host, resolve_credentials
+from lark_config import get_config
+from lark_engine import ListenerEngine
+from lark_queue import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS
+from lark_store import DEFAULT_COMPACT_BYTES
+
+
+def run_ws_listener(app_id: str, app_secret: str, workspace_dir: str, ack: bool = False, on_new_cmd: str = "", domain_key: str = "feishu",
+                    workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE, stats_interval: float = 60.0,
+                    compact_bytes: int = DEFAULT_COMPACT_BYTES, metrics_port: int = 0, json_log: str = "",
+                    backfill: bool = True, backfill_chats=(), config=None, credentials=None):
+    # ack 在进程内经 lark_sender 发送（共享 token 缓存与限流），不再每条消息起一个子进程
+    engine = ListenerEngine(
+        app_id, app_secret, workspace_dir, domain_key, ack=ack, workers=workers, queue_size=queue_size,
+        stats_interval=stats_interval, compact_bytes=compact_bytes, name="lark-listener",
+        metrics_port=metrics_port, json_log=json_log, backfill=backfill, backfill_chats=backfill_chats,
     )
 
-    while True:
+    def run_on_new(_item):
         try:
-            client = lark.ws.Client(
-                app_id,
-                app_secret,
-                event_handler=event_handler,
-                domain=domain,
+            subprocess.Popen(
+                on_new_cmd,
+                shell=True,
+                cwd=engine.workspace,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
             )
-            client.start()
-        except KeyboardInterrupt:
-            print("\n已停止")
-            break
         except Exception as e:
-            print(f"[{_ts()}] 连接失败: {e}，30s 后重试...", file=sys.stderr)
-            time.sleep(30)
+            print("WARN: on-new 执行失败:", e, file=sys.stderr)
+
+    if on_new_cmd:
+        engine.on_new(run_on_new)
+    if config is not None:
+        engine.watch_config(config, credentials)
+    engine.run()
 
 
 def main():
@@ -174,19 +67,32 @@ def main():
     parser.add_argument("--ack", action="store_true", help="写入 pending 后立即回复「已收到，正在处理」")
     parser.add_argument("--on-new", default="", help="有新待办时执行的命令")
     parser.add_argument("--log-dir", default="", help="日志目录（可选）")
+    parser.add_argument("--compact-bytes", type=int, default=DEFAULT_COMPACT_BYTES, help="lark-pending.md 超过该字节数时自动归档已回复的块（0 关闭）")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="后台处理线程数（落盘/ack/on-new）")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE, help="事件队列上限，满时回调最多等 1s，仍满则超出上限入队（保持会话内顺序）")
+    parser.add_argument("--stats-interval", type=float, default=60.0, help="队列深度/延迟统计打印间隔秒数（0 关闭）")
+    parser.add_argument("--metrics-port", type=int, default=0, help="在 127.0.0.1:端口/metrics 提供 Prometheus 指标（0 关闭）")
+    parser.add_argument("--log-json", default="", help="同时把结构化 JSON 日志写入该文件（- 为 stdout）")
+    parser.add_argument("--no-backfill", action="store_true", help="启动时不补拉停机期间的消息")
+    parser.add_argument("--backfill-chats", default="", help="额外补拉的 chat_id，逗号分隔（也可写在 lark-config.json 的 backfill_chats）")
     args = parser.parse_args()
 
-    cfg = _load_config(args.workspace)
-    app_id = args.app_id or os.environ.get("APP_ID") or cfg.get("app_id", "")
-    app_secret = args.app_secret or os.environ.get("APP_SECRET") or cfg.get("app_secret", "")
-    domain_key = (cfg.get("domain") or "feishu").lower()
+    config = get_config(args.workspace)
+    app_id, app_secret, domain_key = resolve_credentials(args, config.data)
+    # lark-config.json 的 backfill_chats 由 engine.watch_config 合并进来（可热更新）
+    backfill_chats = [c.strip() for c in args.backfill_chats.split(",") if c.strip()]
 
     if not app_id or not app_secret:
         print("请配置 app_id 与 app_secret（lark-config.json 或环境变量 APP_ID/APP_SECRET）", file=sys.stderr)
         sys.exit(1)
 
-    print(f"[{_ts()}] 启动监听 app_id={app_id[:12]}... domain={_domain_url(domain_key)}")
-    run_ws_listener(app_id, app_secret, args.workspace, ack=args.ack, on_new_cmd=args.on_new or "", domain_key=domain_key)
+    print(f"[{_ts()}] 启动监听 app_id={app_id[:12]}... domain={domain_host(domain_key)}")
+    run_ws_listener(
+        app_id, app_secret, args.workspace, ack=args.ack, on_new_cmd=args.on_new or "", domain_key=domain_key,
+        workers=args.workers, queue_size=args.queue_size, stats_interval=args.stats_interval, compact_bytes=args.compact_bytes,
+        metrics_port=args.metrics_port, json_log=args.log_json, backfill=not args.no_backfill, backfill_chats=backfill_chats,
+        config=config, credentials=lambda cfg: resolve_credentials(args, cfg),
+    )
 
 
 if __name__ == "__main__":
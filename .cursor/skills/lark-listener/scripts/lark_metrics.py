@@ -0,0 +1,263 @@
+"""
+监听/回复的指标：计数器、仪表、直方图，以 Prometheus 文本格式在本地 HTTP /metrics 暴露，可选写 JSON 日志。
+
+- 各模块在模块级用 counter() / gauge() / histogram() 声明指标（同名重复声明返回同一个对象），无需传递 registry
+- gauge 可以绑定回调（如未回复条数），抓取时才计算
+- start_metrics_server(port)：127.0.0.1:port/metrics；port 为 0 时不启动
+- configure_json_log(path)：之后 log_event() 与定期指标快照以 JSON 行写入该文件（- 为 stdout）
+- 不依赖 prometheus_client，只实现用到的部分
+
+用法:
+  from lark_metrics import counter, histogram
+  EVENTS = counter("lark_events_received_total", "收到的消息事件")
+  EVENTS.inc()
+  with histogram("lark_ack_seconds", "ack 耗时").time():
+      ...
+"""
+
+import bisect
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_str(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items())) + "}"
+
+
+def _fmt(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+
+    def samples(self):
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{_label_str(labels)} {_fmt(value)}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items()) or [((), 0)]
+        return [(self.name, dict(k), v) for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self._values = {}
+        self._fn = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, fn):
+        """抓取时调用 fn() 取值；fn 抛异常时该指标本次不输出"""
+        self._fn = fn
+
+    def samples(self):
+        if self._fn is not None:
+            try:
+                return [(self.name, {}, self._fn())]
+            except Exception:
+                return []
+        with self._lock:
+            return [(self.name, dict(k), v) for k, v in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [bucket_counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                s[0][i] += 1
+            s[1] += value
+            s[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def samples(self):
+        out = []
+        with self._lock:
+            series = [(dict(k), list(v[0]), v[1], v[2]) for k, v in self._series.items()]
+        for labels, counts, total, count in series:
+            acc = 0
+            for bound, c in zip(self.buckets, counts):
+                acc += c
+                out.append((f"{self.name}_bucket", {**labels, "le": _fmt(bound)}, acc))
+            out.append((f"{self.name}_bucket", {**labels, "le": "+Inf"}, count))
+            out.append((f"{self.name}_sum", labels, round(total, 6)))
+            out.append((f"{self.name}_count", labels, count))
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, **kw):
+        with self._lock:
+            m = self._metrics.get(name)
+            if m is None:
+                m = self._metrics[name] = cls(name, help_text, **kw)
+            elif not isinstance(m, cls):
+                raise ValueError(f"指标 {name} 已注册为 {m.kind}")
+            return m
+
+    def expose(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.expose() for m in metrics) + "\n"
+
+    def snapshot(self) -> dict:
+        """{指标名{标签}: 值}，直方图只给 _sum / _count"""
+        out = {}
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for m in metrics:
+            for name, labels, value in m.samples():
+                if name.endswith("_bucket"):
+                    continue
+                out[name + _label_str(labels)] = value
+        return out
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help_text: str) -> Counter:
+    return REGISTRY._get(Counter, name, help_text)
+
+
+def gauge(name: str, help_text: str) -> Gauge:
+    return REGISTRY._get(Gauge, name, help_text)
+
+
+def histogram(name: str, help_text: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY._get(Histogram, name, help_text, buckets=buckets)
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1", registry: Registry = REGISTRY):
+    """后台线程提供 GET /metrics；port <= 0 时不启动，返回 server 或 None"""
+    if port <= 0:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.expose().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="lark-metrics", daemon=True).start()
+    return server
+
+
+# ---- JSON 日志 ----
+
+_json_log = {"file": None, "lock": threading.Lock()}
+
+
+def configure_json_log(path: str):
+    """开启 JSON 行日志；path 为 - 时写 stdout，空串关闭"""
+    with _json_log["lock"]:
+        f = _json_log["file"]
+        if f is not None and f is not sys.stdout:
+            f.close()
+        _json_log["file"] = None if not path else (sys.stdout if path == "-" else open(path, "a", encoding="utf-8"))
+
+
+def log_event(event: str, **fields):
+    """写一行 {"ts", "event", ...}；未开启 JSON 日志时什么也不做"""
+    f = _json_log["file"]
+    if f is None:
+        return
+    line = json.dumps({"ts": datetime.now().isoformat(timespec="milliseconds"), "event": event, **fields}, ensure_ascii=False, default=str)
+    with _json_log["lock"]:
+        f.write(line + "\n")
+        f.flush()
+
+
+def start_metrics_logger(interval: float = 60.0, registry: Registry = REGISTRY):
+    """定期把指标快照写入 JSON 日志；未开启 JSON 日志或 interval <= 0 时不启动"""
+    if interval <= 0 or _json_log["file"] is None:
+        return None
+
+    def _loop():
+        while True:
+            time.sleep(interval)
+            log_event("metrics", **registry.snapshot())
+
+    t = threading.Thread(target=_loop, name="lark-metrics-log", daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,229 @@
+"""
+本地飞书开放平台 mock：不连真实租户也能跑通回复链路、做压测。
+
+- POST /open-apis/auth/v3/tenant_access_token/internal
+- POST /open-apis/im/v1/messages/{message_id}/reply   （按 uuid 去重，与飞书一致）
+- PUT  /open-apis/im/v1/messages/{message_id}          （编辑消息）
+- GET  /open-apis/im/v1/messages?container_id=...      （会话历史消息，按 start_time/end_time 过滤、page_token 分页；
+  add_history() 写入的用户消息与机器人回复都在里面，用于验证断线补拉）
+- GET  /open-apis/im/v1/messages/{message_id}/resources/{file_key}   （下载附件，内容由 add_resource() 给出）
+- 可注入固定延迟（latency）与按比例返回 429 频控（rate_limit_ratio），记录每次回复的到达时间
+- make_event()：构造与长连接推送同结构的 im.message.receive_v1 事件，直接交给 ListenerEngine.handle_event
+  （长连接本身是 lark_oapi 的 protobuf 帧协议，压测从事件回调入口注入）
+
+用法:
+  python lark_mock.py --port 18080          # 然后在 lark-config.json 里写 "domain": "http://127.0.0.1:18080"
+  from lark_mock import MockFeishuServer
+  with MockFeishuServer() as mock:
+      ...mock.url...
+"""
+
+import argparse
+import bisect
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+_REPLY_RE = re.compile(r"^/open-apis/im/v1/messages/([^/]+)/reply$")
+_EDIT_RE = re.compile(r"^/open-apis/im/v1/messages/([^/]+)$")
+_RESOURCE_RE = re.compile(r"^/open-apis/im/v1/messages/([^/]+)/resources/([^/]+)$")
+
+
+def make_event(message_id: str, chat_id: str, text: str, event_id: str = None, msg_type: str = "text") -> dict:
+    """与 lark_oapi 传给 register_p2_im_message_receive_v1 回调的数据同结构（dict 形式）"""
+    key = {"text": "text", "image": "image_key"}.get(msg_type, "file_key")
+    content = json.dumps({key: text}, ensure_ascii=False)
+    return {
+        "schema": "2.0",
+        "header": {"event_id": event_id or f"ev_{message_id}", "event_type": "im.message.receive_v1", "create_time": str(int(time.time() * 1000))},
+        "event": {
+            "sender": {"sender_id": {"open_id": "ou_mock"}, "sender_type": "user"},
+            "message": {"message_id": message_id, "chat_id": chat_id, "chat_type": "group", "message_type": msg_type, "content": content},
+        },
+    }
+
+
+class MockFeishuServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, rate_limit_ratio: float = 0.0):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.replies = []  # (monotonic, message_id, text)
+        self.edits = []
+        self.first_reply_at = {}  # message_id -> monotonic
+        self.stats = {"token": 0, "reply": 0, "edit": 0, "duplicate": 0, "rate_limited": 0, "history": 0, "resource": 0}
+        self.resources = {}  # file_key -> (bytes, content_type)
+        self.history = []  # 会话历史消息（接口 item 结构），按创建时间升序
+        self._history_keys = []  # 与 history 对应的 create_time，用于有序插入（bisect 的 key 参数要 3.10+）
+        self._uuids = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="lark-mock", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def add_history(self, chat_id: str, message_id: str, text: str, create_time: float = None, sender_type: str = "user"):
+        """往会话历史里加一条消息（create_time 为秒级时间戳，默认当前时间）"""
+        item = {
+            "message_id": message_id,
+            "chat_id": chat_id,
+            "msg_type": "text",
+            "create_time": str(int((create_time or time.time()) * 1000)),
+            "deleted": False,
+            "sender": {"id": "ou_mock" if sender_type == "user" else "cli_mock", "sender_type": sender_type},
+            "body": {"content": json.dumps({"text": text}, ensure_ascii=False)},
+        }
+        key = int(item["create_time"])
+        with self._lock:
+            i = bisect.bisect_right(self._history_keys, key)
+            self._history_keys.insert(i, key)
+            self.history.insert(i, item)
+
+    def add_resource(self, file_key: str, data: bytes, content_type: str = "application/octet-stream"):
+        with self._lock:
+            self.resources[file_key] = (data, content_type)
+
+    def _list_history(self, query: dict):
+        q = {k: v[0] for k, v in query.items()}
+        start = int(q.get("start_time") or 0) * 1000
+        end = int(q.get("end_time") or 0) * 1000 or float("inf")
+        size = min(int(q.get("page_size") or 20), 50)
+        offset = int(q.get("page_token") or 0)
+        with self._lock:
+            self.stats["history"] += 1
+            items = [m for m in self.history if m["chat_id"] == q.get("container_id") and start <= int(m["create_time"]) <= end]
+        page = items[offset:offset + size]
+        more = offset + size < len(items)
+        return 200, {"code": 0, "msg": "ok", "data": {"items": page, "has_more": more, "page_token": str(offset + size) if more else ""}}
+
+    def _handle(self, method: str, path: str, body: dict, query: dict = None):
+        """返回 (HTTP 状态码, 响应 JSON)；下载附件时为 (200, (bytes, Content-Type))"""
+        if self.latency:
+            time.sleep(self.latency)
+        if path == "/open-apis/auth/v3/tenant_access_token/internal":
+            with self._lock:
+                self.stats["token"] += 1
+            return 200, {"code": 0, "msg": "ok", "tenant_access_token": "t-mock", "expire": 7200}
+        if self.rate_limit_ratio and random.random() < self.rate_limit_ratio:
+            with self._lock:
+                self.stats["rate_limited"] += 1
+            return 429, {"code": 99991400, "msg": "request trigger frequency limit"}
+        if method == "GET" and path == "/open-apis/im/v1/messages":
+            return self._list_history(query or {})
+        m = _RESOURCE_RE.match(path)
+        if method == "GET" and m:
+            with self._lock:
+                res = self.resources.get(m.group(2))
+                self.stats["resource"] += 1
+            if res is None:
+                return 400, {"code": 234003, "msg": "File not in msg."}
+            return 200, res
+        text = ""
+        try:
+            text = json.loads(body.get("content") or "{}").get("text", "")
+        except ValueError:
+            pass
+        now = time.monotonic()
+        m = _REPLY_RE.match(path)
+        if method == "POST" and m:
+            mid = m.group(1)
+            with self._lock:
+                uid = body.get("uuid")
+                if uid and uid in self._uuids:
+                    self.stats["duplicate"] += 1
+                    return 200, {"code": 0, "msg": "ok", "data": {"message_id": self._uuids[uid]}}
+                new_id = f"om_mock_{next(self._ids)}"
+                if uid:
+                    self._uuids[uid] = new_id
+                self.stats["reply"] += 1
+                self.replies.append((now, mid, text))
+                self.first_reply_at.setdefault(mid, now)
+                chat_id = next((h["chat_id"] for h in self.history if h["message_id"] == mid), "")
+            if chat_id:
+                self.add_history(chat_id, new_id, text, sender_type="app")
+            return 200, {"code": 0, "msg": "ok", "data": {"message_id": new_id}}
+        m = _EDIT_RE.match(path)
+        if method == "PUT" and m:
+            with self._lock:
+                self.stats["edit"] += 1
+                self.edits.append((now, m.group(1), text))
+            return 200, {"code": 0, "msg": "ok", "data": {}}
+        return 404, {"code": 404, "msg": f"mock: 不支持 {method} {path}"}
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # keep-alive 下头和正文分两次写，Nagle + 延迟 ACK 会让每个请求多等约 40ms
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _dispatch(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+                except ValueError:
+                    body = {}
+                path, _, qs = self.path.partition("?")
+                status, data = mock._handle(self.command, path, body, parse_qs(qs))
+                if isinstance(data, tuple):
+                    payload, content_type = data
+                else:
+                    payload, content_type = json.dumps(data, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = _dispatch
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地飞书开放平台 mock（token / 回复 / 编辑消息 / 历史消息 / 附件）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求固定延迟秒数")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="按该比例返回 429 频控")
+    args = parser.parse_args()
+    mock = MockFeishuServer(args.host, args.port, latency=args.latency, rate_limit_ratio=args.rate_limit_ratio).start()
+    print(f"INFO: mock 已启动 {mock.url}，lark-config.json 中设置 \"domain\": \"{mock.url}\" 即可指向它")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"INFO: {json.dumps(mock.stats)}")
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
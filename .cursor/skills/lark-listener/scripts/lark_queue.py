@@ -0,0 +1,234 @@
+"""
+有界工作队列 + 线程池：事件回调只负责入队并立即返回，落盘、ack、触发 Agent 交给后台 worker。
+
+- 按 chat_id 分片：同一会话内按到达顺序处理，不同会话并行，worker 数为全局并发上限
+- 队列满时 submit 返回 False（可用 timeout 先等一会儿）；overflow=True 时越过上限照样排进该会话的分片，
+  保持会话内顺序、不丢消息，也不在调用方线程里处理
+- stats() 暴露队列深度、排队延迟（入队到开始处理）、处理/失败计数
+- resize() 运行中增减 worker 数：多出的 worker 处理完手上的一条后退出
+"""
+
+import sys
+import threading
+import time
+from collections import deque
+
+from lark_common import _ts
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 1000
+# 排队延迟超过该秒数时打印告警
+LAG_WARN_SECONDS = 5.0
+# 长连接回调在队列满时最多等待的秒数，之后越过上限入队（见 lark_engine.handle_event）
+SUBMIT_TIMEOUT = 1.0
+
+
+class WorkQueue:
+    """有界队列 + worker 池。给出 key 时按 key 分片：同一 key（如 chat_id）内严格 FIFO、同一时刻只有一个在处理，
+    不同 key 之间由 workers 个线程并行处理（workers 即全局并发上限）。"""
+
+    def __init__(self, handler, workers: int = DEFAULT_WORKERS, maxsize: int = DEFAULT_QUEUE_SIZE, name: str = "lark", key=None):
+        self.handler = handler
+        self.name = name
+        self.maxsize = maxsize
+        self.key = key
+        self._cond = threading.Condition()
+        self._shards = {}  # key -> deque[(enqueued_at, item)]
+        self._ready = deque()  # 有待处理项且当前无人处理的 key
+        self._active = set()
+        self._size = 0
+        self._unfinished = 0
+        self._stopped = False
+        self._submitted = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._overflowed = 0
+        self._blocked = 0
+        self._last_lag = 0.0
+        self._max_lag = 0.0
+        self._lag_sum = 0.0
+        self._last_lag_warn = 0.0
+        self._threads = []
+        self._retire = 0  # 待退出的 worker 数
+        self._spawned = 0
+        for _ in range(max(1, workers)):
+            self._spawn()
+
+    def _spawn(self):
+        t = threading.Thread(target=self._worker, name=f"{self.name}-worker-{self._spawned}", daemon=True)
+        self._spawned += 1
+        t.start()
+        self._threads.append(t)
+
+    @property
+    def workers(self) -> int:
+        with self._cond:
+            return len(self._threads) - self._retire
+
+    def resize(self, workers: int):
+        """调整 worker 数（至少 1）；减少时空闲或处理完当前一条的 worker 退出"""
+        workers = max(1, workers)
+        with self._cond:
+            alive = len(self._threads) - self._retire
+            if workers < alive:
+                self._retire += alive - workers
+                self._cond.notify_all()
+                return
+            revived = min(self._retire, workers - alive)
+            self._retire -= revived
+            for _ in range(workers - alive - revived):
+                self._spawn()
+
+    def submit(self, item, block: bool = False, timeout: float = None, overflow: bool = False) -> bool:
+        """入队；队列已满时 block=False 返回 False，block=True 等到有空位（用于补拉等可以慢下来的生产者），
+        给出 timeout 时最多等这么久，仍满则返回 False。overflow=True 时不等待、越过上限入队（总是返回 True）"""
+        k = self.key(item) if self.key else object()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._size >= self.maxsize and not overflow:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or self._stopped or (remaining is not None and remaining <= 0):
+                    self._rejected += 1
+                    return False
+                self._blocked += 1
+                self._cond.wait(remaining)
+                self._blocked -= 1
+            if self._size >= self.maxsize:
+                self._overflowed += 1
+            shard = self._shards.get(k)
+            if shard is None:
+                shard = self._shards[k] = deque()
+            shard.append((time.monotonic(), item))
+            if len(shard) == 1 and k not in self._active:
+                self._ready.append(k)
+            self._size += 1
+            self._unfinished += 1
+            self._submitted += 1
+            # 有阻塞的生产者在等同一个条件变量时，单个 notify 可能叫醒的不是 worker
+            self._cond.notify_all() if self._blocked else self._cond.notify()
+        return True
+
+    def depth(self) -> int:
+        with self._cond:
+            return self._size
+
+    def join(self):
+        """等待已入队的任务全部处理完"""
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
+
+    def stop(self):
+        """处理完已入队的任务后停止 worker"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for t in list(self._threads):
+            t.join(timeout=5)
+
+    def stats(self) -> dict:
+        with self._cond:
+            done = self._processed + self._failed
+            return {
+                "depth": self._size,
+                "maxsize": self.maxsize,
+                "workers": len(self._threads) - self._retire,
+                "busy": len(self._active),
+                "shards": len(self._shards) if self.key else None,
+                "submitted": self._submitted,
+                "processed": self._processed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "overflowed": self._overflowed,
+                "last_lag": round(self._last_lag, 3),
+                "max_lag": round(self._max_lag, 3),
+                "avg_lag": round(self._lag_sum / done, 3) if done else 0.0,
+            }
+
+    def _take(self):
+        with self._cond:
+            while True:
+                if self._retire:
+                    self._retire -= 1
+                    self._threads.remove(threading.current_thread())
+                    if self._ready:
+                        # 叫醒本该由自己处理的那条的通知转给别的 worker
+                        self._cond.notify()
+                    return None, None, None
+                if self._ready:
+                    break
+                if self._stopped:
+                    return None, None, None
+                self._cond.wait()
+            k = self._ready.popleft()
+            enqueued_at, item = self._shards[k].popleft()
+            self._size -= 1
+            if self._blocked:
+                self._cond.notify_all()
+            self._active.add(k)
+            lag = time.monotonic() - enqueued_at
+            self._last_lag = lag
+            self._max_lag = max(self._max_lag, lag)
+            self._lag_sum += lag
+            return k, item, lag
+
+    def _done(self, k, ok: bool):
+        with self._cond:
+            self._active.discard(k)
+            if self._shards.get(k):
+                self._ready.append(k)
+                self._cond.notify()
+            else:
+                self._shards.pop(k, None)
+            if ok:
+                self._processed += 1
+            else:
+                self._failed += 1
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            k, item, lag = self._take()
+            if lag is None:
+                return
+            # 积压时每条都会超阈值，告警最多每 LAG_WARN_SECONDS 秒打印一次
+            if lag >= LAG_WARN_SECONDS and time.monotonic() - self._last_lag_warn >= LAG_WARN_SECONDS:
+                self._last_lag_warn = time.monotonic()
+                print(f"[{_ts()}] 队列 {self.name} 排队延迟 {lag:.1f}s，深度 {self.depth()}", file=sys.stderr)
+            ok = True
+            try:
+                self.handler(item)
+            except Exception as e:
+                ok = False
+                print(f"[{_ts()}] 队列 {self.name} 处理失败: {e}", file=sys.stderr)
+            finally:
+                self._done(k, ok)
+
+
+def start_stats_reporter(work_queue: WorkQueue, interval: float = 60.0, extra=None):
+    """后台线程定期打印队列统计；interval <= 0 时不启动。extra() 返回的字符串附在统计后面"""
+    if interval <= 0:
+        return None
+
+    def _loop():
+        last = None
+        while True:
+            time.sleep(interval)
+            s = work_queue.stats()
+            snapshot = (s["submitted"], s["processed"], s["failed"], s["depth"])
+            if snapshot == last:
+                continue
+            last = snapshot
+            print(
+                f"[{_ts()}] 队列 {work_queue.name}: 深度={s['depth']}/{s['maxsize']} 处理中={s['busy']} 会话={s['shards']} "
+                f"已处理={s['processed']} 失败={s['failed']} 拒绝={s['rejected']} "
+                f"排队延迟 last={s['last_lag']}s max={s['max_lag']}s avg={s['avg_lag']}s"
+                + (f" {extra()}" if extra else "")
+            )
+
+    t = threading.Thread(target=_loop, name=f"{work_queue.name}-stats", daemon=True)
+    t.start()
+    return t
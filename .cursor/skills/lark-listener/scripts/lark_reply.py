@@ -6,6 +6,18 @@
   python lark_reply.py <message_id> --file reply.txt
   python lark_reply.py <message_id> "回复" --mark-done --workspace D:\\proj
   echo 回复内容 | python lark_reply.py <message_id> -
+  python lark_reply.py --batch replies.jsonl --mark-done --workspace D:\\proj
+  python lark_reply.py --flush-outbox --workspace D:\\proj
+  python lark_reply.py --status om_a om_b --workspace D:\\proj        # 批量查询回复状态（JSON），不用重读 lark-pending.md
+  python lark_reply.py <message_id> --stream agent-tasks/reply-stream-<message_id>.txt --mark-done   # 边写边发（启动时清空该文件）
+
+批量模式：replies.jsonl 每行一个 {"message_id": "om_xxx", "text": "回复"}（或 "file": "相对当前目录的路径"），
+复用同一个 keep-alive Session 并发发送，全部发完后一次性标记已回复，逐条结果以 JSON 输出到 stdout。
+
+发送经 lark_sender 限流并对 429/5xx 退避重试；重试用尽的回复进入 lark-pending.db 的 outbox（退出码 2），
+由监听进程定期或 --flush-outbox 重发，成功后自动标记已回复。超过单条上限的回复自动切成多条发送。
+
+流式模式（--stream）：先回复一条，随后把文件新增内容不断编辑进去，超长或编辑次数用完时另起一条，见 lark_stream.py。
 
 配置：从 lark-config.json 或环境变量 APP_ID、APP_SECRET 读取。
 """
@@ -13,8 +25,8 @@
 import argparse
 import json
 import os
-import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import requests
@@ -22,98 +34,193 @@ except ImportError:
     print("请先安装: pip install requests", file=sys.stderr)
     sys.exit(1)
 
-CONFIG_FILENAME = "lark-config.json"
-MARK_REPLIED = "**[已回复]**"
+from lark_common import domain_host as _domain_host
+from lark_common import resolve_credentials
+from lark_config import load_config
+from lark_store import PendingStore
+from lark_stream import DEFAULT_INTERVAL, stream_reply
+from lark_sender import SendError, get_sender
+from lark_token import get_token_cache
 
+BATCH_CONCURRENCY = 4
 
-def _load_config(workspace_dir):
-    for d in (workspace_dir, os.getcwd(), os.path.dirname(os.path.abspath(__file__))):
-        path = os.path.join(d, CONFIG_FILENAME)
-        if os.path.isfile(path):
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                if isinstance(data, dict):
-                    return data
-            except Exception:
-                pass
-    return {}
+
+def get_tenant_access_token(app_id: str, app_secret: str, domain_host: str, workspace: str = None) -> str:
+    """取 tenant_access_token（带缓存，给出 workspace 时跨进程复用 agent-tasks/lark-token.json）"""
+    return get_token_cache(app_id, app_secret, domain_host, workspace).get()
+
+
+def reply(message_id: str, content_text: str, app_id: str, app_secret: str, domain_key: str = "feishu", workspace: str = None,
+          session=None, chat_id: str = "", mark_done: bool = False) -> bool:
+    """经 lark_sender 发送（限流、退避重试、uuid 幂等）；失败抛 SendError，queued=True 表示已进入重试队列"""
+    workspace = workspace or os.getcwd()
+    sender = get_sender(app_id, app_secret, _domain_host(domain_key), workspace)
+    sender.send(message_id, content_text, chat_id=chat_id, session=session, mark_done=mark_done)
+    return True
 
 
-def _domain_host(domain_key):
-    if domain_key in ("lark", "larksuite"):
-        return "https://open.larksuite.com"
-    return "https://open.feishu.cn"
+def make_session(pool_size: int = BATCH_CONCURRENCY):
+    """keep-alive Session，连接池大小与并发数一致，避免每条回复重新握手"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 
-def get_tenant_access_token(app_id: str, app_secret: str, domain_host: str) -> str:
-    url = f"{domain_host}/open-apis/auth/v3/tenant_access_token/internal"
-    r = requests.post(url, json={"app_id": app_id, "app_secret": app_secret}, timeout=10)
-    r.raise_for_status()
-    data = r.json()
-    if data.get("code") != 0:
-        raise RuntimeError(data.get("msg", "获取 tenant_access_token 失败"))
-    return data["tenant_access_token"]
+def load_batch(path: str) -> list:
+    """读取 JSONL 批量回复文件；path 为 - 时从 stdin 读取"""
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    items = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            items.append({"message_id": "", "text": "", "error": f"第 {lineno} 行不是合法 JSON: {e}"})
+            continue
+        text = item.get("text") or item.get("content") or ""
+        if not text and item.get("file"):
+            try:
+                with open(item["file"], "r", encoding="utf-8") as f:
+                    text = f.read()
+            except OSError as e:
+                items.append({"message_id": item.get("message_id", ""), "text": "", "error": str(e)})
+                continue
+        items.append({"message_id": (item.get("message_id") or "").strip(), "text": text.strip()})
+    return items
 
 
-def reply(message_id: str, content_text: str, app_id: str, app_secret: str, domain_key: str = "feishu", workspace: str = None) -> bool:
+def reply_batch(items: list, app_id: str, app_secret: str, domain_key: str = "feishu", workspace: str = None,
+                mark_done: bool = False, concurrency: int = BATCH_CONCURRENCY) -> list:
+    """并发发送一批回复，返回逐条结果；mark_done 时成功的条目一次性写回 lark-pending.md"""
     workspace = workspace or os.getcwd()
-    host = _domain_host(domain_key)
-    token = get_tenant_access_token(app_id, app_secret, host)
-    url = f"{host}/open-apis/im/v1/messages/{message_id}/reply"
-    body = {
-        "content": json.dumps({"text": content_text}, ensure_ascii=False),
-        "msg_type": "text",
-    }
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    r = requests.post(url, json=body, headers=headers, timeout=10)
-    r.raise_for_status()
-    data = r.json()
-    if data.get("code") != 0:
-        raise RuntimeError(data.get("msg", "回复失败"))
-    return True
+    results = [None] * len(items)
+    todo = []
+    seen = set()
+    with PendingStore(workspace) as store:
+        for i, item in enumerate(items):
+            mid = item.get("message_id", "")
+            if item.get("error") or not mid or not item.get("text"):
+                results[i] = {"message_id": mid, "ok": False, "error": item.get("error") or ("缺少 message_id" if not mid else "回复内容为空")}
+            elif mid in seen or store.is_replied(mid) or store.outbox_pending(mid):
+                results[i] = {"message_id": mid, "ok": True, "skipped": True}
+            else:
+                seen.add(mid)
+                todo.append(i)
 
+        session = make_session(concurrency)
 
-def mark_replied_in_pending(workspace: str, message_id: str):
-    """在 lark-pending.md 中标记该 message_id 已回复"""
-    path = os.path.join(workspace, "agent-tasks", "lark-pending.md")
-    if not os.path.isfile(path):
-        return
-    with open(path, "r", encoding="utf-8") as f:
-        content = f.read()
-    if f"message_id: {message_id}" not in content or MARK_REPLIED in content:
-        return
-    parts = re.split(r"(\n---+\n)", content)
-    for i in range(0, len(parts), 2):
-        block = parts[i]
-        if f"message_id: {message_id}" not in block or MARK_REPLIED in block:
-            continue
-        parts[i] = block.rstrip() + f"\n{MARK_REPLIED}\n"
-        break
-    with open(path, "w", encoding="utf-8") as f:
-        f.write("".join(parts))
+        def _send(i):
+            mid = items[i]["message_id"]
+            try:
+                reply(mid, items[i]["text"], app_id, app_secret, domain_key=domain_key, workspace=workspace, session=session,
+                      mark_done=mark_done)
+                return {"message_id": mid, "ok": True}
+            except SendError as e:
+                return {"message_id": mid, "ok": False, "queued": e.queued, "error": str(e)}
+            except Exception as e:
+                return {"message_id": mid, "ok": False, "error": str(e)}
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+                for i, res in zip(todo, pool.map(_send, todo)):
+                    results[i] = res
+        finally:
+            session.close()
+
+        if mark_done:
+            store.mark_replied_many([r["message_id"] for r in results if r["ok"] and not r.get("skipped")])
+    return results
+
+
+def mark_replied_in_pending(workspace: str, message_id: str) -> bool:
+    """在待办库中标记该 message_id 已回复，并刷新 lark-pending.md"""
+    with PendingStore(workspace) as store:
+        return store.mark_replied(message_id)
 
 
 def main():
     parser = argparse.ArgumentParser(description="按 message_id 回复飞书消息")
-    parser.add_argument("message_id", help="要回复的消息 ID（om_ 开头）")
+    parser.add_argument("message_id", nargs="?", default="", help="要回复的消息 ID（om_ 开头）")
     parser.add_argument("content", nargs="?", default="", help="回复正文；若为 - 则从 stdin 读取")
     parser.add_argument("--file", "-f", default="", help="从文件读取回复内容")
     parser.add_argument("--workspace", default=os.getcwd(), help="项目根目录")
     parser.add_argument("--mark-done", action="store_true", help="发送后在 lark-pending.md 标记已回复")
+    parser.add_argument("--batch", default="", help="批量模式：JSONL 文件（- 为 stdin），每行 message_id + text/file")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="批量模式并发数")
+    parser.add_argument("--stream", default="", help="流式回复：先清空该文件再边读边发（- 为 stdin），写入 <<<END>>> 行或停止写入后结束")
+    parser.add_argument("--stream-interval", type=float, default=DEFAULT_INTERVAL, help="流式回复的更新间隔秒数")
+    parser.add_argument("--flush-outbox", action="store_true", help="重发重试队列（outbox）中到期的回复")
+    parser.add_argument("--status", nargs="+", default=[], metavar="MESSAGE_ID",
+                        help="查询这些消息的回复状态：pending / queued（在重试队列）/ replied / archived / unknown")
     parser.add_argument("--app-id", default="", help="覆盖配置的 App ID")
     parser.add_argument("--app-secret", default="", help="覆盖配置的 App Secret")
     args = parser.parse_args()
 
-    cfg = _load_config(args.workspace)
-    app_id = args.app_id or os.environ.get("APP_ID") or cfg.get("app_id", "")
-    app_secret = args.app_secret or os.environ.get("APP_SECRET") or cfg.get("app_secret", "")
-    domain_key = (cfg.get("domain") or "feishu").lower()
+    if args.status:
+        # 只查库，不需要凭据
+        with PendingStore(args.workspace) as store:
+            print(json.dumps(store.status_many(args.status), ensure_ascii=False, indent=2))
+        sys.exit(0)
+
+    app_id, app_secret, domain_key = resolve_credentials(args, load_config(args.workspace))
 
     if not app_id or not app_secret:
         print("请配置 app_id 与 app_secret（lark-config.json 或环境变量）", file=sys.stderr)
         sys.exit(1)
 
+    if args.flush_outbox:
+        result = get_sender(app_id, app_secret, _domain_host(domain_key), args.workspace).flush_outbox(limit=1000)
+        print(json.dumps(result, ensure_ascii=False))
+        sys.exit(0 if not result["failed"] else 1)
+
+    if args.batch:
+        results = reply_batch(
+            load_batch(args.batch),
+            app_id,
+            app_secret,
+            domain_key=domain_key,
+            workspace=args.workspace,
+            mark_done=args.mark_done,
+            concurrency=args.concurrency,
+        )
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        sys.exit(0 if all(r["ok"] for r in results) else 1)
+
+    if not args.message_id:
+        parser.error("需要 message_id 或 --batch")
+
+    # 幂等：若该 message_id 已标记已回复则跳过（按主键查询，不读整个 md）
+    with PendingStore(args.workspace) as store:
+        if store.is_replied(args.message_id):
+            print("INFO: 该消息已回复，跳过", args.message_id)
+            sys.exit(0)
+        if store.outbox_pending(args.message_id):
+            print("INFO: 该消息的回复已在重试队列中，跳过", args.message_id)
+            sys.exit(0)
+
+    if args.stream:
+        sender = get_sender(app_id, app_secret, _domain_host(domain_key), args.workspace)
+        try:
+            stream = stream_reply(sender, args.message_id, args.stream, interval=args.stream_interval)
+        except SendError as e:
+            print("ERROR:", e, file=sys.stderr)
+            sys.exit(1)
+        if not stream.sent_ids:
+            print("回复内容为空", file=sys.stderr)
+            sys.exit(1)
+        if args.mark_done:
+            mark_replied_in_pending(args.workspace, args.message_id)
+        print("INFO: 流式回复完成", args.message_id, f"共 {len(stream.sent_ids)} 条")
+        sys.exit(0)
+
     if args.file:
         with open(args.file, "r", encoding="utf-8") as f:
             content_text = f.read().strip()
@@ -126,19 +233,6 @@ def main():
         print("回复内容为空", file=sys.stderr)
         sys.exit(1)
 
-    # 幂等：若该 message_id 的块已有 已回复 则跳过
-    pending_path = os.path.join(args.workspace, "agent-tasks", "lark-pending.md")
-    if os.path.isfile(pending_path):
-        with open(pending_path, "r", encoding="utf-8") as f:
-            raw = f.read()
-        idx = raw.find(f"message_id: {args.message_id}")
-        if idx >= 0:
-            next_sep = raw.find("\n---", idx + 10)
-            block = raw[idx : next_sep if next_sep >= 0 else len(raw)]
-            if "**[已回复]**" in block:
-                print("INFO: 该消息已回复，跳过", args.message_id)
-                sys.exit(0)
-
     try:
         reply(
             args.message_id,
@@ -147,10 +241,15 @@ def main():
             app_secret,
             domain_key=domain_key,
             workspace=args.workspace,
+            mark_done=args.mark_done,
         )
         if args.mark_done:
             mark_replied_in_pending(args.workspace, args.message_id)
         print("INFO: 回复成功", args.message_id)
+    except SendError as e:
+        print("ERROR:", e, file=sys.stderr)
+        # 已进入重试队列：由监听进程或 --flush-outbox 重发，成功后自动标记已回复
+        sys.exit(2 if e.queued else 1)
     except Exception as e:
         print("ERROR:", e, file=sys.stderr)
         sys.exit(1)
@@ -0,0 +1,186 @@
+"""
+消息附件的按需下载与本地缓存：监听只把图片/文件的 key 写进待办，Agent 需要看时再下载，不拖慢收消息。
+
+- GET /open-apis/im/v1/messages/{message_id}/resources/{file_key}?type=image|file（图片用 image，文件/语音/视频用 file）
+- 内容寻址：文件按 sha256 存在 agent-tasks/lark-resources/ 下，同样的内容（转发、重复发送）只占一份；
+  file_key → 文件 的索引记在 lark-pending.db 的 resources 表，已下载过的 key 直接返回本地路径
+- 同一个 key 同时只下载一次：进程内按 key 加锁，跨进程用 .locks/<key>.lock 文件锁，后到的等前者下载完直接命中缓存
+- 缓存总大小超过 max_bytes 时按最近使用时间淘汰（默认 DEFAULT_MAX_MB），刚下载的不会被淘汰
+- 下载走 lark_sender 的限流与退避重试
+
+用法:
+  python lark_resource.py om_xxx img_v3_xxx --workspace D:\\proj          # 输出本地文件路径
+  python lark_resource.py om_xxx file_v3_xxx --name 报告.pdf --workspace D:\\proj
+  python lark_resource.py --stats --workspace D:\\proj
+  from lark_resource import ResourceCache
+  path = ResourceCache(workspace, sender).fetch(message_id, file_key)
+"""
+
+import argparse
+import hashlib
+import mimetypes
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from lark_common import domain_host, resolve_credentials
+from lark_config import load_config
+from lark_filelock import FileLock, _replace
+from lark_metrics import counter, histogram
+from lark_sender import SendError, get_sender
+from lark_store import PendingStore, task_dir
+
+RESOURCE_DIRNAME = "lark-resources"
+DEFAULT_MAX_MB = 512
+_SAFE_EXT_RE = re.compile(r"^\.[A-Za-z0-9]{1,8}$")
+
+RESOURCE_REQUESTS = counter("lark_resource_requests_total", "附件请求次数：result=hit 缓存命中 / download 下载 / failed 失败")
+RESOURCE_BYTES = counter("lark_resource_download_bytes_total", "附件下载字节数")
+RESOURCE_SECONDS = histogram("lark_resource_download_seconds", "单个附件下载耗时")
+
+
+def resource_type(file_key: str, kind: str = "") -> str:
+    """接口的 type 参数：图片为 image，文件/语音/视频为 file；未给出时按 key 前缀判断"""
+    if kind in ("image", "file"):
+        return kind
+    return "image" if file_key.startswith("img_") else "file"
+
+
+def _ext(name: str, content_type: str) -> str:
+    ext = os.path.splitext(name or "")[1].lower()
+    if not _SAFE_EXT_RE.match(ext):
+        ext = mimetypes.guess_extension((content_type or "").split(";")[0].strip()) or ""
+    return ext if _SAFE_EXT_RE.match(ext) else ""
+
+
+class ResourceCache:
+    def __init__(self, workspace: str, sender, store: PendingStore = None, max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024):
+        self.dir = os.path.join(task_dir(workspace), RESOURCE_DIRNAME)
+        self.lock_dir = os.path.join(self.dir, ".locks")
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.sender = sender
+        self.store = store or PendingStore(workspace)
+        self.max_bytes = max_bytes
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def _key_lock(self, file_key: str) -> FileLock:
+        with self._locks_guard:
+            lock = self._locks.get(file_key)
+            if lock is None:
+                safe = re.sub(r"[^A-Za-z0-9_.-]", "_", file_key)
+                lock = self._locks[file_key] = FileLock(os.path.join(self.lock_dir, safe + ".lock"), timeout=300)
+            return lock
+
+    def lookup(self, file_key: str):
+        """已缓存时返回本地路径（并刷新最近使用时间），否则返回 None"""
+        row = self.store.resource_get(file_key)
+        if row is None:
+            return None
+        path = os.path.join(self.dir, row["filename"])
+        return path if os.path.isfile(path) else None
+
+    def fetch(self, message_id: str, file_key: str, kind: str = "", name: str = "") -> str:
+        """返回附件的本地路径，未缓存时下载；失败抛出 SendError"""
+        path = self.lookup(file_key)
+        if path:
+            RESOURCE_REQUESTS.inc(result="hit")
+            return path
+        with self._key_lock(file_key):
+            # 等锁期间可能已被别的线程/进程下载好
+            path = self.lookup(file_key)
+            if path:
+                RESOURCE_REQUESTS.inc(result="hit")
+                return path
+            try:
+                path = self._download(message_id, file_key, kind, name)
+            except SendError:
+                RESOURCE_REQUESTS.inc(result="failed")
+                raise
+            RESOURCE_REQUESTS.inc(result="download")
+            return path
+
+    def _download(self, message_id: str, file_key: str, kind: str, name: str) -> str:
+        t0 = time.perf_counter()
+        fd, tmp = tempfile.mkstemp(dir=self.dir, prefix=".dl-")
+        try:
+            with os.fdopen(fd, "w+b") as f:
+                headers = self.sender.download(f"/open-apis/im/v1/messages/{message_id}/resources/{file_key}", f,
+                                               params={"type": resource_type(file_key, kind)})
+                f.flush()
+                os.fsync(f.fileno())
+                f.seek(0)
+                h = hashlib.sha256()
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+                size = f.tell()
+            sha = h.hexdigest()
+            filename = sha + _ext(name, headers.get("Content-Type", ""))
+            path = os.path.join(self.dir, filename)
+            if os.path.isfile(path):
+                # 同样的内容已经有了（转发/重复发送），只记索引
+                os.remove(tmp)
+            else:
+                _replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.store.resource_put(file_key, message_id, sha, size, filename)
+        RESOURCE_BYTES.inc(size)
+        RESOURCE_SECONDS.observe(time.perf_counter() - t0)
+        self.evict(keep=sha)
+        return path
+
+    def evict(self, keep: str = "") -> int:
+        """缓存超过 max_bytes 时按最近使用时间删除文件，返回删除的文件数"""
+        removed = self.store.resource_evict(self.max_bytes, keep=keep)
+        for filename in removed:
+            try:
+                os.remove(os.path.join(self.dir, filename))
+            except OSError:
+                pass
+        return len(removed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="下载飞书消息中的图片/文件（带本地缓存），输出本地路径")
+    parser.add_argument("message_id", nargs="?", help="附件所在消息的 message_id")
+    parser.add_argument("file_keys", nargs="*", help="image_key / file_key，可多个")
+    parser.add_argument("--workspace", default=os.getcwd(), help="项目根目录")
+    parser.add_argument("--type", default="", choices=["", "image", "file"], help="资源类型（默认按 key 前缀判断）")
+    parser.add_argument("--name", default="", help="原文件名，用于确定扩展名")
+    parser.add_argument("--max-mb", type=int, default=DEFAULT_MAX_MB, help="缓存总大小上限（MB）")
+    parser.add_argument("--stats", action="store_true", help="只输出缓存统计")
+    parser.add_argument("--app-id", default="")
+    parser.add_argument("--app-secret", default="")
+    args = parser.parse_args()
+
+    if args.stats:
+        with PendingStore(args.workspace) as store:
+            print(store.resource_stats())
+        return
+    if not args.message_id or not args.file_keys:
+        parser.error("需要 message_id 和至少一个 file_key")
+
+    app_id, app_secret, domain_key = resolve_credentials(args, load_config(args.workspace))
+    if not app_id or not app_secret:
+        print("请配置 app_id 与 app_secret（lark-config.json 或环境变量 APP_ID/APP_SECRET）", file=sys.stderr)
+        sys.exit(1)
+    sender = get_sender(app_id, app_secret, domain_host(domain_key), args.workspace)
+    cache = ResourceCache(args.workspace, sender, max_bytes=args.max_mb * 1024 * 1024)
+    failed = False
+    for key in args.file_keys:
+        try:
+            print(cache.fetch(args.message_id, key, kind=args.type, name=args.name))
+        except SendError as e:
+            failed = True
+            print(f"下载失败 {key}: {e}", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
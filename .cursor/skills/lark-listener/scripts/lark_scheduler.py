@@ -0,0 +1,166 @@
+"""
+无头 Agent 启动调度：合并突发消息、保证尾随启动、限制并发、Agent 退出后仍有未回复则自动再启动。
+
+- notify()：有新消息时调用，debounce 秒内的多条消息只触发一次启动
+- 冷却期内到达的消息不会被丢掉，冷却结束后补一次（trailing run）
+- 跟踪已启动进程，同一时间只运行一个 Agent：每个 Agent 都读整个 lark-pending.md、处理同一批未回复消息，
+  多个同时运行会重复回复；需要并发请用 lark_workers.AgentWorkerPool（--agent-workers）
+- Agent 退出时若 has_pending() 仍为真则再次调度；连续多次无进展则停止自动重试，等下一条新消息
+- configure() 运行中调整 debounce / cooldown（lark-config.json 热更新）
+"""
+
+import sys
+import threading
+import time
+
+from lark_common import _ts
+from lark_metrics import counter, gauge, log_event
+
+DEFAULT_DEBOUNCE = 2.0
+DEFAULT_COOLDOWN = 15.0
+# 整文件模式下并发 Agent 会拿到同一批消息，只能串行
+MAX_RUNNING = 1
+# Agent 连续这么多次退出后未回复数都没有减少，则不再自动重启
+MAX_NO_PROGRESS = 3
+POLL_INTERVAL = 1.0
+
+AGENT_SPAWNS = counter("lark_agent_spawns_total", "启动的无头 Agent 进程，result=ok/error")
+AGENT_EXITS = counter("lark_agent_exits_total", "退出的无头 Agent 进程")
+COALESCED = counter("lark_agent_coalesced_total", "被合并进已排队启动的消息通知")
+COOLDOWN_SKIPS = counter("lark_agent_cooldown_skips_total", "冷却期内到达、推迟到冷却结束后尾随启动的通知")
+AGENTS_RUNNING = gauge("lark_agents_running", "正在运行的无头 Agent 数")
+
+
+class AgentScheduler:
+    def __init__(self, spawn, has_pending=None, pending_count=None, debounce: float = DEFAULT_DEBOUNCE,
+                 cooldown: float = DEFAULT_COOLDOWN):
+        """
+        spawn: 无参函数，启动 Agent 并返回 subprocess.Popen（失败返回 None）
+        has_pending: 无参函数，返回是否仍有未回复消息
+        pending_count: 可选，返回未回复条数，用于判断 Agent 是否有进展
+        """
+        self.spawn = spawn
+        self.has_pending = has_pending or (lambda: False)
+        self.pending_count = pending_count
+        self.debounce = debounce
+        self.cooldown = cooldown
+        self.spawn_count = 0
+        self.coalesced_count = 0
+        self._cond = threading.Condition()
+        self._pending = False
+        self._last_notify = 0.0
+        self._last_spawn = 0.0
+        self._no_progress = 0
+        self._running = []  # [(proc, pending_count_at_start)]
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="agent-scheduler", daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        """有新消息到达"""
+        with self._cond:
+            if self._pending:
+                self.coalesced_count += 1
+                COALESCED.inc()
+            if self._last_spawn and time.monotonic() < self._last_spawn + self.cooldown:
+                COOLDOWN_SKIPS.inc()
+            self._pending = True
+            self._no_progress = 0
+            self._last_notify = time.monotonic()
+            self._cond.notify()
+
+    def configure(self, debounce: float = None, cooldown: float = None):
+        """运行中调整参数，None 表示不变；新的等待时间立即生效"""
+        with self._cond:
+            if debounce is not None:
+                self.debounce = debounce
+            if cooldown is not None:
+                self.cooldown = cooldown
+            self._cond.notify()
+
+    def running_pids(self) -> list:
+        with self._cond:
+            return [p.pid for p, _ in self._running]
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "running": len(self._running),
+                "pids": [p.pid for p, _ in self._running],
+                "pending": self._pending,
+                "spawned": self.spawn_count,
+                "coalesced": self.coalesced_count,
+            }
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+
+    def _count(self):
+        if self.pending_count is None:
+            return None
+        try:
+            return self.pending_count()
+        except Exception:
+            return None
+
+    def _reap(self):
+        still = []
+        for proc, count_at_start in self._running:
+            code = proc.poll()
+            if code is None:
+                still.append((proc, count_at_start))
+                continue
+            print(f"[{_ts()}] 无头 Agent 已退出 pid={proc.pid} code={code}")
+            AGENT_EXITS.inc()
+            log_event("agent_exit", pid=proc.pid, code=code)
+            try:
+                pending = self.has_pending()
+            except Exception:
+                pending = False
+            if not pending:
+                self._no_progress = 0
+                continue
+            count_now = self._count()
+            if count_at_start is not None and count_now is not None and count_now >= count_at_start:
+                self._no_progress += 1
+            else:
+                self._no_progress = 0
+            if self._no_progress >= MAX_NO_PROGRESS:
+                print(f"[{_ts()}] Agent 连续 {self._no_progress} 次无进展，暂停自动重启，等待新消息", file=sys.stderr)
+                continue
+            print(f"[{_ts()}] 仍有未回复消息，重新调度 Agent")
+            self._pending = True
+        self._running = still
+
+    def _loop(self):
+        with self._cond:
+            while not self._stopped:
+                self._reap()
+                now = time.monotonic()
+                timeout = POLL_INTERVAL if self._running else None
+                if self._pending and len(self._running) < MAX_RUNNING:
+                    due = max(self._last_notify + self.debounce, self._last_spawn + self.cooldown)
+                    if now >= due:
+                        self._pending = False
+                        self._last_spawn = now
+                        count = self._count()
+                        self._cond.release()
+                        try:
+                            proc = self.spawn()
+                        except Exception as e:
+                            proc = None
+                            print(f"[{_ts()}] 启动 Agent 失败: {e}", file=sys.stderr)
+                        finally:
+                            self._cond.acquire()
+                        AGENT_SPAWNS.inc(result="ok" if proc is not None else "error")
+                        if proc is not None:
+                            self.spawn_count += 1
+                            self._running.append((proc, count))
+                            log_event("agent_spawn", pid=proc.pid, pending=count)
+                        AGENTS_RUNNING.set(len(self._running))
+                        continue
+                    timeout = due - now if timeout is None else min(timeout, due - now)
+                self._cond.wait(timeout)
@@ -0,0 +1,414 @@
+"""
+飞书回复发送器：限流 + 退避重试 + 幂等 + 持久化重试队列，lark_reply.py 与监听 ack 共用。
+
+- 令牌桶限流：全局 DEFAULT_RATE 次/秒，同一 chat_id 额外 DEFAULT_CHAT_RATE 次/秒（飞书回复接口的应用级 / 会话级频控），
+  突发时排队等令牌而不是撞上 429
+- HTTP 429 / 5xx、网络错误、飞书频控 code 视为可重试，按指数退避 + 全抖动重试；有 x-ogw-ratelimit-reset 时按它等待
+- 请求体带 uuid（由 message_id + 回复内容算出，固定不变），重试或另一个进程重发同一条回复时飞书侧去重，不会发出两条
+- 重试用尽仍是可重试错误的，写入 lark-pending.db 的 outbox 表，flush_outbox() 稍后重发；参数错误、消息已撤回等直接失败
+- 超过 DEFAULT_CHUNK_BYTES 的回复按段落/行自动切成多条依次发送；edit() 编辑已发出的消息（流式回复用，见 lark_stream.py）
+- request() / download() 以同样的限流与重试调用其他接口（补拉历史消息见 lark_backfill.py，下载附件见 lark_resource.py）
+
+用法:
+  from lark_sender import get_sender
+  get_sender(app_id, app_secret, host, workspace).send(message_id, "回复")
+"""
+
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+
+import requests
+
+from lark_common import _ts
+from lark_metrics import counter, histogram, log_event
+from lark_token import authorized_request, get_token_cache, is_invalid_token_response
+
+# 飞书「回复消息」接口：应用 50 次/秒；向同一用户/群 5 次/秒
+DEFAULT_RATE = 50.0
+DEFAULT_CHAT_RATE = 5.0
+MAX_ATTEMPTS = 4
+# 单条文本消息的安全上限（飞书请求体上限 150KB，content 是 JSON 转义后的字符串，留足余量）
+DEFAULT_CHUNK_BYTES = 16 * 1024
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+# outbox 重发：最多尝试次数与最长间隔
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_BACKOFF_MAX = 600.0
+# 飞书频控相关 code：99991400 应用频控，230020 会话发送频控
+RATE_LIMIT_CODES = (99991400, 230020)
+REQUEST_SECONDS = histogram("lark_send_request_seconds", "单次回复/编辑请求耗时（含限流等待）")
+REPLY_SECONDS = histogram("lark_reply_seconds", "一条回复从开始发送到成功（含重试与退避）的耗时")
+SEND_RESULTS = counter("lark_send_total", "发送结果：result=ok/retry/queued/failed，kind=reply/edit/outbox/其他接口")
+RATE_LIMIT_WAIT = histogram("lark_rate_limit_wait_seconds", "令牌桶限流等待时间")
+_UUID_NS = uuid.UUID("6f1c4a52-8d0e-4b6b-9a3e-2f7d1c9e5b10")
+
+
+class SendError(RuntimeError):
+    def __init__(self, msg: str, retryable: bool = False, retry_after: float = None, queued: bool = False):
+        super().__init__(msg)
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.queued = queued
+
+
+class TokenBucket:
+    """令牌桶：rate 个/秒，容量 burst；acquire() 阻塞到拿到令牌"""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """预占一个令牌，返回需要等待的秒数（令牌可以透支，等待期间别人排在后面）"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def set_rate(self, rate: float):
+        """运行中调整速率，容量随之变为 max(1, rate)；已透支的令牌按新速率补回"""
+        with self._lock:
+            now = time.monotonic()
+            if self.rate > 0:
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self.rate = rate
+            self.burst = max(1.0, rate)
+            self._tokens = min(self._tokens, self.burst)
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        wait = self._reserve()
+        if wait > 0:
+            RATE_LIMIT_WAIT.observe(wait)
+            time.sleep(wait)
+
+
+def reply_uuid(message_id: str, text: str) -> str:
+    """同一条消息的同一回复内容得到同一个 uuid（飞书按 uuid 在 1 小时内去重）"""
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(_UUID_NS, f"{message_id}:{digest}"))
+
+
+def split_text(text: str, limit: int = DEFAULT_CHUNK_BYTES) -> list:
+    """按 UTF-8 字节数切分，优先在空行、换行、空格处断开；各段拼起来等于原文"""
+    if len(text.encode("utf-8")) <= limit:
+        return [text]
+    chunks = []
+    rest = text
+    while len(rest.encode("utf-8")) > limit:
+        # 先按字节上限粗切出候选（不切断多字节字符），再往回找合适的断点
+        head = rest.encode("utf-8")[:limit].decode("utf-8", errors="ignore")
+        cut = 0
+        for sep in ("\n\n", "\n", " "):
+            pos = head.rfind(sep)
+            if pos >= len(head) // 2:
+                cut = pos + len(sep)
+                break
+        cut = cut or len(head)
+        chunks.append(rest[:cut])
+        rest = rest[cut:]
+    if rest:
+        chunks.append(rest)
+    return chunks
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX) -> float:
+    """指数退避 + 全抖动：[0, min(cap, base * 2^attempt)]"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def _classify_http_error(e: requests.HTTPError) -> SendError:
+    r = e.response
+    status = r.status_code if r is not None else 0
+    retry_after = None
+    if r is not None:
+        for h in ("x-ogw-ratelimit-reset", "Retry-After"):
+            try:
+                retry_after = float(r.headers.get(h, ""))
+                break
+            except ValueError:
+                continue
+    try:
+        msg = (r.json() or {}).get("msg") or str(e)
+    except ValueError:
+        msg = str(e)
+    return SendError(f"HTTP {status}: {msg}", retryable=status == 429 or status >= 500, retry_after=retry_after)
+
+
+class LarkSender:
+    def __init__(self, app_id: str, app_secret: str, host: str, workspace: str = None,
+                 rate: float = DEFAULT_RATE, chat_rate: float = DEFAULT_CHAT_RATE, max_attempts: int = MAX_ATTEMPTS,
+                 chunk_bytes: int = DEFAULT_CHUNK_BYTES):
+        self.host = host
+        self.workspace = os.path.abspath(workspace) if workspace else None
+        self.cache = get_token_cache(app_id, app_secret, host, workspace)
+        self.limiter = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.max_attempts = max(1, max_attempts)
+        self.chunk_bytes = chunk_bytes
+        self._chat_buckets = {}
+        self._lock = threading.Lock()
+        self._store = None
+        self.stats = {"sent": 0, "retries": 0, "queued": 0, "failed": 0}
+
+    def _chat_bucket(self, chat_id: str):
+        if not chat_id or self.chat_rate <= 0:
+            return None
+        with self._lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self._chat_buckets) > 10000:
+                    self._chat_buckets.clear()
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+            return bucket
+
+    def set_rates(self, rate: float = None, chat_rate: float = None):
+        """运行中调整全局 / 每会话限流（次/秒，<= 0 不限），配置热更新时调用"""
+        if rate is not None and rate != self.limiter.rate:
+            self.limiter.set_rate(rate)
+        if chat_rate is not None and chat_rate != self.chat_rate:
+            with self._lock:
+                self.chat_rate = chat_rate
+                self._chat_buckets.clear()
+
+    def _outbox(self):
+        if not self.workspace:
+            return None
+        with self._lock:
+            if self._store is None:
+                from lark_store import PendingStore
+
+                self._store = PendingStore(self.workspace)
+            return self._store
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _request_once(self, method: str, url: str, body: dict, chat_id: str = "", session=None) -> dict:
+        t0 = time.perf_counter()
+        bucket = self._chat_bucket(chat_id)
+        if bucket:
+            bucket.acquire()
+        self.limiter.acquire()
+        try:
+            data = authorized_request(self.cache, method, url, body, session=session)
+            REQUEST_SECONDS.observe(time.perf_counter() - t0, method=method)
+        except requests.HTTPError as e:
+            raise _classify_http_error(e) from e
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise SendError(f"网络错误: {e}", retryable=True) from e
+        code = data.get("code")
+        if code != 0:
+            raise SendError(f"code={code} {data.get('msg', '请求失败')}", retryable=code in RATE_LIMIT_CODES)
+        return data
+
+    def _post_once(self, message_id: str, text: str, uid: str, chat_id: str = "", session=None) -> dict:
+        url = f"{self.host}/open-apis/im/v1/messages/{message_id}/reply"
+        body = {"content": json.dumps({"text": text}, ensure_ascii=False), "msg_type": "text", "uuid": uid}
+        return self._request_once("POST", url, body, chat_id, session)
+
+    def _with_retry(self, fn, kind: str = "reply"):
+        for attempt in range(self.max_attempts):
+            try:
+                return fn()
+            except SendError as e:
+                if not e.retryable or attempt == self.max_attempts - 1:
+                    raise
+                self._count("retries")
+                SEND_RESULTS.inc(result="retry", kind=kind)
+                time.sleep(max(e.retry_after or 0, backoff_delay(attempt)))
+
+    def send(self, message_id: str, text: str, chat_id: str = "", session=None, mark_done: bool = False,
+             queue_on_failure: bool = True) -> dict:
+        """发送一条回复（过长时切成多条），可重试错误按退避重试；仍失败时剩余各段写入 outbox 并抛出 SendError(queued=True)
+
+        返回最后一条的响应，其 data.message_id 为新消息的 id。
+        """
+        chunks = split_text(text, self.chunk_bytes)
+        uids = [reply_uuid(message_id, c if len(chunks) == 1 else f"{i}/{len(chunks)}:{c}") for i, c in enumerate(chunks)]
+        data = {}
+        for i, chunk in enumerate(chunks):
+            t0 = time.perf_counter()
+            try:
+                data = self._with_retry(lambda: self._post_once(message_id, chunk, uids[i], chat_id, session))
+                self._count("sent")
+                SEND_RESULTS.inc(result="ok", kind="reply")
+                REPLY_SECONDS.observe(time.perf_counter() - t0)
+            except SendError as err:
+                store = self._outbox() if queue_on_failure and err.retryable else None
+                log_event("send_failed", message_id=message_id, error=str(err), queued=store is not None)
+                if store is None:
+                    self._count("failed")
+                    SEND_RESULTS.inc(result="failed", kind="reply")
+                    raise
+                for j in range(i, len(chunks)):
+                    # 只有最后一段发出去才算回复完成
+                    store.outbox_add(uids[j], message_id, chunks[j], chat_id, mark_done and j == len(chunks) - 1,
+                                     attempts=self.max_attempts, error=str(err),
+                                     next_at=time.time() + backoff_delay(self.max_attempts, cap=OUTBOX_BACKOFF_MAX) + j * 0.001)
+                self._count("queued")
+                SEND_RESULTS.inc(result="queued", kind="reply")
+                raise SendError(f"{err}（已加入重试队列）", retryable=True, queued=True) from err
+        return data
+
+    def request(self, method: str, path: str, body: dict = None, params: dict = None, session=None, kind: str = "api") -> dict:
+        """调用任意开放平台接口（path 以 /open-apis 开头），同样限流 + 退避重试，返回响应 JSON"""
+        url = f"{self.host}{path}"
+        if params:
+            url += "?" + urlencode({k: v for k, v in params.items() if v not in (None, "")})
+        try:
+            data = self._with_retry(lambda: self._request_once(method, url, body, "", session), kind=kind)
+        except SendError:
+            SEND_RESULTS.inc(result="failed", kind=kind)
+            raise
+        SEND_RESULTS.inc(result="ok", kind=kind)
+        return data
+
+    def _download_once(self, url: str, fileobj, session=None) -> dict:
+        self.limiter.acquire()
+        for attempt in range(2):
+            token = self.cache.get(session=session)
+            try:
+                r = (session or requests).get(url, headers={"Authorization": f"Bearer {token}"}, stream=True, timeout=(10, 60))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                raise SendError(f"网络错误: {e}", retryable=True) from e
+            with r:
+                if r.status_code >= 400 or r.headers.get("Content-Type", "").startswith("application/json"):
+                    # 出错时返回的是 JSON
+                    try:
+                        data = r.json()
+                    except ValueError:
+                        data = {}
+                    if attempt == 0 and is_invalid_token_response(data):
+                        self.cache.invalidate(token)
+                        continue
+                    try:
+                        r.raise_for_status()
+                    except requests.HTTPError as e:
+                        raise _classify_http_error(e) from e
+                    code = data.get("code")
+                    raise SendError(f"code={code} {data.get('msg', '下载失败')}", retryable=code in RATE_LIMIT_CODES)
+                fileobj.seek(0)
+                fileobj.truncate()
+                try:
+                    for chunk in r.iter_content(65536):
+                        fileobj.write(chunk)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    raise SendError(f"网络错误: {e}", retryable=True) from e
+                return dict(r.headers)
+        raise SendError("token 失效", retryable=True)
+
+    def download(self, path: str, fileobj, params: dict = None, session=None) -> dict:
+        """下载二进制内容（如消息中的图片/文件）写入 fileobj，同样限流 + 退避重试，返回响应头"""
+        url = f"{self.host}{path}"
+        if params:
+            url += "?" + urlencode(params)
+        try:
+            headers = self._with_retry(lambda: self._download_once(url, fileobj, session), kind="download")
+        except SendError:
+            SEND_RESULTS.inc(result="failed", kind="download")
+            raise
+        SEND_RESULTS.inc(result="ok", kind="download")
+        return headers
+
+    def edit(self, message_id: str, text: str, chat_id: str = "", session=None) -> dict:
+        """编辑已发出的文本消息（message_id 为机器人自己发出的消息），可重试错误按退避重试"""
+        url = f"{self.host}/open-apis/im/v1/messages/{message_id}"
+        body = {"content": json.dumps({"text": text}, ensure_ascii=False), "msg_type": "text"}
+        try:
+            data = self._with_retry(lambda: self._request_once("PUT", url, body, chat_id, session), kind="edit")
+        except SendError:
+            SEND_RESULTS.inc(result="failed", kind="edit")
+            raise
+        SEND_RESULTS.inc(result="ok", kind="edit")
+        return data
+
+    def flush_outbox(self, limit: int = 50, session=None) -> dict:
+        """重发 outbox 中到期的条目，返回 {"sent", "retry", "failed"} 计数
+
+        多段回复按顺序逐段发送，一段发出后下一段在同一次 flush 内接着发；全部发出才标记已回复。
+        """
+        result = {"sent": 0, "retry": 0, "failed": 0}
+        store = self._outbox()
+        if store is None:
+            return result
+        done = 0
+        while done < limit:
+            rows = store.outbox_due(limit - done)
+            if not rows:
+                break
+            sent_before = result["sent"]
+            for row in rows:
+                done += 1
+                self._flush_one(store, row, result, session)
+            if result["sent"] == sent_before:
+                # 这一轮没有发出任何一段，不会有新的后续段到期
+                break
+        return result
+
+    def _flush_one(self, store, row: dict, result: dict, session=None):
+        """重发一段；失败时按退避推迟，不可重试或次数用尽时放弃"""
+        try:
+            self._post_once(row["message_id"], row["text"], row["uuid"], row["chat_id"], session)
+        except SendError as e:
+            attempts = row["attempts"] + 1
+            give_up = not e.retryable or attempts >= OUTBOX_MAX_ATTEMPTS
+            delay = max(e.retry_after or 0, backoff_delay(attempts, cap=OUTBOX_BACKOFF_MAX))
+            store.outbox_retry(row["uuid"], time.time() + delay, str(e), give_up=give_up)
+            result["failed" if give_up else "retry"] += 1
+            SEND_RESULTS.inc(result="failed" if give_up else "retry", kind="outbox")
+            return
+        store.outbox_done(row["uuid"])
+        self._count("sent")
+        SEND_RESULTS.inc(result="ok", kind="outbox")
+        result["sent"] += 1
+
+
+_senders = {}
+_senders_lock = threading.Lock()
+
+
+def get_sender(app_id: str, app_secret: str, host: str, workspace: str = None) -> LarkSender:
+    """按 (app_id, host, workspace) 返回进程内共享的 LarkSender，同进程所有线程共用一套限流"""
+    key = (app_id, host, os.path.abspath(workspace) if workspace else None)
+    with _senders_lock:
+        sender = _senders.get(key)
+        if sender is None or sender.cache.app_secret != app_secret:
+            sender = _senders[key] = LarkSender(app_id, app_secret, host, workspace)
+        return sender
+
+
+def start_outbox_flusher(sender, interval: float = 30.0):
+    """后台线程定期重发 outbox；sender 也可以是返回当前 LarkSender 的函数（凭据热更新后换用新的发送器）；interval <= 0 时不启动"""
+    current = sender if callable(sender) else (lambda: sender)
+    if interval <= 0 or not current().workspace:
+        return None
+
+    def _loop():
+        while True:
+            time.sleep(interval)
+            try:
+                r = current().flush_outbox()
+                if r["sent"] or r["failed"]:
+                    print(f"[{_ts()}] INFO: 重试队列 已重发={r['sent']} 待重试={r['retry']} 放弃={r['failed']}")
+            except Exception as e:
+                print(f"[{_ts()}] WARN: 重试队列处理失败: {e}", file=sys.stderr)
+
+    t = threading.Thread(target=_loop, name="lark-outbox", daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,806 @@
+"""
+飞书待办存储：SQLite（WAL）保存消息与回复状态，lark-pending.md 只是给 Agent 读的视图。
+
+- 去重、标记已回复、列出未回复都走主键/索引，不再整文件扫描或正则重切
+- 新消息只向 lark-pending.md 追加一个块，库里记下该块状态标记的字节偏移（md_offset）；未回复的块带 **[待回复]**，
+  标记已回复时按偏移原地改写成等长的 **[已回复]**，不重写整个文件；偏移对不上（视图被改动过）时才由库重新生成
+- status_many()：批量查询回复状态（lark_reply.py --status），Agent 不必重读 lark-pending.md
+- 首次打开时若库为空而 lark-pending.md 已有内容，会把旧块导入库中
+- compact()：已回复的块归档到 agent-tasks/archive/lark-YYYY-MM-DD.md.gz，视图只保留未回复的；
+  message_id 仍记在 archived 表里用于去重
+- 所有对 lark-pending.md 的写入都在 SQLite 写事务（BEGIN IMMEDIATE）内、并持有 lark-pending.md.lock 文件锁完成，
+  跨进程串行，因此归档/标记已回复与监听进程的追加可以同时进行而不丢块
+- 整体重写走临时文件 + os.replace，追加后 fsync；打开时发现视图末尾是半截块（进程崩溃）会从库重建
+- outbox 表：lark_sender 多次重试仍失败的回复，由监听进程或 lark_reply.py --flush-outbox 稍后重发
+- resources 表：lark_resource 下载过的附件（file_key → 内容哈希、大小、最近使用时间），用于缓存命中与按大小淘汰
+
+用法:
+  from lark_store import PendingStore
+  store = PendingStore(workspace)
+  if store.add(message_id, chat_id, text):
+      ...
+  store.mark_replied(message_id)
+
+  python lark_store.py compact --workspace D:\\proj        # 手动归档已回复的块
+  python lark_store.py stats --workspace D:\\proj
+  python lark_store.py stress --workspace %TEMP%\\lark-stress   # 多进程并发写入压力测试
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from lark_common import _ts
+from lark_filelock import FileLock, append_durable, atomic_write
+
+LARK_PENDING_FILENAME = "lark-pending.md"
+LARK_STORE_FILENAME = "lark-pending.db"
+ARCHIVE_DIRNAME = "archive"
+ARCHIVE_FILENAME = "lark-{}.md.gz"
+# lark-pending.md 超过该字节数时自动归档（0 关闭）
+DEFAULT_COMPACT_BYTES = 256 * 1024
+# 自动归档只处理回复超过该秒数的块，给刚回复完的 worker 留出统计时间
+AUTO_COMPACT_MIN_AGE = 60
+MARK_REPLIED = "**[已回复]**"
+# 与 MARK_REPLIED 字节数相同，标记已回复时原地覆盖
+MARK_PENDING = "**[待回复]**"
+PENDING_HEADER = (
+    "# 飞书待办\n\n"
+    "Agent 读取本文件，对每条无 **[已回复]** 的块：处理 user_text → 运行 lark_reply.py message_id \"回复\" --mark-done --workspace 项目根\n\n"
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id TEXT NOT NULL UNIQUE,
+    chat_id TEXT NOT NULL DEFAULT '',
+    text TEXT NOT NULL DEFAULT '',
+    received_at TEXT NOT NULL DEFAULT '',
+    replied INTEGER NOT NULL DEFAULT 0,
+    replied_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_replied ON messages(replied, seq);
+CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id, replied, seq);
+CREATE TABLE IF NOT EXISTS archived (
+    message_id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL DEFAULT '',
+    replied_ts REAL,
+    archived_at TEXT NOT NULL,
+    archive TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    uuid TEXT PRIMARY KEY,
+    message_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL DEFAULT '',
+    text TEXT NOT NULL,
+    mark_done INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(failed, next_at);
+CREATE TABLE IF NOT EXISTS resources (
+    file_key TEXT PRIMARY KEY,
+    message_id TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_resources_lru ON resources(last_used);
+CREATE INDEX IF NOT EXISTS idx_resources_sha ON resources(sha256);
+"""
+
+# 后续版本新增的列：(列名, 定义)，打开旧库时自动补齐
+_EXTRA_COLUMNS = (
+    ("claimed_by", "TEXT"),
+    ("dispatched_at", "REAL"),
+    ("replied_ts", "REAL"),
+    ("md_offset", "INTEGER"),
+)
+
+# 多次处理失败、不再派发的消息的 claimed_by 值
+CLAIM_FAILED = "failed"
+
+_SEP_RE = re.compile(r"\n---+\n")
+_TS_RE = re.compile(r"^\*\*\[([^\]]+)\]\*\*")
+
+
+def _encode(text: str) -> bytes:
+    # 与文本模式写文件的结果一致（Windows 上换行为 \r\n），字节偏移才算得准
+    return text.replace("\n", os.linesep).encode("utf-8")
+
+
+# 块末尾从状态标记开始的部分，用来由块的结束位置推出标记的偏移
+_MARK_TAIL = _encode(f"{MARK_PENDING}\n\n---\n")
+
+
+def task_dir(workspace: str) -> str:
+    return os.path.join(os.path.abspath(workspace), "agent-tasks")
+
+
+def render_block(message_id: str, chat_id: str, text: str, received_at: str, replied: bool = False) -> str:
+    """渲染单条待办块，格式与 Agent 提示词约定一致"""
+    marker = MARK_REPLIED if replied else MARK_PENDING
+    return f"""
+---
+message_id: {message_id}
+chat_id: {chat_id}
+**[{received_at}]** 用户消息：
+{text}
+
+{marker}
+
+---
+"""
+
+
+def parse_blocks(content: str):
+    """解析 lark-pending.md 中的待办块，返回 dict 列表（仅用于导入旧文件）"""
+    blocks = []
+    for chunk in _SEP_RE.split(content):
+        lines = chunk.strip("\n").split("\n")
+        fields = {}
+        body = []
+        in_body = False
+        for line in lines:
+            if in_body:
+                body.append(line)
+            elif line.startswith("message_id:"):
+                fields["message_id"] = line.split(":", 1)[1].strip()
+            elif line.startswith("chat_id:"):
+                fields["chat_id"] = line.split(":", 1)[1].strip()
+            else:
+                m = _TS_RE.match(line)
+                if m and fields.get("message_id"):
+                    fields["received_at"] = m.group(1)
+                    in_body = True
+        if not fields.get("message_id"):
+            continue
+        replied = MARK_REPLIED in chunk
+        text = "\n".join(line for line in body if line.strip() not in (MARK_REPLIED, MARK_PENDING)).strip()
+        blocks.append({
+            "message_id": fields["message_id"],
+            "chat_id": fields.get("chat_id", ""),
+            "text": text,
+            "received_at": fields.get("received_at", ""),
+            "replied": replied,
+        })
+    return blocks
+
+
+class PendingStore:
+    """lark-pending 的索引存储。线程安全；多进程并发由 SQLite 自身的锁保证。"""
+
+    def __init__(self, workspace: str, compact_bytes: int = 0):
+        """compact_bytes > 0 时，lark-pending.md 超过该大小会在 add 后自动归档已回复的块"""
+        self.task_dir = task_dir(workspace)
+        os.makedirs(self.task_dir, exist_ok=True)
+        self.db_path = os.path.join(self.task_dir, LARK_STORE_FILENAME)
+        self.md_path = os.path.join(self.task_dir, LARK_PENDING_FILENAME)
+        self.archive_dir = os.path.join(self.task_dir, ARCHIVE_DIRNAME)
+        self.compact_bytes = compact_bytes
+        self._md_lock = FileLock(self.md_path + ".lock")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+        self._import_legacy_markdown()
+        if not self._view_is_intact():
+            self.write_markdown()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _view_is_intact(self) -> bool:
+        """视图存在且以完整块（或文件头）结尾"""
+        try:
+            with open(self.md_path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                f.seek(max(0, size - 8))
+                tail = f.read().replace(b"\r\n", b"\n")
+        except OSError:
+            return False
+        return tail.endswith(b"---\n") or tail.endswith(b"\n\n")
+
+    @contextmanager
+    def _write_tx(self):
+        """SQLite 写事务：同时作为 lark-pending.md 的跨进程写锁"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _migrate(self):
+        with self._lock:
+            existing = {r["name"] for r in self._conn.execute("PRAGMA table_info(messages)").fetchall()}
+            for name, decl in _EXTRA_COLUMNS:
+                if name not in existing:
+                    try:
+                        self._conn.execute(f"ALTER TABLE messages ADD COLUMN {name} {decl}")
+                    except sqlite3.OperationalError:
+                        # 另一个进程刚补过
+                        pass
+
+    def _import_legacy_markdown(self):
+        if not os.path.isfile(self.md_path):
+            return
+        with self._lock:
+            if self._has_any(self._conn):
+                return
+            with open(self.md_path, "r", encoding="utf-8") as f:
+                blocks = parse_blocks(f.read())
+        if not blocks:
+            return
+        with self._write_tx() as conn:
+            if self._has_any(conn):
+                return
+            conn.executemany(
+                "INSERT OR IGNORE INTO messages(message_id, chat_id, text, received_at, replied) VALUES (?, ?, ?, ?, ?)",
+                [(b["message_id"], b["chat_id"], b["text"], b["received_at"], int(b["replied"])) for b in blocks],
+            )
+
+    @staticmethod
+    def _has_any(conn) -> bool:
+        return bool(
+            conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone()
+            or conn.execute("SELECT 1 FROM archived LIMIT 1").fetchone()
+        )
+
+    def has(self, message_id: str) -> bool:
+        """message_id 是否已收录（含已归档的）"""
+        with self._lock:
+            return (
+                self._conn.execute("SELECT 1 FROM messages WHERE message_id = ?", (message_id,)).fetchone() is not None
+                or self._conn.execute("SELECT 1 FROM archived WHERE message_id = ?", (message_id,)).fetchone() is not None
+            )
+
+    def is_replied(self, message_id: str):
+        """已回复返回 True（含已归档），未回复返回 False，不存在返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT replied FROM messages WHERE message_id = ?", (message_id,)).fetchone()
+            if row is None and self._conn.execute("SELECT 1 FROM archived WHERE message_id = ?", (message_id,)).fetchone():
+                return True
+        return None if row is None else bool(row["replied"])
+
+    def add(self, message_id: str, chat_id: str, text: str, received_at: str = None) -> bool:
+        """写入新消息并追加到 lark-pending.md；message_id 已存在（含已归档）时返回 False"""
+        received_at = received_at or _ts()
+        with self._write_tx() as conn:
+            if conn.execute("SELECT 1 FROM archived WHERE message_id = ?", (message_id,)).fetchone():
+                return False
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO messages(message_id, chat_id, text, received_at) VALUES (?, ?, ?, ?)",
+                (message_id, chat_id or "", text or "", received_at),
+            )
+            if cur.rowcount == 0:
+                return False
+            with self._md_lock:
+                size = append_durable(self.md_path, _encode(render_block(message_id, chat_id or "", text or "", received_at)))
+            conn.execute("UPDATE messages SET md_offset = ? WHERE seq = ?", (size - len(_MARK_TAIL), cur.lastrowid))
+        if self.compact_bytes and size > self.compact_bytes:
+            self.compact(min_age=AUTO_COMPACT_MIN_AGE)
+        return True
+
+    def mark_replied(self, message_id: str) -> bool:
+        """标记已回复并刷新视图；已标记或不存在时返回 False"""
+        return bool(self.mark_replied_many([message_id]))
+
+    def mark_replied_many(self, message_ids) -> list:
+        """批量标记已回复：一个事务 + 一次视图写入，返回实际发生变化的 message_id"""
+        changed = []
+        now, now_ts = _ts(), time.time()
+        with self._write_tx() as conn:
+            for mid in message_ids:
+                cur = conn.execute(
+                    "UPDATE messages SET replied = 1, replied_at = ?, replied_ts = ? WHERE message_id = ? AND replied = 0",
+                    (now, now_ts, mid),
+                )
+                if cur.rowcount > 0:
+                    changed.append(mid)
+            if changed and not self._mark_in_place_locked(conn, changed):
+                self._write_markdown_locked(conn)
+        return changed
+
+    def _mark_in_place_locked(self, conn, message_ids) -> bool:
+        """按 md_offset 把这些块的 **[待回复]** 原地改成 **[已回复]**；有偏移缺失或对不上时不改动并返回 False"""
+        offsets = []
+        for mid in message_ids:
+            row = conn.execute("SELECT md_offset FROM messages WHERE message_id = ?", (mid,)).fetchone()
+            if row is None or row["md_offset"] is None:
+                return False
+            offsets.append(row["md_offset"])
+        pending, replied = _encode(MARK_PENDING), _encode(MARK_REPLIED)
+        with self._md_lock:
+            try:
+                f = open(self.md_path, "r+b")
+            except OSError:
+                return False
+            with f:
+                # 先全部校验再写，避免改了一半才发现视图已被改动
+                for off in offsets:
+                    f.seek(off)
+                    if f.read(len(pending)) != pending:
+                        return False
+                for off in sorted(offsets):
+                    f.seek(off)
+                    f.write(replied)
+                f.flush()
+                os.fsync(f.fileno())
+        return True
+
+    def status_many(self, message_ids) -> dict:
+        """批量查询回复状态：{message_id: "pending" | "queued" | "replied" | "archived" | "unknown"}
+
+        queued 表示回复已进入 outbox 等待重发；archived 为已回复并已归档。
+        """
+        ids = list(dict.fromkeys(m for m in message_ids if m))
+        status = dict.fromkeys(ids, "unknown")
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                for r in self._conn.execute(f"SELECT message_id FROM archived WHERE message_id IN ({marks})", chunk):
+                    status[r[0]] = "archived"
+                for r in self._conn.execute(f"SELECT message_id, replied FROM messages WHERE message_id IN ({marks})", chunk):
+                    status[r[0]] = "replied" if r[1] else "pending"
+                for r in self._conn.execute(
+                    f"SELECT DISTINCT message_id FROM outbox WHERE failed = 0 AND message_id IN ({marks})", chunk
+                ):
+                    if status[r[0]] == "pending":
+                        status[r[0]] = "queued"
+        return status
+
+    def list_unreplied(self, limit: int = None):
+        sql = "SELECT message_id, chat_id, text, received_at FROM messages WHERE replied = 0 ORDER BY seq"
+        params = ()
+        if limit:
+            sql += " LIMIT ?"
+            params = (int(limit),)
+        with self._lock:
+            return [dict(r) for r in self._conn.execute(sql, params).fetchall()]
+
+    def recent_message_ids(self, limit: int) -> list:
+        """最近收录的 message_id（含已归档），按从旧到新排列，用于预热内存去重缓存"""
+        with self._lock:
+            live = [r[0] for r in self._conn.execute("SELECT message_id FROM messages ORDER BY seq DESC LIMIT ?", (int(limit),))]
+            rest = int(limit) - len(live)
+            archived = [r[0] for r in self._conn.execute(
+                "SELECT message_id FROM archived ORDER BY rowid DESC LIMIT ?", (rest,)
+            )] if rest > 0 else []
+        return list(reversed(archived)) + list(reversed(live))
+
+    def existing_ids(self, message_ids) -> set:
+        """批量判重：返回 message_ids 中已收录（含已归档）的那些"""
+        ids = list(dict.fromkeys(m for m in message_ids if m))
+        found = set()
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                for table in ("messages", "archived"):
+                    found.update(r[0] for r in self._conn.execute(
+                        f"SELECT message_id FROM {table} WHERE message_id IN ({marks})", chunk
+                    ))
+        return found
+
+    def last_received_ts(self):
+        """最近一条消息的收录时间（time.time() 时间戳），库为空返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT received_at FROM messages ORDER BY seq DESC LIMIT 1").fetchone()
+            if row is None:
+                row = self._conn.execute("SELECT MAX(replied_ts) FROM archived").fetchone()
+                return row[0] if row and row[0] else None
+        try:
+            return datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S").timestamp()
+        except ValueError:
+            return None
+
+    def known_chats(self, limit: int = 200) -> list:
+        """收到过消息的 chat_id（含已归档），最近活跃的在前，用于断线后补拉"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chat_id FROM (SELECT chat_id, MAX(seq) AS k FROM messages WHERE chat_id != '' GROUP BY chat_id) "
+                "ORDER BY k DESC LIMIT ?", (int(limit),)
+            ).fetchall()
+            chats = [r[0] for r in rows]
+            if len(chats) < limit:
+                seen = set(chats)
+                for (cid,) in self._conn.execute(
+                    "SELECT chat_id FROM archived WHERE chat_id != '' GROUP BY chat_id ORDER BY MAX(rowid) DESC"
+                ):
+                    if cid not in seen and len(chats) < limit:
+                        seen.add(cid)
+                        chats.append(cid)
+        return chats
+
+    def count_unreplied(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages WHERE replied = 0").fetchone()[0]
+
+    def claim_unreplied(self, worker: str, limit: int, per_chat: bool = False) -> list:
+        """为 worker 认领最多 limit 条未回复且未被认领的消息（原子操作），返回认领到的行
+
+        per_chat=True 时只认领一个会话的消息：挑最早一条所在、且当前没有被其他 worker 处理中的 chat_id，
+        保证同一会话内按顺序处理、不同会话可由不同 worker 并行处理。
+        """
+        now = time.time()
+        with self._write_tx() as conn:
+            if per_chat:
+                row = conn.execute(
+                    "SELECT chat_id FROM messages WHERE replied = 0 AND claimed_by IS NULL AND chat_id NOT IN ("
+                    " SELECT chat_id FROM messages WHERE replied = 0 AND claimed_by IS NOT NULL AND claimed_by != ?"
+                    ") ORDER BY seq LIMIT 1",
+                    (CLAIM_FAILED,),
+                ).fetchone()
+                seqs = [r[0] for r in conn.execute(
+                    "SELECT seq FROM messages WHERE chat_id = ? AND replied = 0 AND claimed_by IS NULL ORDER BY seq LIMIT ?",
+                    (row[0], int(limit)),
+                ).fetchall()] if row else []
+            else:
+                seqs = [r[0] for r in conn.execute(
+                    "SELECT seq FROM messages WHERE replied = 0 AND claimed_by IS NULL ORDER BY seq LIMIT ?", (int(limit),)
+                ).fetchall()]
+            if not seqs:
+                return []
+            marks = ",".join("?" * len(seqs))
+            conn.execute(f"UPDATE messages SET claimed_by = ?, dispatched_at = ? WHERE seq IN ({marks})", (worker, now, *seqs))
+            rows = conn.execute(
+                f"SELECT message_id, chat_id, text, received_at FROM messages WHERE seq IN ({marks}) ORDER BY seq", seqs
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def release_claims(self, worker: str, message_ids=None, claimed_by=None) -> int:
+        """释放 worker 名下仍未回复的认领；claimed_by 非空时改记为该值（如 failed）而不是清空"""
+        sql = "UPDATE messages SET claimed_by = ? WHERE claimed_by = ? AND replied = 0"
+        params = [claimed_by, worker]
+        if message_ids is not None:
+            message_ids = list(message_ids)
+            if not message_ids:
+                return 0
+            sql += f" AND message_id IN ({','.join('?' * len(message_ids))})"
+            params.extend(message_ids)
+        with self._lock:
+            return self._conn.execute(sql, params).rowcount
+
+    def reply_times(self, message_ids) -> dict:
+        """返回 {message_id: replied_ts 或 None}（含已归档的）"""
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+        marks = ",".join("?" * len(message_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT message_id, replied_ts FROM messages WHERE message_id IN ({marks})"
+                f" UNION ALL SELECT message_id, replied_ts FROM archived WHERE message_id IN ({marks})",
+                message_ids + message_ids,
+            ).fetchall()
+        return {r["message_id"]: r["replied_ts"] for r in rows}
+
+    # ---- 发送重试队列（lark_sender 使用） ----
+
+    def outbox_add(self, uuid: str, message_id: str, text: str, chat_id: str = "", mark_done: bool = False,
+                   attempts: int = 0, next_at: float = 0, error: str = "") -> bool:
+        """加入重试队列；同一 uuid 已在队列中时返回 False，之前已放弃的条目重新排队
+
+        同一条回复切成多段时按加入顺序（rowid）依次重发，见 outbox_due。
+        """
+        with self._write_tx() as conn:
+            cur = conn.execute(
+                "INSERT INTO outbox(uuid, message_id, chat_id, text, mark_done, attempts, next_at, last_error, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(uuid) DO UPDATE SET failed = 0, mark_done = excluded.mark_done, attempts = excluded.attempts,"
+                " next_at = excluded.next_at, last_error = excluded.last_error WHERE outbox.failed = 1",
+                (uuid, message_id, chat_id or "", text, int(mark_done), attempts, next_at, error, _ts()),
+            )
+            return cur.rowcount > 0
+
+    def outbox_due(self, limit: int = 50, now: float = None) -> list:
+        """到期待重发的条目（按 next_at 先后）
+
+        同一消息的多段回复只返回最前面一段：前一段发出（移出队列）后才轮到下一段，
+        前一段放弃后其余各段也不会再发，避免用户只收到后半截、消息却被标记已回复。
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM outbox AS o WHERE failed = 0 AND next_at <= ?"
+                " AND NOT EXISTS (SELECT 1 FROM outbox AS p WHERE p.message_id = o.message_id AND p.rowid < o.rowid)"
+                " ORDER BY next_at LIMIT ?",
+                (now, limit),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def outbox_pending(self, message_id: str) -> bool:
+        """该消息是否有尚未放弃的重发条目（此时不应再发一条新回复）"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM outbox WHERE message_id = ? AND failed = 0 AND mark_done = 1", (message_id,)
+            ).fetchone() is not None
+
+    def outbox_done(self, uuid: str):
+        """重发成功：移出队列；mark_done 的条目在该消息所有段都已发出（队列里没有剩余）时标记已回复"""
+        with self._write_tx() as conn:
+            row = conn.execute("SELECT message_id, mark_done FROM outbox WHERE uuid = ?", (uuid,)).fetchone()
+            conn.execute("DELETE FROM outbox WHERE uuid = ?", (uuid,))
+            complete = row is not None and conn.execute(
+                "SELECT 1 FROM outbox WHERE message_id = ?", (row["message_id"],)
+            ).fetchone() is None
+        if complete and row["mark_done"]:
+            self.mark_replied(row["message_id"])
+
+    def outbox_retry(self, uuid: str, next_at: float, error: str, give_up: bool = False):
+        """重发失败：推迟到 next_at；give_up 时该段连同同一消息的后续各段一起标记放弃（留在表里，消息保持未回复）"""
+        with self._write_tx() as conn:
+            conn.execute(
+                "UPDATE outbox SET attempts = attempts + 1, next_at = ?, last_error = ?, failed = ? WHERE uuid = ?",
+                (next_at, error[:500], int(give_up), uuid),
+            )
+            if give_up:
+                conn.execute(
+                    "UPDATE outbox SET failed = 1, last_error = ? WHERE message_id = (SELECT message_id FROM outbox WHERE uuid = ?)"
+                    " AND rowid > (SELECT rowid FROM outbox WHERE uuid = ?)",
+                    (f"前一段放弃: {error}"[:500], uuid, uuid),
+                )
+
+    # ---- 附件缓存索引（lark_resource 使用） ----
+
+    def resource_get(self, file_key: str):
+        """已缓存的附件（file_key → 内容寻址文件），命中时刷新最近使用时间；未缓存返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM resources WHERE file_key = ?", (file_key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE resources SET last_used = ? WHERE file_key = ?", (time.time(), file_key))
+        return dict(row) if row else None
+
+    def resource_put(self, file_key: str, message_id: str, sha256: str, size: int, filename: str):
+        with self._write_tx() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO resources(file_key, message_id, sha256, size, filename, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (file_key, message_id, sha256, int(size), filename, time.time()),
+            )
+
+    def resource_evict(self, max_bytes: int, keep: str = "") -> list:
+        """按最近使用时间淘汰，直到缓存文件总大小不超过 max_bytes（同一内容只算一次）；返回不再被引用、可以删除的文件名"""
+        removed = []
+        with self._write_tx() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM resources GROUP BY sha256)").fetchone()[0]
+            if total <= max_bytes:
+                return removed
+            for r in conn.execute("SELECT file_key, sha256, size, filename FROM resources ORDER BY last_used").fetchall():
+                if total <= max_bytes:
+                    break
+                if r["sha256"] == keep:
+                    continue
+                conn.execute("DELETE FROM resources WHERE file_key = ?", (r["file_key"],))
+                if conn.execute("SELECT 1 FROM resources WHERE sha256 = ? LIMIT 1", (r["sha256"],)).fetchone() is None:
+                    total -= r["size"]
+                    removed.append(r["filename"])
+        return removed
+
+    def resource_stats(self) -> dict:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM resources GROUP BY sha256)"
+            ).fetchone()
+            keys = self._conn.execute("SELECT COUNT(*) FROM resources").fetchone()[0]
+        return {"keys": keys, "files": row[0], "bytes": row[1]}
+
+    def _render_locked(self, conn) -> str:
+        rows = conn.execute("SELECT message_id, chat_id, text, received_at, replied FROM messages ORDER BY seq").fetchall()
+        parts = [PENDING_HEADER]
+        for r in rows:
+            parts.append(render_block(r["message_id"], r["chat_id"], r["text"], r["received_at"], bool(r["replied"])))
+        return "".join(parts)
+
+    def _write_markdown_locked(self, conn):
+        """由库整体重写视图，同时记下每个块状态标记的偏移"""
+        rows = conn.execute("SELECT message_id, chat_id, text, received_at, replied FROM messages ORDER BY seq").fetchall()
+        parts = [_encode(PENDING_HEADER)]
+        size = len(parts[0])
+        offsets = []
+        for r in rows:
+            block = _encode(render_block(r["message_id"], r["chat_id"], r["text"], r["received_at"], bool(r["replied"])))
+            parts.append(block)
+            size += len(block)
+            offsets.append((size - len(_MARK_TAIL), r["message_id"]))
+        with self._md_lock:
+            atomic_write(self.md_path, b"".join(parts))
+        conn.executemany("UPDATE messages SET md_offset = ? WHERE message_id = ?", offsets)
+
+    def render_markdown(self) -> str:
+        with self._lock:
+            return self._render_locked(self._conn)
+
+    def write_markdown(self):
+        with self._write_tx() as conn:
+            self._write_markdown_locked(conn)
+
+    def archive_path(self, day: str) -> str:
+        return os.path.join(self.archive_dir, ARCHIVE_FILENAME.format(day))
+
+    def compact(self, min_age: float = 0) -> int:
+        """把回复超过 min_age 秒的块追加到按回复日期划分的 .md.gz 归档，从库和视图中移除，返回归档条数"""
+        cutoff = time.time() - min_age
+        with self._write_tx() as conn:
+            rows = conn.execute(
+                "SELECT seq, message_id, chat_id, text, received_at, replied_at, replied_ts FROM messages"
+                " WHERE replied = 1 AND (replied_ts IS NULL OR replied_ts <= ?) ORDER BY seq",
+                (cutoff,),
+            ).fetchall()
+            if not rows:
+                return 0
+            by_day = {}
+            for r in rows:
+                day = (r["replied_at"] or r["received_at"] or _ts())[:10]
+                by_day.setdefault(day, []).append(r)
+            os.makedirs(self.archive_dir, exist_ok=True)
+            now = _ts()
+            for day, items in by_day.items():
+                path = self.archive_path(day)
+                # gzip 支持多成员拼接，追加写不需要解压旧内容
+                with gzip.open(path, "at", encoding="utf-8") as f:
+                    for r in items:
+                        f.write(render_block(r["message_id"], r["chat_id"], r["text"], r["received_at"], True))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO archived(message_id, chat_id, replied_ts, archived_at, archive) VALUES (?, ?, ?, ?, ?)",
+                    [(r["message_id"], r["chat_id"], r["replied_ts"], now, os.path.basename(path)) for r in items],
+                )
+            seqs = [r["seq"] for r in rows]
+            for i in range(0, len(seqs), 500):
+                chunk = seqs[i:i + 500]
+                conn.execute(f"DELETE FROM messages WHERE seq IN ({','.join('?' * len(chunk))})", chunk)
+            self._write_markdown_locked(conn)
+        return len(rows)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            unreplied = self._conn.execute("SELECT COUNT(*) FROM messages WHERE replied = 0").fetchone()[0]
+            archived = self._conn.execute("SELECT COUNT(*) FROM archived").fetchone()[0]
+            outbox = self._conn.execute("SELECT COUNT(*) FROM outbox WHERE failed = 0").fetchone()[0]
+            outbox_failed = self._conn.execute("SELECT COUNT(*) FROM outbox WHERE failed = 1").fetchone()[0]
+        return {
+            "live": total,
+            "unreplied": unreplied,
+            "replied_live": total - unreplied,
+            "archived": archived,
+            "outbox": outbox,
+            "outbox_failed": outbox_failed,
+            "md_bytes": os.path.getsize(self.md_path) if os.path.isfile(self.md_path) else 0,
+        }
+
+
+def _stress_writer(workspace: str, writer: int, count: int, chats: int):
+    with PendingStore(workspace) as store:
+        for i in range(count):
+            store.add(f"om_w{writer}_{i}", f"oc_{i % chats}", f"writer {writer} message {i}")
+
+
+def _stress_replier(workspace: str, targets: list, compact_every: int):
+    with PendingStore(workspace) as store:
+        for n, mid in enumerate(targets, 1):
+            deadline = time.time() + 60
+            while not store.has(mid):
+                if time.time() > deadline:
+                    raise RuntimeError(f"等待 {mid} 写入超时")
+                time.sleep(0.002)
+            # 单条标记以最大化整文件重写次数
+            store.mark_replied(mid)
+            if compact_every and n % compact_every == 0:
+                store.compact()
+
+
+def _read_archives(archive_dir: str) -> list:
+    blocks = []
+    if os.path.isdir(archive_dir):
+        for name in sorted(os.listdir(archive_dir)):
+            if name.endswith(".md.gz"):
+                with gzip.open(os.path.join(archive_dir, name), "rt", encoding="utf-8") as f:
+                    blocks.extend(parse_blocks(f.read()))
+    return blocks
+
+
+def run_stress(workspace: str, writers: int = 4, repliers: int = 4, count: int = 200, chats: int = 8, compact_every: int = 25) -> bool:
+    """多进程并发：writers 个进程追加消息，repliers 个进程逐条标记已回复并穿插归档，结束后校验无丢失"""
+    import multiprocessing
+
+    PendingStore(workspace).close()
+    all_ids = [f"om_w{w}_{i}" for w in range(writers) for i in range(count)]
+    # 偶数序号的消息会被回复，按序号分给各个 replier
+    to_reply = [mid for mid in all_ids if int(mid.rsplit("_", 1)[1]) % 2 == 0]
+    shares = [to_reply[j::repliers] for j in range(repliers)]
+
+    started = time.time()
+    procs = [multiprocessing.Process(target=_stress_writer, args=(workspace, w, count, chats)) for w in range(writers)]
+    procs += [multiprocessing.Process(target=_stress_replier, args=(workspace, share, compact_every)) for share in shares]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    elapsed = time.time() - started
+
+    errors = [f"子进程 pid={proc.pid} 退出码 {proc.exitcode}" for proc in procs if proc.exitcode != 0]
+    expected_replied = set(to_reply)
+    with PendingStore(workspace) as store:
+        for mid in all_ids:
+            state = store.is_replied(mid)
+            if state is None:
+                errors.append(f"丢失消息 {mid}")
+            elif state != (mid in expected_replied):
+                errors.append(f"{mid} 回复状态错误: {state}")
+        with store._lock:
+            live = {r["message_id"]: bool(r["replied"]) for r in store._conn.execute("SELECT message_id, replied FROM messages")}
+            archived = {r[0] for r in store._conn.execute("SELECT message_id FROM archived")}
+        with open(store.md_path, "r", encoding="utf-8") as f:
+            view = {b["message_id"]: b["replied"] for b in parse_blocks(f.read())}
+        if view != live:
+            missing = sorted(set(live) - set(view))[:5]
+            extra = sorted(set(view) - set(live))[:5]
+            wrong = sorted(mid for mid in set(view) & set(live) if view[mid] != live[mid])[:5]
+            errors.append(f"视图与库不一致: 缺 {missing} 多 {extra} 标记错 {wrong}")
+        archived_blocks = {b["message_id"] for b in _read_archives(store.archive_dir)}
+        if not archived <= archived_blocks:
+            errors.append(f"归档文件缺少 {sorted(archived - archived_blocks)[:5]}")
+        stats = store.stats()
+
+    print(json.dumps({
+        "writers": writers, "repliers": repliers, "messages": len(all_ids), "replied": len(to_reply),
+        "elapsed": round(elapsed, 2), "ok": not errors, **stats,
+    }, ensure_ascii=False))
+    for e in errors[:20]:
+        print("ERROR:", e)
+    return not errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="飞书待办存储维护")
+    parser.add_argument("command", choices=("compact", "stats", "render", "stress"),
+                        help="compact 归档已回复；stats 统计；render 重新生成 lark-pending.md；stress 并发写入压力测试")
+    parser.add_argument("--workspace", default=os.getcwd(), help="项目根目录（stress 请用空的临时目录）")
+    parser.add_argument("--min-age", type=float, default=0, help="compact：只归档回复超过该秒数的块")
+    parser.add_argument("--writers", type=int, default=4, help="stress：追加消息的进程数")
+    parser.add_argument("--repliers", type=int, default=4, help="stress：标记已回复的进程数")
+    parser.add_argument("--count", type=int, default=200, help="stress：每个写进程的消息数")
+    args = parser.parse_args()
+
+    if args.command == "stress":
+        sys.exit(0 if run_stress(args.workspace, args.writers, args.repliers, args.count) else 1)
+
+    with PendingStore(args.workspace) as store:
+        if args.command == "compact":
+            n = store.compact(min_age=args.min_age)
+            print(f"INFO: 已归档 {n} 条到 {store.archive_dir}")
+        elif args.command == "render":
+            store.write_markdown()
+            print(f"INFO: 已重新生成 {store.md_path}")
+        print(json.dumps(store.stats(), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+流式回复：Agent 边写回复文件，这边边把内容发到飞书，用户不用等整段回复写完。
+
+- 先回复一条消息，之后每隔 interval 秒把新增内容编辑进这条消息（飞书「编辑消息」接口）
+- 当前消息超过单条上限或编辑次数用完时定稿，剩余内容另起一条回复接着更新
+- 输入来源：tail 一个正在写入的文件（遇到 END_MARKER 行或 idle_timeout 秒无新内容结束），或 stdin 管道（EOF 结束）
+- 开始时先清空（或创建）该文件，上一次写入的旧回复和旧的结束标记不会被发给新用户；因此要先启动流式回复再写文件，
+  每条消息用自己的文件 agent-tasks/reply-stream-<message_id>.txt
+
+用法:
+  python lark_reply.py om_xxx --stream agent-tasks/reply-stream-om_xxx.txt --mark-done --workspace D:\\proj
+  agent ... | python lark_reply.py om_xxx --stream - --mark-done
+"""
+
+import codecs
+import os
+import sys
+import time
+
+from lark_sender import split_text
+
+DEFAULT_INTERVAL = 1.5
+# 飞书单条消息最多编辑 20 次，留一点余量给定稿
+MAX_EDITS = 18
+DEFAULT_IDLE_TIMEOUT = 300.0
+END_MARKER = "<<<END>>>"
+POLL_SECONDS = 0.2
+
+
+class ReplyStream:
+    """把不断追加的文本发成一条（或多条）逐步更新的飞书回复"""
+
+    def __init__(self, sender, message_id: str, chat_id: str = "", interval: float = DEFAULT_INTERVAL, max_edits: int = MAX_EDITS):
+        self.sender = sender
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.interval = interval
+        self.max_edits = max_edits
+        self.sent_ids = []  # 已发出的消息 id，按顺序
+        self.first_sent_at = None
+        self._text = ""
+        self._start = 0  # 当前消息对应 _text 的起始下标
+        self._current = None  # 当前正在更新的消息 id
+        self._shown = ""  # 当前消息在飞书上显示的内容
+        self._edits = 0
+        self._last_flush = 0.0
+
+    def write(self, text: str):
+        self._text += text
+        if time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        while True:
+            pending = self._text[self._start:]
+            if not pending.strip() or pending == self._shown:
+                return
+            if self._current and self._edits >= self.max_edits:
+                # 编辑次数用完：当前消息保持原样定稿，新内容另起一条
+                self._advance()
+                continue
+            piece = split_text(pending, self.sender.chunk_bytes)[0]
+            self._show(piece)
+            if piece == pending:
+                return
+            # 超过单条上限：这一段定稿，剩余内容另起一条
+            self._advance()
+
+    def _show(self, piece: str):
+        if self._current is None:
+            data = self.sender.send(self.message_id, piece, chat_id=self.chat_id, queue_on_failure=False)
+            self._current = (data.get("data") or {}).get("message_id", "")
+            self.sent_ids.append(self._current)
+            if self.first_sent_at is None:
+                self.first_sent_at = time.monotonic()
+        elif piece != self._shown:
+            self.sender.edit(self._current, piece, chat_id=self.chat_id)
+            self._edits += 1
+        self._shown = piece
+
+    def _advance(self):
+        self._start += len(self._shown)
+        self._current = None
+        self._shown = ""
+        self._edits = 0
+
+    def close(self):
+        self.flush()
+        return self.sent_ids
+
+
+def reset_file(path: str):
+    """清空（不存在则创建）流式回复文件"""
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    with open(path, "wb"):
+        pass
+
+
+def tail_file(path: str, idle_timeout: float = DEFAULT_IDLE_TIMEOUT, poll: float = POLL_SECONDS):
+    """逐段产出文件新增内容；遇到 END_MARKER 行（不输出）或超过 idle_timeout 秒无新内容时结束。path 为 - 时读 stdin 到 EOF"""
+    if path == "-":
+        for line in sys.stdin:
+            if line.strip() == END_MARKER:
+                return
+            yield line
+        return
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    deadline = time.monotonic() + idle_timeout
+    while not os.path.isfile(path):
+        if time.monotonic() >= deadline:
+            return
+        time.sleep(poll)
+    buf = ""
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(65536)
+            if data:
+                deadline = time.monotonic() + idle_timeout
+                buf += decoder.decode(data)
+                # 只输出完整行之前的部分，便于识别结束标记；结束标记之后的内容忽略
+                cut = buf.rfind("\n") + 1
+                out, buf = buf[:cut], buf[cut:]
+                lines = out.splitlines(keepends=True)
+                for i, line in enumerate(lines):
+                    if line.strip() == END_MARKER:
+                        yield "".join(lines[:i])
+                        return
+                if out:
+                    yield out
+                continue
+            if time.monotonic() >= deadline:
+                break
+            # 暂无新内容：不完整的行（且不可能是结束标记）也先交出去；空串让调用方有机会按时间 flush
+            if buf and not END_MARKER.startswith(buf.strip()):
+                out, buf = buf, ""
+                yield out
+            else:
+                yield ""
+            time.sleep(poll)
+    buf += decoder.decode(b"", final=True)
+    if buf and buf.strip() != END_MARKER:
+        yield buf
+
+
+def stream_reply(sender, message_id: str, source: str, chat_id: str = "", interval: float = DEFAULT_INTERVAL,
+                 idle_timeout: float = DEFAULT_IDLE_TIMEOUT) -> ReplyStream:
+    """把 source（文件路径或 -）的内容流式回复到 message_id，返回结束后的 ReplyStream；source 是文件时先清空"""
+    if source != "-":
+        reset_file(source)
+    stream = ReplyStream(sender, message_id, chat_id=chat_id, interval=interval)
+    for piece in tail_file(source, idle_timeout=idle_timeout):
+        stream.write(piece)
+    stream.close()
+    return stream
@@ -0,0 +1,171 @@
+"""
+tenant_access_token 缓存：按 expire 缓存并在到期前主动刷新，监听与回复共用。
+
+- 同一进程内多个线程同时取 token 时只会发起一次刷新（single-flight）；落盘时用文件锁把多个进程也合并为一次刷新
+- 可选落盘到 agent-tasks/lark-token.json，短命的 lark_reply.py 进程之间复用同一个 token
+
+用法:
+  from lark_token import get_token_cache
+  token = get_token_cache(app_id, app_secret, host, workspace).get()
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+import requests
+
+from lark_filelock import FileLock, atomic_write
+from lark_metrics import counter
+
+TOKEN_CACHE_FILENAME = "lark-token.json"
+# 距离过期不足该秒数时主动刷新（飞书 token 有效期约 2 小时）
+REFRESH_MARGIN = 300
+# 飞书返回这些 code 表示 token 无效/过期，需要丢弃缓存重取
+INVALID_TOKEN_CODES = (99991661, 99991663, 99991668)
+
+TOKEN_REFRESHES = counter("lark_token_refreshes_total", "tenant_access_token 实际向服务端刷新的次数")
+TOKEN_INVALIDATIONS = counter("lark_token_invalidations_total", "服务端判定 token 失效后丢弃缓存的次数")
+
+
+class TokenCache:
+    def __init__(self, app_id: str, app_secret: str, host: str, cache_path: str = None, refresh_margin: int = REFRESH_MARGIN):
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.host = host
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self.refresh_count = 0
+        self._token = ""
+        self._expire_at = 0.0
+        self._lock = threading.Lock()
+
+    def _fresh(self, now: float) -> bool:
+        return bool(self._token) and now < self._expire_at - self.refresh_margin
+
+    def get(self, force: bool = False, session=None) -> str:
+        """返回可用 token；快到期或 force 时刷新，并发调用共享同一次刷新"""
+        if not force and self._fresh(time.time()):
+            return self._token
+        stale = self._token
+        with self._lock:
+            # 等锁期间其他线程可能已经刷新过
+            if self._token != stale and self._fresh(time.time()):
+                return self._token
+            # 落盘时再加文件锁：多个 lark_reply.py 进程同时启动也只刷新一次
+            with FileLock(self.cache_path + ".lock") if self.cache_path else nullcontext():
+                if not force and self._load_disk() and self._fresh(time.time()):
+                    return self._token
+                self._refresh(session)
+                return self._token
+
+    def invalidate(self, token: str = None):
+        """丢弃缓存；传入 token 时仅当其仍为当前 token 才丢弃，避免误删别人刚刷新的"""
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = ""
+                self._expire_at = 0.0
+                with FileLock(self.cache_path + ".lock") if self.cache_path else nullcontext():
+                    self._remove_disk(token)
+
+    def _refresh(self, session=None):
+        url = f"{self.host}/open-apis/auth/v3/tenant_access_token/internal"
+        r = (session or requests).post(url, json={"app_id": self.app_id, "app_secret": self.app_secret}, timeout=10)
+        r.raise_for_status()
+        data = r.json()
+        if data.get("code") != 0:
+            raise RuntimeError(data.get("msg", "获取 tenant_access_token 失败"))
+        self._token = data["tenant_access_token"]
+        self._expire_at = time.time() + int(data.get("expire", 7200))
+        self.refresh_count += 1
+        TOKEN_REFRESHES.inc()
+        self._save_disk()
+
+    def _load_disk(self) -> bool:
+        if not (self.cache_path and os.path.isfile(self.cache_path)):
+            return False
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            return False
+        if data.get("app_id") != self.app_id or data.get("host") != self.host:
+            return False
+        self._token = data.get("tenant_access_token", "")
+        self._expire_at = float(data.get("expire_at", 0))
+        return bool(self._token)
+
+    def _save_disk(self):
+        if not self.cache_path:
+            return
+        data = {"app_id": self.app_id, "host": self.host, "tenant_access_token": self._token, "expire_at": self._expire_at}
+        try:
+            atomic_write(self.cache_path, json.dumps(data))
+            os.chmod(self.cache_path, 0o600)
+        except OSError:
+            pass
+
+    def _remove_disk(self, token: str = None):
+        if not self.cache_path:
+            return
+        if token is not None:
+            # 其他进程可能已写入新 token，只删除与失效 token 相同的缓存
+            try:
+                with open(self.cache_path, "r", encoding="utf-8") as f:
+                    if json.load(f).get("tenant_access_token") != token:
+                        return
+            except Exception:
+                return
+        try:
+            os.remove(self.cache_path)
+        except OSError:
+            pass
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_token_cache(app_id: str, app_secret: str, host: str, workspace: str = None) -> TokenCache:
+    """按 (app_id, host) 返回进程内共享的 TokenCache；给出 workspace 时启用落盘缓存"""
+    cache_path = os.path.join(os.path.abspath(workspace), "agent-tasks", TOKEN_CACHE_FILENAME) if workspace else None
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    key = (app_id, host)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None or cache.app_secret != app_secret:
+            cache = TokenCache(app_id, app_secret, host, cache_path=cache_path)
+            _caches[key] = cache
+        elif cache_path and not cache.cache_path:
+            cache.cache_path = cache_path
+        return cache
+
+
+def is_invalid_token_response(data: dict) -> bool:
+    return isinstance(data, dict) and data.get("code") in INVALID_TOKEN_CODES
+
+
+def authorized_request(cache: TokenCache, method: str, url: str, body: dict, session=None, timeout: int = 10) -> dict:
+    """带 tenant_access_token 的请求，返回响应 JSON；token 被服务端判定失效时刷新后重试一次"""
+    for attempt in range(2):
+        token = cache.get(session=session)
+        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+        r = (session or requests).request(method, url, json=body, headers=headers, timeout=timeout)
+        try:
+            data = r.json()
+        except ValueError:
+            data = None
+        if attempt == 0 and is_invalid_token_response(data):
+            TOKEN_INVALIDATIONS.inc()
+            cache.invalidate(token)
+            continue
+        r.raise_for_status()
+        return data or {}
+    return {}
+
+
+def authorized_post(cache: TokenCache, url: str, body: dict, session=None, timeout: int = 10) -> dict:
+    return authorized_request(cache, "POST", url, body, session=session, timeout=timeout)
@@ -0,0 +1,223 @@
+"""
+Agent worker 池（supervisor 模式）：常驻 N 个 worker，每个 worker 从待办库认领一小批消息，
+只把这几条写进自己的任务文件交给无头 Agent，而不是让每个 Agent 读整个 lark-pending.md。
+
+- 认领走 PendingStore.claim_unreplied，多个 worker 之间不会拿到同一条消息
+- 默认按会话分片：一个 worker 一次只认领一个 chat_id 的消息，且该会话处理中时其他 worker 不会接手，
+  因此会话内按顺序回复、不同会话并行；worker 数即全局并发上限
+- Agent 异常退出或没回复完：释放认领并按退避重启；同一条消息失败 MAX_ATTEMPTS 次后标记 failed 不再派发
+- Agent 运行超过 agent_timeout 秒（默认 DEFAULT_AGENT_TIMEOUT）视为卡死：结束进程，按一次失败处理并释放认领
+- 认领/读库出错（如 database is locked）只记日志并退避重试，worker 线程不会退出
+- 每条消息打印「启动 → 回复」耗时，stats() 汇总最近的延迟
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+from lark_common import _ts
+from lark_metrics import counter, histogram, log_event
+from lark_store import CLAIM_FAILED
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_BATCH = 5
+MAX_ATTEMPTS = 3
+DEFAULT_AGENT_TIMEOUT = 1800.0
+RESTART_BACKOFF_MAX = 30.0
+WORKER_TASK_FILENAME = "lark-worker-{}.md"
+WORKER_REPLIES_FILENAME = "replies-worker-{}.jsonl"
+
+# 与 lark_scheduler 同名，registry 返回同一个指标
+AGENT_SPAWNS = counter("lark_agent_spawns_total", "启动的无头 Agent 进程，result=ok/error")
+AGENT_EXITS = counter("lark_agent_exits_total", "退出的无头 Agent 进程")
+AGENT_REPLY_SECONDS = histogram("lark_agent_reply_seconds", "worker 启动 Agent 到该消息被回复的耗时")
+MESSAGES_FAILED = counter("lark_messages_failed_total", "多次处理仍未回复、不再派发的消息")
+AGENT_TIMEOUTS = counter("lark_agent_timeouts_total", "运行超时被结束的 Agent 进程")
+WORKER_ERRORS = counter("lark_agent_worker_errors_total", "worker 循环中的异常（认领、读库等）")
+
+
+def render_worker_task(rows: list) -> str:
+    """worker 任务文件：只含分给该 worker 的消息块"""
+    parts = ["# 飞书待办（分配给本 Agent）\n\n只处理下列消息，不要读取 lark-pending.md。\n"]
+    for r in rows:
+        parts.append(f"""
+---
+message_id: {r['message_id']}
+chat_id: {r['chat_id']}
+**[{r['received_at']}]** 用户消息：
+{r['text']}
+
+---
+""")
+    return "".join(parts)
+
+
+def _kill(proc):
+    """结束 Agent 进程；Windows 下 shell 启动的 agent 是子进程，连同进程树一起结束"""
+    try:
+        if sys.platform == "win32":
+            subprocess.run(["taskkill", "/T", "/F", "/PID", str(proc.pid)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+        else:
+            proc.kill()
+    except Exception:
+        pass
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        pass
+
+
+class AgentWorkerPool:
+    def __init__(self, store, spawn, size: int = DEFAULT_POOL_SIZE, batch: int = DEFAULT_BATCH, per_chat: bool = True,
+                 agent_timeout: float = DEFAULT_AGENT_TIMEOUT):
+        """
+        store: PendingStore
+        spawn: spawn(task_rel_path, replies_rel_path) -> subprocess.Popen 或 None，路径相对 workspace
+        agent_timeout: 单次 Agent 运行的最长秒数，超时结束进程（<= 0 不限）
+        """
+        self.store = store
+        self.spawn = spawn
+        self.size = max(1, size)
+        self.batch = max(1, batch)
+        self.per_chat = per_chat
+        self.agent_timeout = agent_timeout
+        self._wake = threading.Condition()
+        self._generation = 0
+        self._stopped = False
+        self._attempts = {}  # message_id -> 失败次数，由 _stats_lock 保护
+        self._latencies = deque(maxlen=200)
+        self._stats_lock = threading.Lock()
+        self._runs = 0
+        self._restarts = 0
+        self._timeouts = 0
+        self._threads = []
+        for i in range(self.size):
+            t = threading.Thread(target=self._worker, args=(i,), name=f"agent-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def notify(self):
+        """有新消息：唤醒空闲 worker 去认领"""
+        with self._wake:
+            self._generation += 1
+            self._wake.notify_all()
+
+    def stop(self):
+        with self._wake:
+            self._stopped = True
+            self._wake.notify_all()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            lat = sorted(self._latencies)
+            return {
+                "workers": self.size,
+                "runs": self._runs,
+                "restarts": self._restarts,
+                "timeouts": self._timeouts,
+                "replied": len(lat),
+                "p50_latency": round(lat[len(lat) // 2], 2) if lat else None,
+                "max_latency": round(lat[-1], 2) if lat else None,
+            }
+
+    def _wait_for_work(self, seen_generation: int, timeout: float) -> int:
+        with self._wake:
+            if not self._stopped and self._generation == seen_generation:
+                self._wake.wait(timeout)
+            return self._generation
+
+    def _wait_agent(self, name: str, proc) -> int:
+        """等待 Agent 退出；超过 agent_timeout 时结束进程，返回 None"""
+        try:
+            return proc.wait(timeout=self.agent_timeout if self.agent_timeout > 0 else None)
+        except subprocess.TimeoutExpired:
+            pass
+        print(f"[{_ts()}] {name} Agent pid={proc.pid} 运行超过 {self.agent_timeout:.0f}s，结束进程", file=sys.stderr)
+        _kill(proc)
+        AGENT_TIMEOUTS.inc()
+        with self._stats_lock:
+            self._timeouts += 1
+        log_event("agent_timeout", worker=name, pid=proc.pid, seconds=self.agent_timeout)
+        return None
+
+    def _worker(self, index: int):
+        name = f"worker-{index}"
+        task_rel = os.path.join("agent-tasks", WORKER_TASK_FILENAME.format(index))
+        replies_rel = os.path.join("agent-tasks", WORKER_REPLIES_FILENAME.format(index))
+        workspace = os.path.dirname(self.store.task_dir)
+        state = {"generation": 0, "backoff": 1.0, "released": False}
+        while not self._stopped:
+            try:
+                if not state["released"]:
+                    # 上次进程退出时遗留的认领
+                    self.store.release_claims(name)
+                    state["released"] = True
+                self._run_once(name, task_rel, replies_rel, workspace, state)
+            except Exception as e:
+                WORKER_ERRORS.inc()
+                log_event("agent_worker_error", worker=name, error=str(e))
+                print(f"[{_ts()}] {name} 出错: {e}，{state['backoff']:.0f}s 后重试", file=sys.stderr)
+                # 认领可能已写入库，下一轮先释放
+                state["released"] = False
+                time.sleep(state["backoff"])
+                state["backoff"] = min(state["backoff"] * 2, RESTART_BACKOFF_MAX)
+
+    def _run_once(self, name: str, task_rel: str, replies_rel: str, workspace: str, state: dict):
+        """认领一批消息交给一个 Agent 并等它结束；没有消息时等待通知"""
+        rows = self.store.claim_unreplied(name, self.batch, per_chat=self.per_chat)
+        if not rows:
+            state["generation"] = self._wait_for_work(state["generation"], 30.0)
+            return
+        ids = [r["message_id"] for r in rows]
+        with open(os.path.join(workspace, task_rel), "w", encoding="utf-8") as f:
+            f.write(render_worker_task(rows))
+        started = time.time()
+        proc = self.spawn(task_rel, replies_rel)
+        AGENT_SPAWNS.inc(result="ok" if proc is not None else "error")
+        log_event("agent_spawn", worker=name, pid=getattr(proc, "pid", None), messages=ids)
+        with self._stats_lock:
+            self._runs += 1
+        code = self._wait_agent(name, proc) if proc is not None else -1
+        if proc is not None:
+            AGENT_EXITS.inc()
+            log_event("agent_exit", worker=name, pid=proc.pid, code=code)
+        replied_at = self.store.reply_times(ids)
+        left = []
+        for mid in ids:
+            ts = replied_at.get(mid)
+            if ts:
+                latency = max(0.0, ts - started)
+                with self._stats_lock:
+                    self._latencies.append(latency)
+                    self._attempts.pop(mid, None)
+                AGENT_REPLY_SECONDS.observe(latency)
+                print(f"[{_ts()}] {name} message_id={mid} 启动→回复 {latency:.1f}s")
+            else:
+                left.append(mid)
+        if not left:
+            state["backoff"] = 1.0
+            # 本会话处理完，其他等待中的 worker 可能可以接手新的会话
+            self.notify()
+            return
+        failed = []
+        with self._stats_lock:
+            for mid in left:
+                self._attempts[mid] = self._attempts.get(mid, 0) + 1
+                if self._attempts[mid] >= MAX_ATTEMPTS:
+                    failed.append(mid)
+                    self._attempts.pop(mid, None)
+            self._restarts += 1
+        if failed:
+            self.store.release_claims(name, failed, claimed_by=CLAIM_FAILED)
+            MESSAGES_FAILED.inc(len(failed))
+            print(f"[{_ts()}] {name} 以下消息多次处理失败，不再派发: {', '.join(failed)}", file=sys.stderr)
+        self.store.release_claims(name)
+        self.notify()
+        reason = "超时被结束" if code is None else f"退出 code={code}"
+        print(f"[{_ts()}] {name} Agent {reason}，未回复 {len(left)} 条，{state['backoff']:.0f}s 后重启", file=sys.stderr)
+        time.sleep(state["backoff"])
+        state["backoff"] = min(state["backoff"] * 2, RESTART_BACKOFF_MAX)
@@ -0,0 +1,230 @@
+"""
+飞书长连接守护：快速重连 + 心跳 + 卡死检测，替代「任何异常都 sleep 30s 再重建 Client」。
+
+- 同一个 lark.ws.Client 复用到底，断线后按指数退避 + 全抖动重连：首次等待不超过 RECONNECT_BASE 秒，上限 RECONNECT_MAX
+- 自己每 PING_INTERVAL 秒发 ping，任何入站帧（pong、事件）都算心跳；STALL_TIMEOUT 秒一帧都没收到视为连接卡死，主动断开重连
+- 回调阻塞事件循环（如队列满时等待空位）或 busy() 为真时给一个 ping 周期的宽限，不把自己的积压误判为连接卡死
+- 重连成功后在后台线程调用 on_reconnected(since)，since 为断线前最后一次收到帧的时间戳，调用方据此补拉断线期间的消息（lark_backfill.py）
+- health() 给出在线状态、最后一帧距今秒数、重连次数
+- reconnect() 换用新的凭据 / 域名并主动重连（lark-config.json 热更新时调用），普通调优项的变化不会触发重连
+- 依赖 lark_oapi.ws.Client 的内部方法（_connect / _disconnect / _handle_message / _write_message），SDK 结构变化时退回 client.start()
+
+用法:
+  sup = WsSupervisor(app_id, app_secret, event_handler, domain_host(domain_key), on_reconnected=lambda since: ...)
+  sup.run()   # 阻塞
+"""
+
+import asyncio
+import sys
+import threading
+import time
+
+from lark_common import _ts
+from lark_metrics import counter, gauge, histogram, log_event
+from lark_sender import backoff_delay
+
+RECONNECT_BASE = 0.5
+RECONNECT_MAX = 30.0
+PING_INTERVAL = 15.0
+STALL_TIMEOUT = 45.0
+# 连上后稳定这么久才把退避次数清零，避免「连上即断」时退避失效
+STABLE_SECONDS = 60.0
+# 卡死的连接做关闭握手可能一直等不到对端，限时后直接丢弃
+DISCONNECT_TIMEOUT = 2.0
+WATCH_TICK = 1.0
+
+RECONNECTS = counter("lark_ws_reconnects_total", "长连接断线后重连成功的次数")
+CONNECT_FAILURES = counter("lark_ws_connect_failures_total", "长连接建立失败的次数")
+STALLS = counter("lark_ws_stalls_total", "长时间未收到任何帧、判定卡死而主动断开的次数")
+DOWNTIME_SECONDS = histogram("lark_ws_downtime_seconds", "断线到重连成功的耗时")
+CONNECTED = gauge("lark_ws_connected", "长连接是否在线（1/0）")
+
+_SDK_METHODS = ("_connect", "_disconnect", "_handle_message", "_write_message", "_service_id")
+
+
+class WsSupervisor:
+    def __init__(self, app_id: str, app_secret: str, event_handler, domain: str, on_reconnected=None, busy=None,
+                 ping_interval: float = PING_INTERVAL, stall_timeout: float = STALL_TIMEOUT,
+                 base: float = RECONNECT_BASE, cap: float = RECONNECT_MAX):
+        import lark_oapi as lark
+
+        # 重连由这里负责，关掉 SDK 自带的（首次随机等待最多 30s、之后每 120s 一次）
+        self.client = lark.ws.Client(app_id, app_secret, event_handler=event_handler, domain=domain, auto_reconnect=False)
+        self.on_reconnected = on_reconnected
+        self.busy = busy
+        self.ping_interval = ping_interval
+        self.stall_timeout = stall_timeout
+        self.base = base
+        self.cap = cap
+        self.connected = False
+        self.connected_at = 0.0
+        self.last_frame = 0.0  # time.time()
+        self.reconnects = 0
+        self._lost = None  # 本次连接的断开通知（asyncio.Event）
+        self._lost_reason = ""
+        self._loop = None
+
+    def health(self) -> dict:
+        now = time.time()
+        return {
+            "connected": self.connected,
+            "uptime_s": round(now - self.connected_at, 1) if self.connected else 0.0,
+            "last_frame_age_s": round(now - self.last_frame, 1) if self.last_frame else None,
+            "reconnects": self.reconnects,
+        }
+
+    def reconnect(self, reason: str = "配置变更", app_id: str = None, app_secret: str = None, domain: str = None):
+        """换用新的凭据 / 域名（None 表示不变）并断开当前连接，由重连流程连到新地址；未连上时下次连接生效"""
+        client = self.client
+        if app_id:
+            client._app_id = app_id
+        if app_secret:
+            client._app_secret = app_secret
+        if domain:
+            client._domain = domain
+        loop, lost = self._loop, self._lost
+        if loop is None or lost is None or not self.connected:
+            return
+
+        def _drop():
+            self._lost_reason = self._lost_reason or reason
+            lost.set()
+
+        loop.call_soon_threadsafe(_drop)
+
+    def run(self):
+        """阻塞运行；KeyboardInterrupt 向上抛出"""
+        from lark_oapi.ws import client as ws_client
+
+        if not all(hasattr(self.client, n) for n in _SDK_METHODS):
+            print(f"[{_ts()}] WARN: 当前 lark_oapi 版本不支持接管重连，使用 SDK 自带重连", file=sys.stderr)
+            self._run_sdk()
+            return
+        # SDK 的协程都跑在它模块级的事件循环上，这里也必须用同一个
+        ws_client.loop.run_until_complete(self._supervise(ws_client.loop))
+
+    def _run_sdk(self):
+        self.client._auto_reconnect = True
+        attempt = 0
+        while True:
+            try:
+                self.client.start()
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                delay = backoff_delay(attempt, self.base, self.cap)
+                attempt += 1
+                print(f"[{_ts()}] 连接失败: {e}，{delay:.1f}s 后重试...", file=sys.stderr)
+                time.sleep(delay)
+
+    # ---- 连接管理 ----
+
+    async def _supervise(self, loop):
+        client = self.client
+        self._loop = loop
+        # 接管收帧循环：记录心跳，断开时通知这里，而不是让 SDK 自己慢速重连
+        client._receive_message_loop = lambda: self._receive_loop(loop)
+        attempt = 0  # 退避指数
+        tries = 0  # 本次断线以来的连接尝试次数
+        down_since = None  # 断线时刻
+        last_seen = 0.0  # 断线前最后一次收到帧的时刻
+        while True:
+            if down_since is not None:
+                await asyncio.sleep(backoff_delay(attempt, self.base, self.cap))
+            self._lost = asyncio.Event()
+            self._lost_reason = ""
+            tries += 1
+            try:
+                await client._connect()
+            except Exception as e:
+                CONNECT_FAILURES.inc()
+                attempt += 1
+                down_since = down_since or time.time()
+                print(f"[{_ts()}] 长连接建立失败（第 {tries} 次）: {e}", file=sys.stderr)
+                log_event("ws_connect_failed", error=str(e), attempt=tries)
+                await self._disconnect()
+                continue
+
+            now = time.time()
+            self.connected, self.connected_at, self.last_frame = True, now, now
+            CONNECTED.set(1)
+            if down_since is None:
+                print(f"[{_ts()}] 长连接已建立")
+            else:
+                downtime = now - down_since
+                self.reconnects += 1
+                RECONNECTS.inc()
+                DOWNTIME_SECONDS.observe(downtime)
+                print(f"[{_ts()}] 长连接已恢复，断线 {downtime:.2f}s，尝试 {tries} 次")
+                log_event("ws_reconnected", downtime_s=round(downtime, 3), attempts=tries)
+                if self.on_reconnected and last_seen:
+                    threading.Thread(target=self._fire_reconnected, args=(last_seen,), name="lark-ws-catchup", daemon=True).start()
+
+            tries = 0
+            reason = await self._watch()
+            last_seen = self.last_frame
+            down_since = time.time()
+            self.connected = False
+            CONNECTED.set(0)
+            attempt = 0 if down_since - self.connected_at >= STABLE_SECONDS else attempt + 1
+            print(f"[{_ts()}] 长连接断开（{reason}），重连中...", file=sys.stderr)
+            log_event("ws_disconnected", reason=reason, uptime_s=round(down_since - self.connected_at, 1))
+            await self._disconnect()
+
+    async def _disconnect(self):
+        try:
+            await asyncio.wait_for(self.client._disconnect(), DISCONNECT_TIMEOUT)
+        except Exception as e:
+            print(f"[{_ts()}] 关闭旧连接超时或失败，直接丢弃: {e!r}", file=sys.stderr)
+
+    def _fire_reconnected(self, since: float):
+        try:
+            self.on_reconnected(since)
+        except Exception as e:
+            print(f"[{_ts()}] 重连后补拉失败: {e}", file=sys.stderr)
+
+    async def _receive_loop(self, loop):
+        lost = self._lost
+        conn = self.client._conn
+        try:
+            while True:
+                msg = await conn.recv()
+                self.last_frame = time.time()
+                loop.create_task(self.client._handle_message(msg))
+        except Exception as e:
+            self._lost_reason = f"连接关闭: {e}"
+        finally:
+            lost.set()
+
+    async def _watch(self) -> str:
+        """连接期间定期 ping 并检查心跳，连接断开或卡死时返回原因"""
+        lost = self._lost
+        last_ping = 0.0
+        grace_until = 0.0
+        while True:
+            t0 = time.monotonic()
+            try:
+                await asyncio.wait_for(lost.wait(), WATCH_TICK)
+                return self._lost_reason or "连接关闭"
+            except asyncio.TimeoutError:
+                pass
+            now = time.monotonic()
+            if now - t0 > WATCH_TICK * 2 or (self.busy and self.busy()):
+                # 事件循环被回调阻塞或本地积压：收不到帧是自己的原因，等一个 ping 来回再判断
+                grace_until = now + self.ping_interval
+            if now - last_ping >= self.ping_interval:
+                last_ping = now
+                try:
+                    await self.client._write_message(_ping_frame(self.client._service_id))
+                except Exception as e:
+                    return f"ping 失败: {e}"
+            silent = time.time() - self.last_frame
+            if silent > self.stall_timeout and now > grace_until:
+                STALLS.inc()
+                return f"{silent:.0f}s 未收到任何帧"
+
+
+def _ping_frame(service_id: str) -> bytes:
+    from lark_oapi.ws.client import _new_ping_frame
+
+    return _new_ping_frame(int(service_id or 0)).SerializeToString()